@@ -0,0 +1,390 @@
+"""
+Autopilot for DangerNoodle, a controller that plays the game by itself for demos and attract mode.
+Like every controller it is a callable taking a GameState and returning a direction, see tournament.py,
+so the same controller plays in the window with --autopilot and headless in tournaments.
+
+The board is covered by a Hamiltonian cycle, a closed path visiting every cell once. As long as the body
+lies along the cycle in order from tail to head, with gaps allowed, the snake can never get trapped:
+every cell ahead of the head up to the tail is free, so it can always follow the cycle around to its tail.
+The autopilot keeps that order and takes shortcuts across the cycle towards the apple, picking the
+neighbour that is closest to the apple in a BFS distance field. The field is only computed again when
+a new apple spawns, so most ticks are a handful of lookups. As the snake grows the room for shortcuts
+shrinks, and once it covers half of the board it simply follows the cycle until the board is full.
+When the body is not in cycle order (a board without a Hamiltonian cycle, or a game taken over halfway)
+it takes the BFS shortest path to the apple, but only if the tail is still reachable from the apple
+once the snake gets there, and otherwise chases its own tail until it is safe again.
+Usage:
+controller = PathfindingController()
+state = GameState(40, 30)
+while state.step(controller(state)):
+    pass
+"""
+
+from collections import deque
+from itertools import islice
+
+from engine import UP, LEFT, DOWN, RIGHT, DIRECTION_STEPS
+
+# Boards with more cells than this are too large to plan on every apple, there the autopilot only
+# avoids dying on the next tick
+MAX_PLANNING_CELLS = 1 << 16
+# Shortcuts leave gaps in the body, and an apple spawning in a gap can only be reached once the tail has
+# passed it. Once the snake covers this fraction of the board it follows the cycle without shortcuts,
+# so the gaps close before the board fills up
+SHORTCUT_MAX_FILL = 0.5
+UNREACHABLE = -1
+
+
+def hamiltonian_cycle(columns, rows):
+    """
+    Function to return a list of the (x, y) cells of a Hamiltonian cycle of the board, in order.
+    Returns None if the board has none, which is the case when both sides are odd or a side is 1.
+    The first row is walked from left to right, the other rows except the first column in a zigzag,
+    and the first column back up
+    Parameters:
+        columns (int): The width of the board in cells
+        rows (int): The height of the board in cells
+    """
+    if columns < 2 or rows < 2 or (columns % 2 and rows % 2):
+        return None
+    if rows % 2:
+        # Only the amount of columns is even, build the cycle on the mirrored board
+        return [(x, y) for y, x in hamiltonian_cycle(rows, columns)]
+    cycle = [(x, 0) for x in range(columns)]
+    for y in range(1, rows):
+        xs = range(columns - 1, 0, -1) if y % 2 else range(1, columns)
+        cycle.extend((x, y) for x in xs)
+    cycle.extend((0, y) for y in range(rows - 1, 0, -1))
+    return cycle
+
+
+class PathfindingController():
+    """
+    Controller that plays the game by pathfinding on the occupancy grid, see the module docstring.
+    The tables for a board are built on the first call and reused for every game on a board of the same size.
+    Usage:
+    controller = PathfindingController()
+    direction = controller(state)
+    """
+    def __init__(self):
+        self.board = None # (columns, rows, boundaries) the tables are built for
+        self.neighbours = None # cell -> tuple of (neighbouring cell, direction to move there)
+        self.cycle_index = None # cell -> position along the Hamiltonian cycle, None without a cycle
+        self.distances = None # distance field to the apple, UNREACHABLE for blocked cells
+        self.field_key = None # (state, boundaries, apple cell) the distance field was computed for
+        self.state = None # the state of the previous call, to notice a new game
+        self.ticks = -1 # the ticks of the state on the previous call
+        self.expected_head = None # the cell the head should be in after the previous move
+        self.ordered = False # True if the body is known to lie along the cycle in order
+        self.path = deque() # remaining cells of the path to the apple, when the body is not in cycle order
+
+    def __call__(self, state):
+        """
+        Function to return the direction to move in on the next tick, or None to keep going straight
+        Parameters:
+            state (GameState): The current game state
+        """
+        if (state.columns, state.rows, state.boundaries) != self.board:
+            self.build(state)
+        if self.neighbours is None:
+            return self.safe_direction(state)
+        head = state.body.head()
+        head_cell = head.y * state.columns + head.x
+        if state is not self.state or state.ticks != self.ticks + 1 or head_cell != self.expected_head:
+            # A new game, or the previous move was not made, check the order of the body from scratch.
+            # A state that was reset keeps its identity, so its distance field is computed again as well
+            self.state = state
+            self.field_key = None
+            self.ordered = self.is_ordered(state)
+            self.path.clear()
+        elif not self.ordered and self.cycle_index is not None:
+            self.ordered = self.is_ordered(state)
+        self.ticks = state.ticks
+        if self.ordered:
+            cell, direction = self.plan_ordered(state, head_cell)
+            if cell is None:
+                self.ordered = False
+        if not self.ordered:
+            cell, direction = self.plan_unordered(state, head_cell)
+        self.expected_head = cell
+        return direction
+
+    def build(self, state):
+        """
+        Function to build the neighbour table and the Hamiltonian cycle of the board of a state
+        Parameters:
+            state (GameState): A game state on the board
+        """
+        columns = state.columns
+        rows = state.rows
+        self.board = (columns, rows, state.boundaries)
+        self.distances = None
+        self.field_key = None
+        self.state = None
+        if columns * rows > MAX_PLANNING_CELLS:
+            self.neighbours = None
+            self.cycle_index = None
+            return
+        neighbours = []
+        for y in range(rows):
+            for x in range(columns):
+                cell_neighbours = []
+                for direction in (UP, LEFT, DOWN, RIGHT):
+                    dx, dy = DIRECTION_STEPS[direction]
+                    nx = x + dx
+                    ny = y + dy
+                    if not (0 <= nx < columns and 0 <= ny < rows):
+                        if state.boundaries:
+                            continue
+                        nx %= columns
+                        ny %= rows
+                    cell_neighbours.append( (ny * columns + nx, direction) )
+                neighbours.append(tuple(cell_neighbours))
+        self.neighbours = neighbours
+        cycle = hamiltonian_cycle(columns, rows)
+        if cycle is None:
+            self.cycle_index = None
+        else:
+            self.cycle_index = [0] * (columns * rows)
+            for position, (x, y) in enumerate(cycle):
+                self.cycle_index[y * columns + x] = position
+
+    def is_ordered(self, state):
+        """
+        Function to check if the body lies along the Hamiltonian cycle in order from tail to head.
+        That is the case when the steps along the cycle from every segment to the next add up to less than a lap
+        Parameters:
+            state (GameState): The current game state
+        """
+        index = self.cycle_index
+        if index is None:
+            return False
+        columns = state.columns
+        size = len(index)
+        segments = state.body.segments
+        tail = segments[0]
+        previous = index[tail.y * columns + tail.x]
+        span = 0
+        for segment in islice(segments, 1, None):
+            position = index[segment.y * columns + segment.x]
+            span += (position - previous) % size
+            previous = position
+        return span < size
+
+    def plan_ordered(self, state, head_cell):
+        """
+        Function to pick the next move while the body is in cycle order, returns (cell, direction).
+        A move is only allowed to skip ahead along the cycle as far as it stays before the tail, which keeps
+        the body in order, and as far as the apple, so the apple is never passed. Of the allowed moves the one
+        closest to the apple in the distance field is taken. Returns (None, None) if no move is allowed
+        Parameters:
+            state (GameState): The current game state
+            head_cell (int): The cell of the head
+        """
+        index = self.cycle_index
+        size = len(index)
+        columns = state.columns
+        head_position = index[head_cell]
+        tail = state.body.tail()
+        free = (index[tail.y * columns + tail.x] - head_position) % size
+        # The tail cell itself is only safe if the tail moves away this tick
+        limit = free if len(state.body) >= state.snake_length else free - 1
+        if len(state.body) >= size * SHORTCUT_MAX_FILL:
+            limit = min(limit, 1)
+        apple_gap = (index[state.apple_y * columns + state.apple_x] - head_position) % size
+        apple_ahead = apple_gap <= limit
+        if apple_ahead:
+            limit = apple_gap
+            distances = self.distance_field(state)
+        best = None
+        best_key = None
+        for cell, direction in self.neighbours[head_cell]:
+            gap = (index[cell] - head_position) % size
+            if gap == 0 or gap > limit:
+                continue
+            if apple_ahead:
+                distance = distances[cell]
+                # Cells cut off in a stale distance field are tried last, further along the cycle first
+                key = (distance if distance != UNREACHABLE else size, -gap)
+            else:
+                # The apple lies in a gap behind the head, move on along the cycle as fast as allowed
+                key = (-gap,)
+            if best_key is None or key < best_key:
+                best = (cell, direction)
+                best_key = key
+        return best if best is not None else (None, None)
+
+    def distance_field(self, state):
+        """
+        Function to return the BFS distance of every free cell to the apple. The field is reused until a
+        new apple spawns: cells freed by the tail in the meantime are missing from it and cells taken by
+        the head are still in it, which only makes it slightly less accurate, never unsafe
+        Parameters:
+            state (GameState): The current game state
+        """
+        apple = state.apple_y * state.columns + state.apple_x
+        if self.field_key != (state, state.boundaries, apple):
+            self.distances = self.bfs(state.grid.counts, apple)
+            self.field_key = (state, state.boundaries, apple)
+        return self.distances
+
+    def bfs(self, blocked, source, target=None):
+        """
+        Function to return the BFS distance from a source cell to every cell reachable through unblocked cells.
+        The source itself is always expanded. Stops early once the target is reached, if given
+        Parameters:
+            blocked (bytearray): Non-zero for every blocked cell
+            source (int): The cell to start from
+            target (int): The cell to stop at. Defaults to None
+        """
+        neighbours = self.neighbours
+        distances = [UNREACHABLE] * len(neighbours)
+        distances[source] = 0
+        queue = deque((source,))
+        pop = queue.popleft
+        push = queue.append
+        while queue:
+            cell = pop()
+            if cell == target:
+                break
+            distance = distances[cell] + 1
+            for next_cell, _ in neighbours[cell]:
+                if distances[next_cell] == UNREACHABLE and not blocked[next_cell]:
+                    distances[next_cell] = distance
+                    push(next_cell)
+        return distances
+
+    def plan_unordered(self, state, head_cell):
+        """
+        Function to pick the next move while the body is not in cycle order, returns (cell, direction).
+        Follows the shortest path to the apple, planned again whenever the apple moves, as long as the snake
+        can still reach its tail after eating the apple. Otherwise it chases its tail
+        Parameters:
+            state (GameState): The current game state
+            head_cell (int): The cell of the head
+        """
+        counts = state.grid.counts
+        apple = state.apple_y * state.columns + state.apple_x
+        if not (self.path and self.path[-1] == apple):
+            path = self.shortest_path(state, head_cell, apple)
+            self.path = deque(path) if path and self.tail_reachable(state, path) else deque()
+        if self.path:
+            cell = self.path.popleft()
+            for next_cell, direction in self.neighbours[head_cell]:
+                if next_cell == cell and not counts[cell]:
+                    return cell, direction
+            self.path.clear()
+        return self.chase_tail(state, head_cell)
+
+    def shortest_path(self, state, head_cell, target):
+        """
+        Function to return the cells of a shortest path from the head to a target cell, excluding the head,
+        or None if the target can't be reached
+        Parameters:
+            state (GameState): The current game state
+            head_cell (int): The cell of the head
+            target (int): The cell to find a path to
+        """
+        blocked = self.blocked_cells(state)
+        distances = self.bfs(blocked, head_cell, target)
+        if distances[target] == UNREACHABLE:
+            return None
+        # Walk back from the target along decreasing distances
+        path = [target]
+        cell = target
+        while distances[cell] > 1:
+            for previous, _ in self.neighbours[cell]:
+                if distances[previous] == distances[cell] - 1:
+                    cell = previous
+                    break
+            path.append(cell)
+        path.reverse()
+        return path
+
+    def blocked_cells(self, state):
+        """
+        Function to return the cells blocked on the next tick: the body, except the tail if it moves away
+        Parameters:
+            state (GameState): The current game state
+        """
+        counts = state.grid.counts
+        if len(state.body) < state.snake_length:
+            return counts
+        blocked = bytearray(counts)
+        tail = state.body.tail()
+        blocked[tail.y * state.columns + tail.x] = 0
+        return blocked
+
+    def tail_reachable(self, state, path):
+        """
+        Function to check if the snake can still reach its tail once it has followed a path,
+        by moving a copy of the body along the path
+        Parameters:
+            state (GameState): The current game state
+            path (list): The cells of the path, excluding the head
+        """
+        columns = state.columns
+        cells = [segment.y * columns + segment.x for segment in state.body]
+        cells.extend(path)
+        # The snake grows by one for the apple at the end of the path
+        length = min(len(cells), state.snake_length + 1)
+        body = cells[-length:]
+        blocked = bytearray(len(self.neighbours))
+        for cell in body:
+            blocked[cell] = 1
+        tail = body[0]
+        blocked[tail] = 0
+        return self.bfs(blocked, body[-1], tail)[tail] != UNREACHABLE
+
+    def chase_tail(self, state, head_cell):
+        """
+        Function to pick the free neighbour of the head that is furthest from the tail while the tail
+        is still reachable from it, which leaves the most room behind. Returns (cell, direction), which
+        is (None, None) if every neighbour is blocked
+        Parameters:
+            state (GameState): The current game state
+            head_cell (int): The cell of the head
+        """
+        blocked = self.blocked_cells(state)
+        tail = state.body.tail()
+        distances = self.bfs(blocked, tail.y * state.columns + tail.x)
+        best = (None, None)
+        best_distance = None
+        for cell, direction in self.neighbours[head_cell]:
+            if blocked[cell]:
+                continue
+            distance = distances[cell]
+            if best_distance is None or distance > best_distance:
+                best = (cell, direction)
+                best_distance = distance
+        return best
+
+    def safe_direction(self, state):
+        """
+        Function to pick a direction on boards too large to plan on, moving towards the apple
+        while avoiding the cells that would end the game on the next tick
+        Parameters:
+            state (GameState): The current game state
+        """
+        head = state.body.head()
+        grid = state.grid
+        tail = state.body.tail()
+        tail_moves = len(state.body) >= state.snake_length
+        best = None
+        best_distance = None
+        for direction in (UP, LEFT, DOWN, RIGHT):
+            dx, dy = DIRECTION_STEPS[direction]
+            x = head.x + dx
+            y = head.y + dy
+            if not grid.in_bounds(x, y):
+                if state.boundaries:
+                    continue
+                x %= state.columns
+                y %= state.rows
+            if grid.is_occupied(grid.cell(x, y)) and not (tail_moves and (x, y) == (tail.x, tail.y)):
+                continue
+            distance = abs(state.apple_x - x) + abs(state.apple_y - y)
+            if best_distance is None or distance < best_distance:
+                best = direction
+                best_distance = distance
+        return best
@@ -0,0 +1,249 @@
+"""
+Vectorized batch environment to play many independent games of snake in lockstep.
+The rules are the same as engine.GameState, but the state of every game is stored in NumPy arrays
+and a single call to step() advances all games at once. Intended for evaluating AI controllers
+on large amounts of seeded games, not for the pygame frontend.
+Usage:
+env = BatchSnakeEnv(10000, seed=42)
+actions = np.full(env.num_games, -1)
+rewards, dones = env.step(actions)
+"""
+
+try:
+    import numpy as np
+except ModuleNotFoundError as e:
+    print(f"{e}: The numpy module could not be found")
+from engine import UP, LEFT, DOWN, RIGHT
+
+# Actions are indices into ACTIONS, -1 keeps the current direction
+# The opposite of action a is (a + 2) % 4
+ACTIONS = (UP, LEFT, DOWN, RIGHT)
+NO_ACTION = -1
+# Change in x and y for each action
+ACTION_DX = (0, -1, 0, 1)
+ACTION_DY = (-1, 0, 1, 0)
+
+# Death causes, matching engine.GameState.death_cause
+ALIVE = 0
+DEATH_WALL = 1
+DEATH_SELF = 2
+DEATH_FULL = 3
+DEATH_CAUSES = (None, "wall", "self", "full")
+
+# Random candidate cells to try for a new apple before falling back to scanning the board
+SPAWN_ATTEMPTS = 8
+
+
+def splitmix64(x):
+    """
+    Function to hash an array of uint64 values with the splitmix64 finalizer.
+    Used as a counter-based random number generator, so apple spawns of a game only
+    depend on its seed and not on the other games in the batch
+    Parameters:
+        x (ndarray): An array of uint64 values
+    """
+    z = x + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+class BatchSnakeEnv():
+    """
+    Advances num_games independent games of snake in lockstep.
+    Every game has a ring buffer holding the cells of its body, an occupancy map of the board
+    and an apple. Games that end are reset automatically on the same step, the final score,
+    length and death cause of the finished game are stored in the final_* arrays.
+    Every game gets a unique game id, and its apples are derived from (seed, game id),
+    so the n-th game of an env with a given seed always gets the same apples.
+    Usage:
+    env = BatchSnakeEnv(1000, boundaries=False, seed=0)
+    rewards, dones = env.step(np.random.randint(-1, 4, env.num_games))
+    finished_scores = env.final_scores[dones]
+    """
+    def __init__(self, num_games, columns=40, rows=30, boundaries=True, seed=0):
+        """
+        Parameters:
+            num_games (int): The amount of games to run in parallel
+            columns (int): The width of the board in cells
+            rows (int): The height of the board in cells
+            boundaries (bool): If True, running into the edges is game over. If False, the snake wraps around
+            seed (int): The seed from which the apple locations of all games are derived
+        """
+        self.num_games = num_games
+        self.columns = columns
+        self.rows = rows
+        self.cells = columns * rows
+        self.boundaries = boundaries
+        self.seed = np.uint64(seed)
+        cell_dtype = np.int16 if self.cells < 2**15 else np.int32
+        self.action_dx = np.array(ACTION_DX, dtype=np.int64)
+        self.action_dy = np.array(ACTION_DY, dtype=np.int64)
+        self.games = np.arange(num_games)
+
+        # The body of every game is a ring buffer of cells, bodies[g, head_ptr[g]] is the head
+        # and the tail is lengths[g] - 1 entries behind it
+        self.bodies = np.zeros((num_games, self.cells), dtype=cell_dtype)
+        self.head_ptr = np.zeros(num_games, dtype=np.int64)
+        self.lengths = np.zeros(num_games, dtype=np.int64) # current amount of segments
+        self.snake_lengths = np.zeros(num_games, dtype=np.int64) # max allowed length of the snake
+        # Amount of segments on every cell, usually 0 or 1 but the head can overlap the body on death
+        self.occupancy = np.zeros((num_games, self.cells), dtype=np.uint8)
+        self.heads_x = np.zeros(num_games, dtype=np.int64)
+        self.heads_y = np.zeros(num_games, dtype=np.int64)
+        self.directions = np.zeros(num_games, dtype=np.int64) # index into ACTIONS
+        self.apples = np.zeros(num_games, dtype=np.int64) # cell of the apple
+        self.apple_counts = np.zeros(num_games, dtype=np.uint64) # amount of apples spawned this game
+        self.scores = np.zeros(num_games, dtype=np.int64)
+        self.ticks = np.zeros(num_games, dtype=np.int64)
+        self.game_ids = np.zeros(num_games, dtype=np.uint64)
+        self.next_game_id = 0
+        # Results of the last finished game in every slot, only meaningful where dones is True
+        self.final_scores = np.zeros(num_games, dtype=np.int64)
+        self.final_ticks = np.zeros(num_games, dtype=np.int64)
+        self.final_game_ids = np.zeros(num_games, dtype=np.uint64)
+        self.death_causes = np.zeros(num_games, dtype=np.int8)
+        self.reset()
+
+    def reset(self, games=None):
+        """
+        Function to start a new game in the given slots, or in all slots if games is None
+        Parameters:
+            games (ndarray): The indices of the games to reset. Defaults to None
+        """
+        if games is None:
+            games = self.games
+        count = len(games)
+        if not count:
+            return
+        self.game_ids[games] = np.arange(self.next_game_id, self.next_game_id + count, dtype=np.uint64)
+        self.next_game_id += count
+        self.occupancy[games] = 0
+        # initialize snake as size 2 in the center of the board and moving downwards
+        head_x = self.columns // 2
+        head_y = self.rows // 2
+        head_cell = head_y * self.columns + head_x
+        self.bodies[games, 0] = head_cell - self.columns
+        self.bodies[games, 1] = head_cell
+        self.occupancy[games, head_cell - self.columns] = 1
+        self.occupancy[games, head_cell] = 1
+        self.head_ptr[games] = 1
+        self.lengths[games] = 2
+        self.snake_lengths[games] = 2
+        self.heads_x[games] = head_x
+        self.heads_y[games] = head_y
+        self.directions[games] = ACTIONS.index(DOWN)
+        self.apple_counts[games] = 0
+        self.scores[games] = 0
+        self.ticks[games] = 0
+        self.spawn_apples(games)
+
+    def random(self, games, attempt):
+        """
+        Function to return a random uint64 for each of the given games,
+        derived from the seed, the game id, the amount of spawned apples and the attempt
+        Parameters:
+            games (ndarray): The indices of the games
+            attempt (int): The attempt at placing the current apple
+        """
+        key = splitmix64(self.game_ids[games] ^ self.seed)
+        key = key + self.apple_counts[games] * np.uint64(SPAWN_ATTEMPTS + 1) + np.uint64(attempt)
+        return splitmix64(key)
+
+    def spawn_apples(self, games):
+        """
+        Function to place a new apple on a free cell for each of the given games.
+        Returns the indices of the games that have no free cell left, which ends them
+        Parameters:
+            games (ndarray): The indices of the games that need a new apple
+        """
+        pending = games
+        for attempt in range(SPAWN_ATTEMPTS):
+            cells = (self.random(pending, attempt) % np.uint64(self.cells)).astype(np.int64)
+            free = self.occupancy[pending, cells] == 0
+            self.apples[pending[free]] = cells[free]
+            pending = pending[~free]
+            if not pending.size:
+                break
+        # The board is nearly full for the remaining games, pick directly from their free cells
+        full = []
+        if pending.size:
+            rand = self.random(pending, SPAWN_ATTEMPTS)
+            for game, value in zip(pending, rand):
+                free_cells = np.flatnonzero(self.occupancy[game] == 0)
+                if free_cells.size:
+                    self.apples[game] = free_cells[int(value % np.uint64(free_cells.size))]
+                else:
+                    full.append(game)
+        self.apple_counts[games] += np.uint64(1)
+        return np.array(full, dtype=np.int64)
+
+    def step(self, actions):
+        """
+        Function to advance every game by a single tick. Finished games are reset automatically.
+        Returns a tuple of (rewards, dones). The reward of a game is 1 when it ate an apple,
+        -1 when it died and 0 otherwise. Filling the board with the last apple is a win, which keeps the reward
+        of that apple. dones is True for every game that ended this step
+        Parameters:
+            actions (ndarray): An action for every game, an index into ACTIONS or -1 to keep going straight
+        """
+        actions = np.asarray(actions, dtype=np.int64)
+        games = self.games
+        columns = self.columns
+        cells = self.cells
+
+        # Change direction, unless there is no action or the snake would reverse into itself
+        turn = (actions >= 0) & (actions != (self.directions + 2) % 4)
+        self.directions = np.where(turn, actions, self.directions)
+        x = self.heads_x + self.action_dx[self.directions]
+        y = self.heads_y + self.action_dy[self.directions]
+
+        # If the head is outside the board, either game over or wrap around to the other side
+        death_causes = np.zeros(self.num_games, dtype=np.int8)
+        outside = (x < 0) | (x >= columns) | (y < 0) | (y >= self.rows)
+        if self.boundaries:
+            death_causes[outside] = DEATH_WALL
+        else:
+            x %= columns
+            y %= self.rows
+        moving = ~outside if self.boundaries else np.ones(self.num_games, dtype=bool)
+        x = np.where(moving, x, self.heads_x)
+        y = np.where(moving, y, self.heads_y)
+        head_cells = y * columns + x
+
+        # Pop the tail of every snake at max length, then push the new head
+        pop = moving & (self.lengths >= self.snake_lengths)
+        popping = games[pop]
+        tail_ptr = (self.head_ptr[popping] - self.lengths[popping] + 1) % cells
+        self.occupancy[popping, self.bodies[popping, tail_ptr]] -= 1
+        self.lengths[popping] -= 1
+        movers = games[moving]
+        self.head_ptr[movers] = (self.head_ptr[movers] + 1) % cells
+        self.bodies[movers, self.head_ptr[movers]] = head_cells[movers]
+        self.lengths[movers] += 1
+        self.heads_x = x
+        self.heads_y = y
+        self.ticks += 1
+
+        # If the head overlaps with any other segment of the snake, game over
+        collided = self.occupancy[movers, head_cells[movers]] != 0
+        death_causes[movers[collided]] = DEATH_SELF
+        self.occupancy[movers, head_cells[movers]] += 1
+
+        ate = (death_causes == ALIVE) & (head_cells == self.apples)
+        eaters = games[ate]
+        self.snake_lengths[eaters] += 1
+        self.scores[eaters] += 1
+        full = self.spawn_apples(eaters)
+        death_causes[full] = DEATH_FULL
+
+        dones = death_causes != ALIVE
+        rewards = ate.astype(np.float32) - (dones & (death_causes != DEATH_FULL))
+        finished = games[dones]
+        if finished.size:
+            self.final_scores[finished] = self.scores[finished]
+            self.final_ticks[finished] = self.ticks[finished]
+            self.final_game_ids[finished] = self.game_ids[finished]
+            self.death_causes[finished] = death_causes[finished]
+            self.reset(finished)
+        return rewards, dones
@@ -0,0 +1,885 @@
+"""
+Benchmarks for the hot paths of DangerNoodle: the game rules, multiplayer, spawning apples, the autopilot,
+drawing, text rendering, saving highscores and settings and saving games. Uses the SDL dummy video driver, so no window is opened and it
+can be run headless. All random input is seeded, so every run does the same work, and every benchmark
+is run several times keeping the best result.
+The results can be written to a JSON file, and compared to the JSON file of an earlier run,
+which lists every metric that got worse by more than the tolerance and exits with status 1 if any did.
+Usage:
+python benchmark.py --json baseline.json
+python benchmark.py --baseline baseline.json --tolerance 0.25 --repeat 5
+"""
+
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+import argparse
+import json
+from math import sqrt
+import platform
+from random import Random
+import sys
+import tempfile
+from time import perf_counter, perf_counter_ns
+
+import numpy as np
+import pygame as pg
+
+from autopilot import PathfindingController, hamiltonian_cycle
+import dangernoodle
+from batch_env import BatchSnakeEnv
+from codec import MirrorState, StateEncoder
+from engine import (GameState, OccupancyGrid, SnakeBody, UP, LEFT, DOWN, RIGHT, DIRECTION_STEPS, DENSE_GRID_MAX_CELLS,
+                    make_grid)
+from leaderboard import Leaderboard
+from multiplayer import MultiGameState, greedy_bot
+from replay import ReplayRecorder
+from savegame import load_game, save_game
+from server import KEYFRAME_INTERVAL
+from storage import SaveStore
+
+# Direction of every step between two cells, the reverse of DIRECTION_STEPS
+STEP_DIRECTIONS = {step: direction for direction, step in DIRECTION_STEPS.items()}
+# Metrics in these units are better when higher, all other units are durations
+RATE_UNITS = ("ticks/sec", "calls/sec")
+
+
+def make_snake_body(length, columns=40, rows=30, first_row=0):
+    """
+    Function to build a SnakeBody of a given length that zigzags across the board,
+    so the draw functions have to handle straight body segments as well as turns
+    Parameters:
+        length (int): The amount of segments in the snake
+        columns (int): The width of the board in cells
+        rows (int): The height of the board in cells
+        first_row (int): The row the tail starts in. Defaults to 0
+    """
+    snake_body = SnakeBody()
+    for idx in range(length):
+        row, col = divmod(idx, columns)
+        if row % 2:
+            col = columns - 1 - col
+            rotation = 90 # moving left
+        else:
+            rotation = 270 # moving right
+        # Rows are wrapped around vertically, the benchmark only cares about blitting cost
+        snake_body.push_head(col, (row + first_row) % rows, rotation)
+    return snake_body
+
+
+def rotate(img, degrees):
+    """
+    Function to rotate an image a given amount of degrees anti-clockwise, the way the game rotated
+    every sprite before the sprite atlas was introduced
+    Parameters:
+        img (image): The image to rotate
+        degrees (int): The amount of degrees to rotate the image
+    """
+    return pg.transform.rotate(img, degrees)
+
+
+def draw_snake_rotating(game):
+    """
+    Reference implementation of draw_snake() that rotates every segment on every frame,
+    the way it was done before the sprite atlas was introduced. The unrotated sprites come from the atlas
+    Parameters:
+        game (Snake): The game whose snake should be drawn
+    """
+    block_size = game.block_size
+    segments = list(game.state.body)
+    for idx, segment in enumerate(segments[:-1]):
+        next_rotation = segments[idx+1].rotation
+        if idx == 0:
+            body = rotate(game.sprites["tail"][UP], next_rotation)
+        elif segment.rotation != next_rotation:
+            body = rotate(game.sprites["turn"][UP], next_rotation)
+        else:
+            body = rotate(game.sprites["body"][UP], next_rotation)
+        game.program_surface.blit(body, (segment.x * block_size, segment.y * block_size))
+    head = segments[-1]
+    game.program_surface.blit(rotate(game.sprites["head"][UP], head.rotation), (head.x * block_size, head.y * block_size))
+
+
+def draw_snake_scanning(game):
+    """
+    Reference implementation of draw_snake() that walks the whole body and skips the segments out of view,
+    the way it was done before the segments were bucketed in chunks
+    Parameters:
+        game (Snake): The game whose snake should be drawn
+    """
+    segments = game.state.body.segments
+    blit = game.program_surface.blit
+    block_size = game.block_size
+    left, top, right, bottom = game.visible_cells()
+    body = iter(segments)
+    next(body)
+    segment = next(body)
+    for _ in range(len(segments) - 3):
+        next_segment = next(body)
+        if left <= segment.x < right and top <= segment.y < bottom:
+            blit(game.segment_sprite(segment, next_segment.rotation),
+                 (segment.x * block_size - game.camera.x, segment.y * block_size - game.camera.y))
+        segment = next_segment
+    game.draw_snake_ends()
+
+
+def time_frames(draw, frames):
+    """
+    Function to call a draw function a number of times and return the mean frame time in ms
+    Parameters:
+        draw (callable): The function drawing a single frame
+        frames (int): The amount of frames to draw
+    """
+    start = perf_counter()
+    for _ in range(frames):
+        draw()
+    return (perf_counter() - start) / frames * 1000
+
+
+def bench_sprite_atlas(game, lengths=(10, 100, 1000, 10000), frames=50):
+    """
+    Benchmark the frame time of drawing the snake against snake length,
+    with and without the pre-rotated sprite atlas
+    Parameters:
+        game (Snake): A fully initialized game
+        lengths (tuple): The snake lengths to benchmark
+        frames (int): The amount of frames to draw per length
+    """
+    print("draw_snake frame time (ms) vs snake length")
+    print(f"{'length':>8} {'rotating':>10} {'atlas':>10} {'speedup':>8}")
+    results = []
+    for length in lengths:
+        game.state.body = make_snake_body(length)
+        game.rebuild_chunks()
+        rotating = time_frames(lambda: draw_snake_rotating(game), frames)
+        atlas = time_frames(game.draw_snake, frames)
+        results.append((length, rotating, atlas))
+        print(f"{length:>8} {rotating:>10.3f} {atlas:>10.3f} {rotating/atlas:>7.1f}x")
+    game.reset_game_variables()
+    return results
+
+
+def bench_dirty_rects(game, lengths=(10, 100, 1000), frames=100):
+    """
+    Benchmark the in-game frame time, including the display update, against snake length
+    for a full redraw and for a dirty rect redraw of only the changed cells
+    Parameters:
+        game (Snake): A fully initialized game
+        lengths (tuple): The snake lengths to benchmark
+        frames (int): The amount of frames to draw per length
+    """
+    print("in-game frame time (ms) vs snake length")
+    print(f"{'length':>8} {'full':>10} {'dirty':>10}")
+    results = []
+    game.draw_in_game_screen()
+    for length in lengths:
+        # Keep the snake away from the score in the top left corner, which would force a full redraw
+        game.state.body = make_snake_body(length, first_row=2)
+        grid = OccupancyGrid(game.state.columns, game.state.rows)
+        for segment in game.state.body:
+            grid.occupy(grid.cell(segment.x, segment.y))
+        game.state.grid = grid
+        game.rebuild_chunks()
+        full = time_frames(lambda: (game.draw_in_game_screen(), dangernoodle.pg.display.update()), frames)
+        old_cells = game.changing_cells()
+        dirty = time_frames(lambda: dangernoodle.pg.display.update(
+            game.draw_in_game_changes(old_cells, game.state.score)), frames)
+        results.append((length, full, dirty))
+        print(f"{length:>8} {full:>10.3f} {dirty:>10.3f}")
+    game.reset_game_variables()
+    return results
+
+
+def bench_viewport(game, lengths=(1000, 10000, 100000), columns=1000, rows=1000, frames=50):
+    """
+    Benchmark the frame time of drawing the snake on a large board, where only a small part of the snake
+    is in view. Compares walking the whole body, drawing only the chunks in view, and drawing from the
+    scrolled body layer of the following camera, moving the camera a few pixels every frame
+    Parameters:
+        game (Snake): A fully initialized game
+        lengths (tuple): The snake lengths to benchmark
+        columns (int): The width of the board in cells
+        rows (int): The height of the board in cells
+        frames (int): The amount of frames to draw per length
+    """
+    print(f"draw_snake frame time (ms) vs snake length on a {columns}x{rows} board")
+    print(f"{'length':>8} {'scanning':>10} {'chunks':>10} {'following':>10}")
+    results = []
+    for length in lengths:
+        game.state = GameState(columns, rows, True, Random(0))
+        game.state.body = make_snake_body(length, columns, rows, first_row=rows // 2)
+        game.rebuild_chunks()
+        game.update_camera(recenter=True)
+        scanning = time_frames(lambda: draw_snake_scanning(game), frames)
+        chunks = time_frames(game.draw_snake, frames)
+        game.draw_following_frame()
+        steps = iter(range(frames))
+        def follow():
+            # Scroll back and forth, so the camera stays on the snake
+            game.camera.x += 4 if next(steps) % 20 < 10 else -4
+            game.draw_following_frame()
+        following = time_frames(follow, frames)
+        results.append((length, scanning, chunks, following))
+        print(f"{length:>8} {scanning:>10.3f} {chunks:>10.3f} {following:>10.3f}")
+    game.reset_game_variables()
+    return results
+
+
+def bench_text_cache(game, frames=200):
+    """
+    Benchmark the time to draw the help menu, with a cold text cache (cleared every frame)
+    and with a warm text cache, and show the hit/miss counters.
+    The cached static layer of the menu is dropped before every frame in both cases,
+    otherwise the menu is only blitted from it and no text is drawn at all
+    Parameters:
+        game (Snake): A fully initialized game
+        frames (int): The amount of frames to draw
+    """
+    text_cache = game.text_cache
+    def cold():
+        text_cache.clear()
+        game.invalidate_menu_background("help")
+        game.draw_help_menu()
+    def warm():
+        game.invalidate_menu_background("help")
+        game.draw_help_menu()
+    text_cache.hits = text_cache.misses = 0
+    cold_time = time_frames(cold, frames)
+    cold_misses = text_cache.misses
+    assert cold_misses > 0, "the cold help menu did not render any text"
+    text_cache.hits = text_cache.misses = 0
+    warm_time = time_frames(warm, frames)
+    print(f"draw_help_menu: {cold_time:.3f} ms uncached ({cold_misses} misses), {warm_time:.3f} ms cached "
+          f"({text_cache.hits} hits, {text_cache.misses} misses)")
+    return cold_time, warm_time
+
+
+def list_ticks(length, columns, ticks):
+    """
+    Function to advance a snake stored as a list of [x, y, rotation] lists a number of ticks,
+    the way game_loop() did before the deque body and occupancy grid were introduced.
+    The snake moves along the rows of the board, so it never collides with itself
+    Parameters:
+        length (int): The length of the snake
+        columns (int): The width of the board in cells
+        ticks (int): The amount of ticks to advance
+    """
+    snake_list = [[idx % columns, idx // columns, 270] for idx in range(length)]
+    position = length
+    for _ in range(ticks):
+        snake_head = [position % columns, position // columns, 270]
+        snake_list.append(snake_head)
+        del snake_list[0]
+        for segment in snake_list[:-1]:
+            if segment[:2] == snake_head[:2]:
+                raise RuntimeError("snake collided with itself")
+        position += 1
+
+
+def body_ticks(length, columns, ticks):
+    """
+    Function to advance a snake stored as a SnakeBody with an OccupancyGrid a number of ticks,
+    the way game_loop() does it. The snake moves along the rows of the board, so it never collides with itself
+    Parameters:
+        length (int): The length of the snake
+        columns (int): The width of the board in cells
+        ticks (int): The amount of ticks to advance
+    """
+    rows = (length + ticks) // columns + 1
+    grid = OccupancyGrid(columns, rows)
+    snake_body = SnakeBody()
+    for idx in range(length):
+        snake_body.push_head(idx % columns, idx // columns, 270)
+        grid.occupy(idx)
+    position = length
+    for _ in range(ticks):
+        old_tail = snake_body.pop_tail()
+        grid.release(grid.cell(old_tail.x, old_tail.y))
+        snake_head = snake_body.push_head(position % columns, position // columns, 270, old_tail)
+        head_cell = grid.cell(snake_head.x, snake_head.y)
+        if grid.is_occupied(head_cell):
+            raise RuntimeError("snake collided with itself")
+        grid.occupy(head_cell)
+        position += 1
+
+
+def bench_snake_body(lengths=(10, 1000, 100000), columns=400):
+    """
+    Benchmark the amount of game ticks per second against snake length, for the old
+    list based body and the deque based body with occupancy grid
+    Parameters:
+        lengths (tuple): The snake lengths to benchmark
+        columns (int): The width of the board in cells
+    """
+    print("ticks/sec vs snake length")
+    print(f"{'length':>8} {'list':>12} {'deque+grid':>12}")
+    results = []
+    for length in lengths:
+        # The list based body is O(n) per tick, so use fewer ticks for long snakes
+        ticks = max(20, 1000000 // length)
+        start = perf_counter()
+        list_ticks(length, columns, ticks)
+        list_rate = ticks / (perf_counter() - start)
+        ticks = 100000
+        start = perf_counter()
+        body_ticks(length, columns, ticks)
+        body_rate = ticks / (perf_counter() - start)
+        results.append((length, list_rate, body_rate))
+        print(f"{length:>8} {list_rate:>12.0f} {body_rate:>12.0f}")
+    return results
+
+
+def play_headless(state, ticks):
+    """
+    Function to play a headless game for a number of ticks, restarting it on game over.
+    The snake follows a fixed pseudo-random list of directions, so every run does the same work
+    Parameters:
+        state (GameState): The game state to advance
+        ticks (int): The amount of ticks to advance
+    """
+    rng = Random(0)
+    directions = [rng.choice((UP, LEFT, DOWN, RIGHT, None, None, None, None)) for _ in range(4096)]
+    step = state.step
+    games = 0
+    for tick in range(ticks):
+        if not step(directions[tick & 4095]):
+            state.reset()
+            games += 1
+    return games
+
+
+def bench_game_state(ticks=1000000):
+    """
+    Benchmark the amount of headless ticks per second of the game rules in GameState.step()
+    Parameters:
+        ticks (int): The amount of ticks to advance
+    """
+    results = []
+    for boundaries in (True, False):
+        state = GameState(40, 30, boundaries)
+        start = perf_counter()
+        games = play_headless(state, ticks)
+        rate = ticks / (perf_counter() - start)
+        results.append((boundaries, rate, games))
+        print(f"GameState.step (boundaries={boundaries}): {rate:.0f} ticks/sec over {games} games")
+    return results
+
+
+def pairwise_collisions(state):
+    """
+    Function to find the snakes of a multiplayer game whose next head hits a body, by comparing the next
+    head of every snake with every segment of every snake, the way a single snake_list per snake would.
+    Used as the baseline for the shared occupancy grid of MultiGameState
+    Parameters:
+        state (MultiGameState): The current game state
+    """
+    hits = []
+    for snake in state.alive:
+        dx, dy = DIRECTION_STEPS[snake.direction]
+        head = snake.body.head()
+        x = head.x + dx
+        y = head.y + dy
+        for other in state.alive:
+            for segment in other.body:
+                if segment.x == x and segment.y == y:
+                    hits.append(snake)
+    return hits
+
+
+def bench_multiplayer(snake_counts=(2, 16, 256), cells_per_snake=600, snake_ticks=200000):
+    """
+    Benchmark MultiGameState.step() against the amount of snakes, all played by greedy bots.
+    The board grows with the amount of snakes, so every snake has the same room. Games are restarted
+    when they end. The time of the bots is not counted. For comparison, the time to find the collisions
+    of a tick by scanning the bodies of all snakes is measured on every tenth tick
+    Parameters:
+        snake_counts (tuple): The amounts of snakes to benchmark
+        cells_per_snake (int): The amount of cells of the board per snake
+        snake_ticks (int): The amount of snake moves to play per amount of snakes
+    """
+    print("MultiGameState.step time (us) vs amount of snakes")
+    print(f"{'snakes':>8} {'board':>10} {'per tick':>10} {'per snake':>10} {'pairwise':>10}")
+    results = []
+    for num_snakes in snake_counts:
+        rows = max(2, round(sqrt(num_snakes * cells_per_snake * 3 / 4)))
+        columns = num_snakes * cells_per_snake // rows
+        state = MultiGameState(columns, rows, num_snakes, rng=Random(0))
+        step_time = 0
+        moves = 0
+        pairwise_time = 0
+        pairwise_ticks = 0
+        for tick in range(snake_ticks // num_snakes):
+            directions = [greedy_bot(state, snake) for snake in state.snakes]
+            if tick % 10 == 0:
+                start = perf_counter()
+                pairwise_collisions(state)
+                pairwise_time += perf_counter() - start
+                pairwise_ticks += 1
+            moves += len(state.alive)
+            start = perf_counter()
+            alive = state.step(directions)
+            step_time += perf_counter() - start
+            if not alive:
+                state.reset()
+        per_tick = step_time / (snake_ticks // num_snakes) * 1000000
+        per_snake = step_time / moves * 1000000
+        pairwise = pairwise_time / pairwise_ticks * 1000000
+        results.append((num_snakes, per_tick, per_snake, pairwise))
+        print(f"{num_snakes:>8} {f'{columns}x{rows}':>10} {per_tick:>10.1f} {per_snake:>10.2f} {pairwise:>10.1f}")
+    return results
+
+
+def make_cycle_game(length, columns, rows):
+    """
+    Function to create a multiplayer game with a single snake laid along the Hamiltonian cycle of the board,
+    so it can follow the cycle for as long as needed. Returns the game and the cycle
+    Parameters:
+        length (int): The length of the snake, less than the amount of cells of the board
+        columns (int): The width of the board in cells, one side has to be even
+        rows (int): The height of the board in cells
+    """
+    cycle = hamiltonian_cycle(columns, rows)
+    state = MultiGameState(columns, rows, 1, rng=Random(0))
+    snake = state.snakes[0]
+    for segment in snake.body:
+        state.release(segment.y * columns + segment.x)
+    snake.body = SnakeBody()
+    for index in range(length):
+        x, y = cycle[index]
+        previous_x, previous_y = cycle[index - 1]
+        snake.direction = STEP_DIRECTIONS[(x - previous_x, y - previous_y)]
+        snake.body.push_head(x, y, snake.direction)
+        state.occupy(y * columns + x, 0)
+    snake.snake_length = length
+    state.apple_slots = {}
+    state.spawn_apple(0)
+    return state, cycle
+
+
+def bench_codec(length=1000, columns=40, rows=30, ticks=2000):
+    """
+    Benchmark the size and the encode and decode times of the frames streamed to spectators,
+    for a single long snake following the Hamiltonian cycle of the board. The bytes per tick of the stream,
+    a delta every tick and a snapshot every KEYFRAME_INTERVAL ticks, are compared to a snapshot every tick
+    Parameters:
+        length (int): The length of the snake
+        columns (int): The width of the board in cells
+        rows (int): The height of the board in cells
+        ticks (int): The amount of ticks to encode
+    """
+    state, cycle = make_cycle_game(length, columns, rows)
+    encoder = StateEncoder()
+    mirror = MirrorState()
+    mirror.apply(bytes(encoder.welcome(state, -1, 15)[4:]))
+    snapshot = bytes(encoder.snapshot(state))
+    start = perf_counter()
+    for _ in range(100):
+        encoder.snapshot(state)
+    snapshot_encode = (perf_counter() - start) / 100 * 1000000
+    start = perf_counter()
+    for _ in range(100):
+        mirror.apply(snapshot[4:])
+    snapshot_decode = (perf_counter() - start) / 100 * 1000000
+    deltas = []
+    encode_time = 0
+    position = length - 1
+    for _ in range(ticks):
+        position = (position + 1) % len(cycle)
+        x, y = cycle[position]
+        head = state.snakes[0].body.head()
+        lengths = [len(state.snakes[0].body)]
+        state.step([STEP_DIRECTIONS[(x - head.x, y - head.y)]])
+        start = perf_counter()
+        delta = encoder.delta(state, lengths)
+        encode_time += perf_counter() - start
+        deltas.append(bytes(delta[4:]))
+        if state.game_over:
+            break
+    start = perf_counter()
+    for delta in deltas:
+        mirror.apply(delta)
+    decode_time = perf_counter() - start
+    delta_bytes = sum(len(delta) + 4 for delta in deltas) / len(deltas)
+    stream_bytes = delta_bytes + len(snapshot) / KEYFRAME_INTERVAL
+    results = {
+        "delta/bytes": (delta_bytes, "bytes"),
+        "delta/encode": (encode_time / len(deltas) * 1000000, "us"),
+        "delta/decode": (decode_time / len(deltas) * 1000000, "us"),
+        "snapshot/bytes": (len(snapshot), "bytes"),
+        "snapshot/encode": (snapshot_encode, "us"),
+        "snapshot/decode": (snapshot_decode, "us"),
+        "stream/bytes": (stream_bytes, "bytes"),
+    }
+    print(f"Codec, snake of length {length} on {columns}x{rows}:")
+    print(f"  delta {delta_bytes:.1f} bytes, encode {results['delta/encode'][0]:.2f} us, "
+          f"decode {results['delta/decode'][0]:.2f} us per tick")
+    print(f"  snapshot {len(snapshot)} bytes, encode {snapshot_encode:.1f} us, decode {snapshot_decode:.1f} us")
+    print(f"  stream with a keyframe every {KEYFRAME_INTERVAL} ticks {stream_bytes:.1f} bytes per tick, "
+          f"{len(snapshot) / stream_bytes:.0f}x less than a snapshot every tick")
+    return results
+
+
+def bench_spawn_apple(fills=(0.0, 0.5, 0.9, 0.99), boards=((40, 30), (2000, 1000)), spawns=20000):
+    """
+    Benchmark the latency of GameState.spawn_apple() against the fraction of the board covered by the snake,
+    on a board with a dense grid and on a board large enough to get a sparse bitset grid
+    Parameters:
+        fills (tuple): The fractions of occupied cells to benchmark
+        boards (tuple): The (columns, rows) of the boards to benchmark
+        spawns (int): The amount of apples to spawn per fill. A nearly full sparse board is scanned
+            on almost every spawn, so that spawns a thousand times fewer
+    """
+    print("spawn_apple latency (us) vs fill ratio")
+    print(f"{'board':>10} " + " ".join(f"{fill:>8.0%}" for fill in fills))
+    results = []
+    for columns, rows in boards:
+        size = columns * rows
+        latencies = []
+        for fill in fills:
+            count = spawns // 1000 if size > DENSE_GRID_MAX_CELLS and fill >= 0.99 else spawns
+            state = GameState(columns, rows, True, Random(0))
+            state.grid = make_grid(columns, rows)
+            for cell in Random(1).sample(range(size), int(size * fill)):
+                state.grid.occupy(cell)
+            latency = time_calls(lambda _: state.spawn_apple(), range(count))
+            latencies.append(latency)
+            results.append((f"{columns}x{rows}", fill, latency))
+        print(f"{f'{columns}x{rows}':>10} " + " ".join(f"{latency:>8.2f}" for latency in latencies))
+    return results
+
+
+def bench_text_objects(game, calls=20000):
+    """
+    Benchmark the throughput of text_objects() for text that is in the text cache,
+    and for text that is different on every call and has to be rendered
+    Parameters:
+        game (Snake): A fully initialized game
+        calls (int): The amount of calls per kind of text
+    """
+    color = game.text_color_normal
+    game.text_cache.clear()
+    start = perf_counter()
+    for _ in range(calls):
+        game.text_objects("Highscores", color, "small")
+    cached = calls / (perf_counter() - start)
+    # Far fewer calls, every one renders with the font
+    rendered_calls = calls // 10
+    start = perf_counter()
+    for idx in range(rendered_calls):
+        game.text_objects(f"Score: {idx}", color, "small")
+    rendered = rendered_calls / (perf_counter() - start)
+    game.text_cache.clear()
+    print(f"text_objects: {cached:.0f} calls/sec cached, {rendered:.0f} calls/sec rendered")
+    return cached, rendered
+
+
+def bench_save_store(changes=1000):
+    """
+    Benchmark saving and loading the settings: the time to queue a change, the time until a change
+    is synced to disk, and the time to load the snapshot and the log
+    Parameters:
+        changes (int): The amount of settings changes to make
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        log_path = os.path.join(directory, "save.log")
+        snapshot_path = os.path.join(directory, "save.json")
+        store = SaveStore(log_path, snapshot_path)
+        flags = [bool(idx & 1) for idx in range(changes)]
+        queue_time = time_calls(lambda flag: store.set_settings(dark_mode=flag), flags)
+        start = perf_counter()
+        store.close()
+        # Every record is synced to disk, so this is the time per record until it is safely stored
+        write_time = (perf_counter() - start) / changes * 1000000 + queue_time
+        # The log holds the changes since the last compaction on top of the snapshot
+        start = perf_counter()
+        store = SaveStore(log_path, snapshot_path)
+        load_time = (perf_counter() - start) * 1000
+        store.close()
+    print(f"SaveStore: queue a change {queue_time:.1f} us, write a change {write_time:.1f} us, "
+          f"load {load_time:.2f} ms")
+    return queue_time, write_time, load_time
+
+
+def bench_save_game(lengths=(1000, 100000, 1000000), columns=1000, rows=1000):
+    """
+    Benchmark saving a game in progress and resuming it, against the length of the snake
+    Parameters:
+        lengths (tuple): The lengths of the snake to benchmark
+        columns (int): The width of the board in cells
+        rows (int): The height of the board in cells
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "savegame.dns")
+        for length in lengths:
+            state = GameState(columns, rows, False, Random(0))
+            for segment in state.body:
+                state.grid.release(state.grid.cell(segment.x, segment.y))
+            state.body = make_snake_body(length, columns, rows)
+            for segment in state.body:
+                state.grid.occupy(state.grid.cell(segment.x, segment.y))
+            state.snake_length = length
+            recorder = ReplayRecorder(state, 0)
+            start = perf_counter()
+            save_game(path, state, recorder)
+            save_time = (perf_counter() - start) * 1000
+            start = perf_counter()
+            load_game(path)
+            load_time = (perf_counter() - start) * 1000
+            results.append((length, save_time, load_time))
+            print(f"Save game of length {length}: save {save_time:.1f} ms, resume {load_time:.1f} ms, "
+                  f"{os.path.getsize(path)} bytes")
+    return results
+
+
+def bench_autopilot(columns=40, rows=30, long_length=1000):
+    """
+    Benchmark the latency of a PathfindingController call over a whole game, which it plays until the board
+    is full. Percentiles are given over all ticks and over the ticks the snake is at least long_length long
+    Parameters:
+        columns (int): The width of the board in cells
+        rows (int): The height of the board in cells
+        long_length (int): The length from which the snake counts as long
+    """
+    controller = PathfindingController()
+    state = GameState(columns, rows, True, Random(0))
+    latencies = []
+    long_latencies = []
+    while True:
+        start = perf_counter_ns()
+        direction = controller(state)
+        latency = (perf_counter_ns() - start) / 1000
+        latencies.append(latency)
+        if len(state.body) >= long_length:
+            long_latencies.append(latency)
+        if not state.step(direction):
+            break
+    results = []
+    print(f"PathfindingController on {columns}x{rows}: score {state.score} in {state.ticks} ticks ({state.death_cause})")
+    for name, samples in (("all", latencies), (f"length>={long_length}", long_latencies)):
+        samples.sort()
+        if not samples:
+            continue
+        p50 = samples[len(samples) // 2]
+        p99 = samples[min(len(samples) - 1, len(samples) * 99 // 100)]
+        results.append((name, p50, p99))
+        print(f"  {name}: p50 {p50:.1f} us, p99 {p99:.1f} us, max {samples[-1]:.1f} us per tick")
+    return results
+
+
+def bench_batch_env(num_games=(1, 100, 10000), steps=200):
+    """
+    Benchmark the total amount of game ticks per second of BatchSnakeEnv for different batch sizes
+    Parameters:
+        num_games (tuple): The batch sizes to benchmark
+        steps (int): The amount of steps to take per batch size
+    """
+    results = []
+    for count in num_games:
+        env = BatchSnakeEnv(count, seed=0)
+        rng = np.random.default_rng(0)
+        actions = rng.integers(-1, 4, (steps, count))
+        finished = 0
+        start = perf_counter()
+        for step in range(steps):
+            finished += env.step(actions[step])[1].sum()
+        rate = count * steps / (perf_counter() - start)
+        results.append((count, rate))
+        print(f"BatchSnakeEnv ({count} games): {rate:.0f} ticks/sec, {finished} games finished")
+    return results
+
+
+def time_calls(call, args):
+    """
+    Function to call a function once for every argument and return the mean time per call in microseconds
+    Parameters:
+        call (callable): The function to time
+        args (list): The arguments, one per call
+    """
+    start = perf_counter()
+    for arg in args:
+        call(arg)
+    return (perf_counter() - start) / len(args) * 1000000
+
+
+def bench_leaderboard(scores=1000000, players=10000, queries=1000):
+    """
+    Benchmark the queries of a file backed leaderboard holding a large amount of scores
+    Parameters:
+        scores (int): The amount of scores to store
+        players (int): The amount of different player names
+        queries (int): The amount of queries to time per kind of query
+    """
+    rng = Random(0)
+    with tempfile.TemporaryDirectory() as directory:
+        leaderboard = Leaderboard(os.path.join(directory, "leaderboard.db"))
+        entries = [(f"player{rng.randrange(players)}", int(rng.expovariate(1 / 40))) for _ in range(scores)]
+        start = perf_counter()
+        leaderboard.add_scores(entries)
+        insert_time = perf_counter() - start
+        sample = [rng.randrange(200) for _ in range(queries)]
+        names = [f"player{rng.randrange(players)}" for _ in range(queries)]
+        results = {
+            "add_scores": insert_time / scores * 1000000,
+            "add_score": time_calls(lambda score: leaderboard.add_score("bench", score), sample),
+            "top(5)": time_calls(lambda _: leaderboard.top(5), sample),
+            "page 100": time_calls(lambda _: leaderboard.top(5, 500), sample),
+            "rank": time_calls(leaderboard.rank, sample),
+            "best": time_calls(leaderboard.best, names),
+            "history": time_calls(leaderboard.history, names),
+        }
+        leaderboard.close()
+        # Opening reads the score counts, take the fastest of a few opens
+        open_times = []
+        for _ in range(5):
+            start = perf_counter()
+            leaderboard = Leaderboard(os.path.join(directory, "leaderboard.db"))
+            open_times.append((perf_counter() - start) * 1000000)
+            leaderboard.close()
+        results["open"] = min(open_times)
+    print(f"Leaderboard with {scores} scores (us per call): "
+          + ", ".join(f"{name} {elapsed:.1f}" for name, elapsed in results.items()))
+    return results
+
+
+def run_benchmarks(game):
+    """
+    Function to run every benchmark and return a dictionary of metric name -> (value, unit)
+    Parameters:
+        game (Snake): A fully initialized game
+    """
+    metrics = {}
+    for length, rotating, atlas in bench_sprite_atlas(game):
+        metrics[f"draw_snake/rotating/{length}"] = (rotating, "ms")
+        metrics[f"draw_snake/atlas/{length}"] = (atlas, "ms")
+    for length, full, dirty in bench_dirty_rects(game):
+        metrics[f"draw_in_game_screen/{length}"] = (full, "ms")
+        metrics[f"draw_in_game_changes/{length}"] = (dirty, "ms")
+    for length, scanning, chunks, following in bench_viewport(game):
+        metrics[f"draw_snake/scanning/{length}"] = (scanning, "ms")
+        metrics[f"draw_snake/chunks/{length}"] = (chunks, "ms")
+        metrics[f"draw_following_frame/{length}"] = (following, "ms")
+    # Baselines from before the help menu benchmark drew any text hold no help_menu_text metrics, and are skipped
+    cold, warm = bench_text_cache(game)
+    metrics["help_menu_text/uncached"] = (cold, "ms")
+    metrics["help_menu_text/cached"] = (warm, "ms")
+    cached, rendered = bench_text_objects(game)
+    metrics["text_objects/cached"] = (cached, "calls/sec")
+    metrics["text_objects/rendered"] = (rendered, "calls/sec")
+    for length, list_rate, body_rate in bench_snake_body():
+        metrics[f"ticks/list/{length}"] = (list_rate, "ticks/sec")
+        metrics[f"ticks/deque/{length}"] = (body_rate, "ticks/sec")
+    for boundaries, rate, _ in bench_game_state():
+        metrics[f"GameState.step/boundaries={boundaries}"] = (rate, "ticks/sec")
+    for num_snakes, per_tick, per_snake, pairwise in bench_multiplayer():
+        metrics[f"multiplayer/{num_snakes}/tick"] = (per_tick, "us")
+        metrics[f"multiplayer/{num_snakes}/snake"] = (per_snake, "us")
+        metrics[f"multiplayer/{num_snakes}/pairwise"] = (pairwise, "us")
+    for name, metric in bench_codec().items():
+        metrics[f"codec/{name}"] = metric
+    for board, fill, latency in bench_spawn_apple():
+        metrics[f"spawn_apple/{board}/{fill:.0%}"] = (latency, "us")
+    for name, p50, p99 in bench_autopilot():
+        metrics[f"autopilot/{name}/p50"] = (p50, "us")
+        metrics[f"autopilot/{name}/p99"] = (p99, "us")
+    for count, rate in bench_batch_env():
+        metrics[f"BatchSnakeEnv/{count}"] = (rate, "ticks/sec")
+    queue_time, write_time, load_time = bench_save_store()
+    metrics["SaveStore/queue"] = (queue_time, "us")
+    metrics["SaveStore/write"] = (write_time, "us")
+    metrics["SaveStore/load"] = (load_time, "ms")
+    for length, save_time, load_time in bench_save_game():
+        metrics[f"savegame/{length}/save"] = (save_time, "ms")
+        metrics[f"savegame/{length}/resume"] = (load_time, "ms")
+    for name, elapsed in bench_leaderboard().items():
+        metrics[f"Leaderboard/{name}"] = (elapsed, "us")
+    return metrics
+
+
+def keep_best(metrics, run):
+    """
+    Function to merge the metrics of a run into the best metrics so far: the lowest durations and the highest rates.
+    Taking the best of several runs filters out most of the noise of other processes
+    Parameters:
+        metrics (dict): Metric name -> (value, unit) of the best values so far, updated in place
+        run (dict): Metric name -> (value, unit) of the run, see run_benchmarks()
+    """
+    for name, (value, unit) in run.items():
+        best = metrics.get(name)
+        if best is None or (value > best[0] if unit in RATE_UNITS else value < best[0]):
+            metrics[name] = (value, unit)
+
+
+def save_metrics(metrics, path):
+    """
+    Function to write the metrics to a JSON file, along with the versions they were measured with
+    Parameters:
+        metrics (dict): Metric name -> (value, unit), see run_benchmarks()
+        path (str): The path of the JSON file
+    """
+    data = {
+        "python": platform.python_version(),
+        "pygame": dangernoodle.pg.version.ver,
+        "platform": platform.platform(),
+        "metrics": {name: {"value": value, "unit": unit} for name, (value, unit) in metrics.items()},
+    }
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(data, file, indent=1)
+
+
+def compare_metrics(metrics, baseline, tolerance):
+    """
+    Function to print how every metric changed compared to a baseline, and return the names of
+    the metrics that got worse by more than the tolerance. Metrics missing from either side are skipped
+    Parameters:
+        metrics (dict): Metric name -> (value, unit), see run_benchmarks()
+        baseline (dict): The "metrics" of a JSON file written by save_metrics()
+        tolerance (float): The allowed relative slowdown, 0.25 allows metrics to get 25% worse
+    """
+    regressions = []
+    print(f"{'metric':<40} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, (value, unit) in metrics.items():
+        old = baseline.get(name)
+        if old is None or old["unit"] != unit or not old["value"] or not value:
+            continue
+        # Express every change as a slowdown factor, so rates and durations are compared the same way
+        if unit in RATE_UNITS:
+            slowdown = old["value"] / value - 1
+        else:
+            slowdown = value / old["value"] - 1
+        regressed = slowdown > tolerance
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<40} {old['value']:>12.3f} {value:>12.3f} {-slowdown:>+8.1%}"
+              + (" REGRESSION" if regressed else ""))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of DangerNoodle")
+    parser.add_argument("--json", metavar="FILE", help="write the results to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="compare the results to an earlier --json FILE")
+    parser.add_argument("--repeat", type=int, default=3, help="run every benchmark this many times and keep the best result")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="relative slowdown allowed before a metric counts as a regression, defaults to 0.25")
+    args = parser.parse_args()
+    baseline = None
+    if args.baseline:
+        # Read the baseline first, so a missing file doesn't waste a whole run
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)["metrics"]
+    # Without persistence the benchmark never touches the highscores, settings or save game of the player
+    game = dangernoodle.Snake(persistent=False)
+    metrics = {}
+    for run in range(args.repeat):
+        print(f"Run {run + 1} of {args.repeat}")
+        keep_best(metrics, run_benchmarks(game))
+    game.close()
+    if args.json:
+        save_metrics(metrics, args.json)
+    if baseline is not None:
+        regressions = compare_metrics(metrics, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} metrics regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print("No regressions")
@@ -0,0 +1,320 @@
+"""
+Binary codec for streaming multiplayer games of DangerNoodle, used by server.py and spectator.py.
+A snapshot holds the whole game: the body of every snake, the apples, the scores and the settings.
+A delta holds only what changed during a tick: heads pushed, tails popped, snakes that died and apples
+that moved. A client applies a snapshot and then every delta after it to its MirrorState.
+Encoding writes with precompiled structs straight into a buffer that is allocated once and only grows,
+and returns a memoryview of it, so encoding a tick allocates nothing but the small ints of its events.
+Decoding reads with unpack_from from the received bytes without slicing them, and the mirrored bodies
+reuse the segment of a popped tail for the next head, like engine.GameState.
+
+Every message is a frame: a 4 byte length followed by the payload, whose first byte is the message type.
+All integers are big-endian. Cells are sent with the direction of the segment as cell << 2 | direction index.
+Client to server:
+HELLO: role (0 = spectator, 1 = player)
+DIRECTION: direction index (0 = up, 1 = left, 2 = down, 3 = right)
+Server to client:
+WELCOME: columns, rows, amount of snakes, amount of apples, snake of the client (-1 for spectators), tick rate
+SNAPSHOT: tick, boundaries, per snake: alive, score, max length, length and segments from tail to head,
+    then the cell of every apple (NO_APPLE for an empty slot)
+DELTA: tick, amount of events, then EVENT_FORMAT per event: kind, snake or apple slot, value.
+    TAIL: the tail was popped. HEAD: the new head. DIED: death cause index.
+    APPLE: the new cell of the apple, NO_APPLE if it found no room
+Usage:
+encoder = StateEncoder()
+writer.write(encoder.snapshot(state))
+mirror = MirrorState()
+mirror.apply(payload)
+"""
+
+import struct
+
+from engine import UP, LEFT, DOWN, RIGHT, SnakeBody
+
+# Directions are sent as an index into NET_DIRECTIONS, like REPLAY_DIRECTIONS in replay.py
+NET_DIRECTIONS = (UP, LEFT, DOWN, RIGHT)
+DIRECTION_INDICES = {direction: index for index, direction in enumerate(NET_DIRECTIONS)}
+DEATH_CAUSES = ("wall", "self", "snake", "head")
+ROLE_SPECTATOR = 0
+ROLE_PLAYER = 1
+
+# Message types
+HELLO = 0
+DIRECTION = 1
+WELCOME = 2
+SNAPSHOT = 3
+DELTA = 4
+# Delta event kinds
+HEAD = 0
+TAIL = 1
+DIED = 2
+APPLE = 3
+
+LENGTH_FORMAT = struct.Struct("!I")
+WELCOME_FORMAT = struct.Struct("!BHHHHhB")
+SNAPSHOT_HEADER_FORMAT = struct.Struct("!BIB")
+SNAPSHOT_SNAKE_FORMAT = struct.Struct("!BIII")
+DELTA_HEADER_FORMAT = struct.Struct("!BIH")
+EVENT_FORMAT = struct.Struct("!BHI")
+CELL_FORMAT = struct.Struct("!I")
+NO_APPLE = 0xFFFFFFFF
+
+
+class ProtocolError(ValueError):
+    """
+    Raised when a message is malformed or of an unknown type
+    """
+
+
+def frame(payload):
+    """
+    Function to return a short message as a frame, prefixed with its length
+    Parameters:
+        payload (bytes): The message
+    """
+    return LENGTH_FORMAT.pack(len(payload)) + payload
+
+
+async def read_frame(reader, max_size=None):
+    """
+    Function to read a single frame from a stream and return its payload. Raises asyncio.IncompleteReadError
+    when the connection is closed
+    Parameters:
+        reader (StreamReader): The stream to read from
+        max_size (int): The largest payload accepted. Defaults to None, accepting any size
+    """
+    size, = LENGTH_FORMAT.unpack(await reader.readexactly(LENGTH_FORMAT.size))
+    if not size or (max_size is not None and size > max_size):
+        raise ProtocolError(f"Invalid frame size {size}")
+    return await reader.readexactly(size)
+
+
+class StateEncoder():
+    """
+    Encodes the messages of the server into a single reusable buffer. Every method returns a memoryview
+    of the complete frame, which is only valid until the next call, copy it with bytes() to keep it
+    Usage:
+    encoder = StateEncoder()
+    lengths = [len(snake.body) for snake in state.snakes]
+    state.step()
+    data = bytes(encoder.delta(state, lengths))
+    """
+    def __init__(self, size=4096):
+        """
+        Parameters:
+            size (int): The initial size of the buffer in bytes. Defaults to 4096
+        """
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def reserve(self, size):
+        """
+        Function to make sure the buffer holds at least size bytes, growing it to the next power of two
+        Parameters:
+            size (int): The amount of bytes needed
+        """
+        if size > len(self.buffer):
+            # A new buffer rather than resizing the old one, which can't be resized while views of it exist
+            self.buffer = bytearray(1 << (size - 1).bit_length())
+            self.view = memoryview(self.buffer)
+
+    def finish(self, end):
+        """
+        Function to write the length of the frame in front of the payload and return a view of the frame
+        Parameters:
+            end (int): The position right after the payload
+        """
+        LENGTH_FORMAT.pack_into(self.buffer, 0, end - LENGTH_FORMAT.size)
+        return self.view[:end]
+
+    def welcome(self, state, snake_index, tick_rate):
+        """
+        Function to encode the WELCOME frame a client gets when it connects
+        Parameters:
+            state (MultiGameState): The game
+            snake_index (int): The snake of the client, -1 for a spectator
+            tick_rate (int): The ticks per second of the server
+        """
+        WELCOME_FORMAT.pack_into(self.buffer, LENGTH_FORMAT.size, WELCOME, state.columns, state.rows,
+                                 state.num_snakes, state.num_apples, snake_index, tick_rate)
+        return self.finish(LENGTH_FORMAT.size + WELCOME_FORMAT.size)
+
+    def snapshot(self, state):
+        """
+        Function to encode the whole game in a SNAPSHOT frame
+        Parameters:
+            state (MultiGameState): The game
+        """
+        columns = state.columns
+        cells = sum(len(snake.body) for snake in state.alive)
+        self.reserve(LENGTH_FORMAT.size + SNAPSHOT_HEADER_FORMAT.size + SNAPSHOT_SNAKE_FORMAT.size * state.num_snakes
+                     + CELL_FORMAT.size * (cells + state.num_apples))
+        buffer = self.buffer
+        offset = LENGTH_FORMAT.size
+        SNAPSHOT_HEADER_FORMAT.pack_into(buffer, offset, SNAPSHOT, state.ticks, state.boundaries)
+        offset += SNAPSHOT_HEADER_FORMAT.size
+        pack_cell = CELL_FORMAT.pack_into
+        cell_size = CELL_FORMAT.size
+        for snake in state.snakes:
+            length = len(snake.body) if snake.alive else 0
+            SNAPSHOT_SNAKE_FORMAT.pack_into(buffer, offset, snake.alive, snake.score, snake.snake_length, length)
+            offset += SNAPSHOT_SNAKE_FORMAT.size
+            if length:
+                for segment in snake.body:
+                    pack_cell(buffer, offset, (segment.y * columns + segment.x) << 2 | DIRECTION_INDICES[segment.rotation])
+                    offset += cell_size
+        for cell in state.apples:
+            pack_cell(buffer, offset, NO_APPLE if cell is None else cell)
+            offset += cell_size
+        return self.finish(offset)
+
+    def delta(self, state, lengths):
+        """
+        Function to encode what changed during the last tick of a game in a DELTA frame
+        Parameters:
+            state (MultiGameState): The game, right after step()
+            lengths (list): The length of the body of every snake right before step()
+        """
+        columns = state.columns
+        # At most a tail and a head per snake, a death per snake and a move per apple
+        self.reserve(LENGTH_FORMAT.size + DELTA_HEADER_FORMAT.size
+                     + EVENT_FORMAT.size * (2 * len(state.alive) + len(state.died) + len(state.eaten_apples)))
+        buffer = self.buffer
+        pack_event = EVENT_FORMAT.pack_into
+        event_size = EVENT_FORMAT.size
+        offset = LENGTH_FORMAT.size + DELTA_HEADER_FORMAT.size
+        for snake in state.alive:
+            # The tail comes first, so the decoder can reuse its segment for the head
+            if len(snake.body) == lengths[snake.index]:
+                pack_event(buffer, offset, TAIL, snake.index, 0)
+                offset += event_size
+            head = snake.body.head()
+            pack_event(buffer, offset, HEAD, snake.index,
+                       (head.y * columns + head.x) << 2 | DIRECTION_INDICES[head.rotation])
+            offset += event_size
+        for snake in state.died:
+            pack_event(buffer, offset, DIED, snake.index, DEATH_CAUSES.index(snake.death_cause))
+            offset += event_size
+        for slot, _ in state.eaten_apples:
+            cell = state.apples[slot]
+            pack_event(buffer, offset, APPLE, slot, NO_APPLE if cell is None else cell)
+            offset += event_size
+        count = (offset - LENGTH_FORMAT.size - DELTA_HEADER_FORMAT.size) // event_size
+        DELTA_HEADER_FORMAT.pack_into(buffer, LENGTH_FORMAT.size, DELTA, state.ticks, count)
+        return self.finish(offset)
+
+
+class MirrorState():
+    """
+    A client side copy of a game on the server, kept in sync by applying the messages of the server.
+    Every snake has a SnakeBody like the snake of a GameState, so it can be drawn the same way
+    Usage:
+    mirror = MirrorState()
+    mirror.apply(payload)
+    """
+    def __init__(self):
+        self.columns = None
+        self.rows = None
+        self.num_snakes = 0
+        self.num_apples = 0
+        self.snake_index = -1 # the snake of this client, -1 for a spectator
+        self.tick_rate = 0
+        self.tick = 0
+        self.boundaries = True
+        self.bodies = []
+        self.alive = []
+        self.scores = []
+        self.lengths = [] # max length of every snake
+        self.apples = [] # cell of every apple, None for an empty slot
+        self.apple_slots = {} # cell -> index in apples
+        self.synced = False # True once a snapshot was applied
+
+    def apply(self, payload):
+        """
+        Function to apply a message of the server to the copy of the game
+        Parameters:
+            payload (bytes): The message, without the length of the frame
+        """
+        kind = payload[0]
+        try:
+            if kind == WELCOME:
+                (_, self.columns, self.rows, self.num_snakes, self.num_apples, self.snake_index,
+                 self.tick_rate) = WELCOME_FORMAT.unpack(payload)
+                self.synced = False
+            elif kind == SNAPSHOT:
+                self.apply_snapshot(payload)
+            elif kind == DELTA:
+                if self.synced:
+                    self.apply_delta(payload)
+            else:
+                raise ProtocolError(f"Unknown message type {kind}")
+        except (struct.error, IndexError) as e:
+            raise ProtocolError(f"{e}: Malformed message of type {kind}")
+
+    def apply_snapshot(self, payload):
+        """
+        Function to replace the copy of the game with a snapshot
+        Parameters:
+            payload (bytes): The SNAPSHOT message
+        """
+        _, self.tick, boundaries = SNAPSHOT_HEADER_FORMAT.unpack_from(payload)
+        self.boundaries = bool(boundaries)
+        columns = self.columns
+        offset = SNAPSHOT_HEADER_FORMAT.size
+        self.bodies = []
+        self.alive = []
+        self.scores = []
+        self.lengths = []
+        unpack_cell = CELL_FORMAT.unpack_from
+        for _ in range(self.num_snakes):
+            alive, score, snake_length, length = SNAPSHOT_SNAKE_FORMAT.unpack_from(payload, offset)
+            offset += SNAPSHOT_SNAKE_FORMAT.size
+            body = SnakeBody()
+            for _ in range(length):
+                value, = unpack_cell(payload, offset)
+                offset += CELL_FORMAT.size
+                y, x = divmod(value >> 2, columns)
+                body.push_head(x, y, NET_DIRECTIONS[value & 3])
+            self.bodies.append(body)
+            self.alive.append(bool(alive))
+            self.scores.append(score)
+            self.lengths.append(snake_length)
+        self.apples = [None if cell == NO_APPLE else cell
+                       for cell in struct.unpack_from(f"!{self.num_apples}I", payload, offset)]
+        self.apple_slots = {cell: slot for slot, cell in enumerate(self.apples) if cell is not None}
+        self.synced = True
+
+    def apply_delta(self, payload):
+        """
+        Function to apply the events of a single tick
+        Parameters:
+            payload (bytes): The DELTA message
+        """
+        _, self.tick, count = DELTA_HEADER_FORMAT.unpack_from(payload)
+        columns = self.columns
+        unpack_event = EVENT_FORMAT.unpack_from
+        offset = DELTA_HEADER_FORMAT.size
+        recycled = None
+        for _ in range(count):
+            kind, index, value = unpack_event(payload, offset)
+            offset += EVENT_FORMAT.size
+            if kind == TAIL:
+                recycled = self.bodies[index].pop_tail()
+            elif kind == HEAD:
+                cell = value >> 2
+                y, x = divmod(cell, columns)
+                self.bodies[index].push_head(x, y, NET_DIRECTIONS[value & 3], recycled)
+                recycled = None
+                if cell in self.apple_slots:
+                    self.scores[index] += 1
+                    self.lengths[index] += 1
+            elif kind == DIED:
+                self.alive[index] = False
+                self.bodies[index] = SnakeBody()
+            elif kind == APPLE:
+                old = self.apples[index]
+                if self.apple_slots.get(old) == index:
+                    del self.apple_slots[old]
+                self.apples[index] = None if value == NO_APPLE else value
+                if value != NO_APPLE:
+                    self.apple_slots[value] = index
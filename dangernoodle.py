@@ -5,30 +5,40 @@ Inspired by The New Boston pygame tutorial, link to playlist below:
 https://www.youtube.com/playlist?list=PL6gx4Cwl9DGAjkwJocj7vlc_mFU-4wXJq
 
 
-TODO (init, draw_snake, game_loop, generate_apple functions):
-Find method to get high fps with possibly lower x,y increments per clock tick.
-Increments depend on but are not equal to block_size. if they were this could mess up the grid system
-Might need to check for first upcoming multiple of block_size, then turn?
-
-TODO (generate_apple() function):
-remove checklist and check immediately in self.snake_list using some kind of dont-care operator?
-like while [apple_x, apple_y, _] in self.snakelist
-https://stackoverflow.com/questions/53488787/is-there-a-dont-care-value-for-lists-in-python/53488822
-
 TODO (draw_snake() function):
 remove the hardcoded checking for right-then-up and up-then-right movement
 """
 
+from time import perf_counter
+IMPORT_START = perf_counter() # start of the import phase reported by --profile-startup
 try:
     import pygame as pg
 except ModuleNotFoundError as e:
     print(f"{e}: The pygame module could not be found")
+PYGAME_IMPORTED = perf_counter()
 from sys import exit, platform
-from random import randint
+from collections import OrderedDict, deque
+import argparse
 import ctypes
-import pickle
+import os
+import sqlite3
+from random import getrandbits, Random
+from engine import GameState, UP, LEFT, DOWN, RIGHT
+from autopilot import PathfindingController
+from multiplayer import MultiGameState, greedy_bot
+from replay import Replay, ReplayRecorder
+import savegame
+from storage import DEFAULT_SETTINGS, SaveStore, migrate_legacy_files
+from leaderboard import Leaderboard
+from profiler import FrameProfiler
+from verifier import verify_replay
+IMPORT_END = perf_counter()
 
-pg.init() # initialize pg modules. Returns a tuple of (succesful, unsuccesful) initializations
+# Only initialize the pg modules that are used, instead of all of them with pg.init().
+# The audio mixer in particular is never used but can take a long time to start
+pg.display.init()
+pg.font.init()
+INIT_END = perf_counter()
 
 if 'win' in platform.lower():
     # set unique windows app id so Windows uses the proper icon in the taskbar when executing snake.py
@@ -43,10 +53,346 @@ RED = (255, 0, 0)
 GREEN = (0, 255, 0)
 SNAKE_GREEN = (0, 155, 0) # Not bright green
 FONT = "./Gasalt-Black.ttf"
+FONT_SIZES = {"tiny": 20, "small": 30, "med": 40, "large": 80}
+# Sprites are block_size x block_size pixels, the icon should be a 32x32 file
+SPRITE_FILES = {"head": "head.png", "body": "body.png", "turn": "turn.png", "tail": "tail.png", "apple": "apple.png"}
+ICON_FILE = "icon.png"
 # Brown hex: 8c4614
 
 DISPLAY_WIDTH = 800
 DISPLAY_HEIGHT = 600
+# The board is measured in cells and can be larger than the window, up to MAX_BOARD_SIZE cells in either direction
+MAX_BOARD_SIZE = 10000
+# The camera moves to center the head when it comes within this many cells of the edge of the window
+CAMERA_MARGIN = 4
+# Body segments are bucketed in square chunks of this many cells, so only chunks in view are drawn
+CHUNK_SIZE = 16
+
+# Menus block until an event arrives, but wake up at least this often (in ms)
+MENU_EVENT_TIMEOUT = 1000
+# If rendering falls behind, at most this many game ticks are caught up on per frame, the rest is dropped
+MAX_TICKS_PER_FRAME = 5
+# Maximum amount of buffered direction changes, further key presses are ignored until there is room
+INPUT_QUEUE_SIZE = 3
+# When profiling, the numbers in the in-game overlay are updated this often (in ms)
+PROFILE_OVERLAY_INTERVAL = 500
+
+# Map the arrow keys to the direction the snake should move in
+KEY_DIRECTIONS = {pg.K_UP: UP, pg.K_LEFT: LEFT, pg.K_DOWN: DOWN, pg.K_RIGHT: RIGHT}
+# The replay of the last played game is saved here on game over
+LAST_REPLAY_FILE = "last_replay.dnr"
+# Settings are appended to the log on every change, and periodically compacted into the snapshot
+SAVE_LOG_FILE = "save.log"
+SAVE_SNAPSHOT_FILE = "save.json"
+# A game in progress is saved here from the pause menu and on shutdown, and resumed from the main menu
+SAVE_GAME_FILE = "savegame.dns"
+# Highscores and settings of older versions, migrated to the store and the leaderboard on the first start
+LEGACY_HIGHSCORES_FILE = "highscores.pickle"
+LEGACY_SETTINGS_FILE = "settings.pickle"
+# Every highscore ever set is stored in the leaderboard database
+LEADERBOARD_FILE = "leaderboard.db"
+# Amount of highscores shown per page of the highscore menu, a score has to make the first page to be saved
+HIGHSCORES_PER_PAGE = 5
+
+class TextCache():
+    """
+    Least recently used cache of rendered text surfaces, keyed by (text, color, size).
+    Rendering anti-aliased text is slow, while menus and the score redraw the same strings over and over.
+    The amount of hits and misses is counted to check how effective the cache is.
+    Usage:
+    cache = TextCache({"small": pg.font.Font(None, 30)})
+    surface = cache.render("Play", (0, 0, 0), "small")
+    """
+    def __init__(self, fonts, max_entries=256):
+        self.fonts = fonts # maps a size name to its font
+        self.max_entries = max_entries
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, text, color, size):
+        """
+        Function to return the rendered surface of a text, rendering it only if it is not cached yet
+        Parameters:
+            text (str): The text to render
+            color (tup): A tuple of the int values of the desired RGB colors
+            size (str): The name of the font size, either 'small', 'med' or 'large'
+        """
+        key = (text, color, size)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+        self.misses += 1
+        surface = self.fonts[size].render(text, True, color) # render message, True (for anti-aliasing), color
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_entries:
+            self.surfaces.popitem(last=False) # drop the least recently used surface
+        return surface
+
+    def clear(self):
+        """
+        Function to empty the cache, for example when the colors change
+        """
+        self.surfaces.clear()
+
+
+class StartupProfile():
+    """
+    Keeps track of the time spent in each phase of starting the game, reported with --profile-startup.
+    Fonts and sprites are loaded when they are first used, their time is added whenever that happens
+    """
+    def __init__(self):
+        self.phases = OrderedDict() # phase name -> seconds
+        self.add("import pygame", PYGAME_IMPORTED - IMPORT_START)
+        self.add("import game modules", IMPORT_END - PYGAME_IMPORTED)
+        self.add("init pygame", INIT_END - IMPORT_END)
+
+    def add(self, phase, seconds):
+        """
+        Function to add time to a phase
+        Parameters:
+            phase (str): The name of the phase
+            seconds (float): The time spent in seconds
+        """
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def summary(self):
+        """
+        Function to return a multiline report of the time spent in every phase
+        """
+        total = sum(self.phases.values())
+        lines = [f"{phase:>24}: {seconds * 1000:8.2f} ms {seconds / total * 100:5.1f}%"
+                 for phase, seconds in self.phases.items()]
+        lines.append(f"{'total':>24}: {total * 1000:8.2f} ms")
+        return "\n".join(lines)
+
+
+# Startup phases of this process, the first Snake adds its own phases
+STARTUP_PROFILE = StartupProfile()
+
+
+class FontLoader(dict):
+    """
+    Dictionary mapping the size names of FONT_SIZES to fonts. A font is only loaded the first time it is used,
+    falling back to the default system font if the font file can not be found
+    """
+    def __missing__(self, size):
+        start = perf_counter()
+        try:
+            font = pg.font.Font(FONT, FONT_SIZES[size])
+        except FileNotFoundError as e:
+            print(f"Error: Font could not be located\nProceeding with default system font\n{e}")
+            font = pg.font.SysFont(None, FONT_SIZES[size], bold=1)
+        self[size] = font
+        STARTUP_PROFILE.add("fonts", perf_counter() - start)
+        return font
+
+
+class SpriteAtlas(dict):
+    """
+    Dictionary mapping the sprite names of SPRITE_FILES to a dictionary of their four rotations
+    (0, 90, 180 and 270 degrees), converted to the display pixel format and scaled to the block size.
+    A sprite is only loaded and rotated the first time it is used, which needs the display mode to be set
+    for convert_alpha()
+    Usage:
+    atlas = SpriteAtlas(20)
+    head = atlas["head"][RIGHT]
+    """
+    def __init__(self, block_size):
+        super().__init__()
+        self.block_size = block_size
+
+    def __missing__(self, name):
+        start = perf_counter()
+        img = pg.image.load(SPRITE_FILES[name]).convert_alpha()
+        if img.get_size() != (self.block_size, self.block_size):
+            img = pg.transform.smoothscale(img, (self.block_size, self.block_size))
+        rotations = {degrees: pg.transform.rotate(img, degrees) for degrees in (0, 90, 180, 270)}
+        self[name] = rotations
+        STARTUP_PROFILE.add("images", perf_counter() - start)
+        return rotations
+
+
+class SegmentChunks():
+    """
+    Spatial index of the body segments of the snake, bucketed by chunk of CHUNK_SIZE x CHUNK_SIZE cells.
+    Holds every segment except the tail, the neck and the head, which move between frames and are drawn
+    separately. A segment is stored with the sprite it is drawn with, which is fixed once the segment
+    is behind the neck, so drawing the part of the snake in view only visits the chunks in view.
+    The cells of added and removed segments can be tracked, to update a cached layer of the body
+    Usage:
+    chunks = SegmentChunks()
+    chunks.add(segment, sprite)
+    for segment, sprite in chunks.in_cells(0, 0, 40, 30):
+        pass
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.chunks = {} # (chunk x, chunk y) -> {segment: sprite}
+        self.members = {} # segment -> key of its chunk
+        self.track_changes = False
+        self.added = [] # segments added since the last take_changes(), if changes are tracked
+        self.removed = [] # (x, y) cells of segments removed since the last take_changes()
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, segment):
+        return segment in self.members
+
+    def add(self, segment, sprite):
+        """
+        Function to add a segment. Its position must not change until it is removed again
+        Parameters:
+            segment (Segment): The segment to add
+            sprite (Surface): The sprite to draw the segment with
+        """
+        key = (segment.x // self.chunk_size, segment.y // self.chunk_size)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = {}
+        chunk[segment] = sprite
+        self.members[segment] = key
+        if self.track_changes:
+            self.added.append(segment)
+
+    def remove(self, segment):
+        """
+        Function to remove a segment
+        Parameters:
+            segment (Segment): The segment to remove
+        """
+        key = self.members.pop(segment)
+        chunk = self.chunks[key]
+        del chunk[segment]
+        if not chunk:
+            del self.chunks[key]
+        if self.track_changes:
+            self.removed.append( (segment.x, segment.y) )
+
+    def clear(self):
+        """
+        Function to remove all segments, without tracking them as changes
+        """
+        self.chunks.clear()
+        self.members.clear()
+        self.take_changes()
+
+    def take_changes(self):
+        """
+        Function to return the (added segments, removed cells) since the last call, and forget them
+        """
+        changes = (self.added, self.removed)
+        self.added = []
+        self.removed = []
+        return changes
+
+    def in_cells(self, left, top, right, bottom):
+        """
+        Generator yielding (segment, sprite) for every segment in the chunks overlapping a range of cells.
+        Segments in those chunks just outside the range are included as well
+        Parameters:
+            left (int): The first column of the range
+            top (int): The first row of the range
+            right (int): The column after the last column of the range
+            bottom (int): The row after the last row of the range
+        """
+        chunks = self.chunks
+        chunk_size = self.chunk_size
+        for chunk_y in range(top // chunk_size, (bottom - 1) // chunk_size + 1):
+            for chunk_x in range(left // chunk_size, (right - 1) // chunk_size + 1):
+                chunk = chunks.get( (chunk_x, chunk_y) )
+                if chunk:
+                    yield from chunk.items()
+
+
+class FramePacing():
+    """
+    Keeps track of the frame times of the last frames, the amount of dropped game ticks
+    and the latency between a key press and the move it causes, to check how smooth the game runs.
+    Usage:
+    stats = FramePacing()
+    stats.add_frame(clock.tick(60))
+    print(stats.summary())
+    """
+    def __init__(self, window=600):
+        self.frame_times = deque(maxlen=window) # frame times of the last window frames in ms
+        self.input_latencies = deque(maxlen=window) # key press to move latencies of the last window moves in ms
+        self.frames = 0
+        self.ticks = 0
+        self.dropped_ticks = 0
+
+    def add_frame(self, frame_time, ticks=0):
+        """
+        Function to record a rendered frame
+        Parameters:
+            frame_time (float): The time since the previous frame in ms
+            ticks (int): The amount of game ticks done this frame. Defaults to 0
+        """
+        self.frame_times.append(frame_time)
+        self.frames += 1
+        self.ticks += ticks
+
+    def add_input_latency(self, latency):
+        """
+        Function to record the time between a key press and the tick in which it moved the snake
+        Parameters:
+            latency (float): The latency in ms
+        """
+        self.input_latencies.append(latency)
+
+    def percentile(self, percentile, samples=None):
+        """
+        Function to return the value at a given percentile of the recent frame times, or of other samples
+        Parameters:
+            percentile (float): The percentile, between 0 and 100
+            samples (iterable): The samples to use. Defaults to None, in which case the frame times are used
+        """
+        samples = sorted(self.frame_times if samples is None else samples)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+    def summary(self):
+        """
+        Function to return a single line summary of the frame pacing
+        """
+        return (f"{self.frames} frames, {self.ticks} ticks, frame time p50 {self.percentile(50):.1f} ms, "
+                f"p99 {self.percentile(99):.1f} ms, {self.dropped_ticks} dropped ticks, "
+                f"input latency p50 {self.percentile(50, self.input_latencies):.1f} ms, "
+                f"p99 {self.percentile(99, self.input_latencies):.1f} ms")
+
+class VersusState():
+    """
+    The part of a multiplayer.MultiGameState the in-game screen draws, as if it were the GameState of the snake
+    of the player: its body, score and turns. The apples are drawn along with the other snakes, see
+    Snake.draw_other_snakes(), so apple_x and apple_y are None
+    """
+    def __init__(self, state, index=0):
+        """
+        Parameters:
+            state (MultiGameState): The multiplayer game
+            index (int): The index of the snake of the player. Defaults to 0
+        """
+        self.multi = state
+        self.snake = state.snakes[index]
+        self.columns = state.columns
+        self.rows = state.rows
+        self.apple_x = None
+        self.apple_y = None
+
+    @property
+    def body(self):
+        return self.snake.body
+
+    @property
+    def score(self):
+        return self.snake.score
+
+    def is_turn(self, direction):
+        return self.snake.is_turn(direction)
 
 class Snake():
     """
@@ -56,60 +402,97 @@ class Snake():
     game = snake.Snake()
     game.main_menu()
     """
-    def __init__(self):
-        # Initialize fonts
-        try:
-            self.smallfont = pg.font.Font(FONT, 30)
-            self.medfont = pg.font.Font(FONT, 40) # size 50
-            self.largefont = pg.font.Font(FONT, 80) # size 80
-        except FileNotFoundError as e:
-            print(f"Error: Font could not be located\nProceeding with default system font\n{e}")
-            self.smallfont = pg.font.SysFont(None, 30, bold=1)
-            self.medfont = pg.font.SysFont(None, 40, bold=1)
-            self.largefont = pg.font.SysFont(None, 80, bold=1)
+    def __init__(self, columns=None, rows=None, block_size=20, persistent=True):
+        """
+        Parameters:
+            columns (int): The width of the board in cells. Defaults to None, filling the window
+            rows (int): The height of the board in cells. Defaults to None, filling the window
+            block_size (int): The size of a cell in pixels. Defaults to 20
+            persistent (bool): If False, no files are opened or written: the highscores are kept in memory and the
+                default settings are used, for a window that only draws games such as the spectator. Defaults to True
+        """
+        self.startup_profile = STARTUP_PROFILE
+        start = perf_counter()
+        # Initialize fonts, every size is loaded the first time it is rendered
+        self.text_cache = TextCache(FontLoader())
+        # Static layers of the menus, rendered once per (menu, dark_mode)
+        self.menu_backgrounds = {}
         # Initialize colors
         self.background_color = WHITE
         self.text_color_normal = BLACK
         self.text_color_emphasis_bad = RED
         self.text_color_emphasis_good = GREEN
         self.snake_color = SNAKE_GREEN
-        # Initialize blocksize and fps
-        self.block_size = 20
-        self.game_fps = 15
+        # Initialize blocksize, board size and fps. The board doesn't depend on the size of the window,
+        # the part of it that is drawn is determined by the camera
+        self.block_size = block_size
+        self.columns = columns or DISPLAY_WIDTH // block_size
+        self.rows = rows or DISPLAY_HEIGHT // block_size
+        if not (2 <= self.columns <= MAX_BOARD_SIZE and 2 <= self.rows <= MAX_BOARD_SIZE and block_size > 0):
+            raise ValueError(f"Board size must be between 2 and {MAX_BOARD_SIZE} cells and block size positive")
+        # The visible part of the board, in pixels of the board
+        self.camera = pg.Rect(0, 0, DISPLAY_WIDTH, DISPLAY_HEIGHT)
+        # If True, the camera keeps the head in the center instead of only moving when it nears the edge.
+        # The screen is then drawn from a cached layer of the background and body, scrolled along with the camera
+        self.camera_follow = False
+        self.body_layer = None
+        self.body_layer_camera = None # the camera the body layer was drawn with
+        self.chunks = SegmentChunks()
+        self.game_fps = 15 # game ticks per second, the speed of the snake
+        self.render_fps = self.display_refresh_rate() # frames per second drawn while in game
         self.menu_fps = 15
-        # Initialize highscores
-        try:
-            with open("highscores.pickle", "rb") as file:
-                self.highscores = pickle.load(file)
-        except:
-            self.highscores = []
-            for _ in range(5):
-                self.highscores.append( ('', 0) ) #Initialize highscores to empty if no file is found
-        # Initialize settings
-        try:
-            with open("settings.pickle", "rb") as file:
-                self.boundaries, self.dark_mode = pickle.load(file)
-            if self.dark_mode:
-                self.toggle_dark_mode(True)
-        except:
-            self.boundaries = True
-            self.dark_mode = False
-        # Load images
+        self.frame_stats = FramePacing()
+        self.print_frame_stats = False # print the frame pacing after every game
+        # Controller playing the game instead of the arrow keys, see autopilot.py. None when the player plays
+        self.controller = None
+        # Amount of bot snakes the player plays against on the same board, see versus_loop(). 0 for a normal game
+        self.num_bots = 0
+        # Profiling of the game loop is opt-in, see enable_profiling(). Without a profiler the loop skips every lap
+        self.profiler = None
+        self.profile_trace_file = None
+        self.show_profile_overlay = False
+        self.profile_overlay = None # rendered overlay, updated every PROFILE_OVERLAY_INTERVAL ms
+        self.profile_overlay_time = 0
+        self.in_game = False # no game to autosave on shutdown until one is started
+        # Initialize highscores and settings, the store falls back to the defaults if nothing was saved yet
+        if persistent:
+            try:
+                self.leaderboard = Leaderboard(LEADERBOARD_FILE)
+            except sqlite3.Error as e:
+                print(f"{e}: Could not open {LEADERBOARD_FILE}, highscores will not be saved")
+                self.leaderboard = Leaderboard(":memory:")
+            self.store = SaveStore(SAVE_LOG_FILE, SAVE_SNAPSHOT_FILE)
+            migrate_legacy_files(self.store, self.leaderboard, LEGACY_HIGHSCORES_FILE, LEGACY_SETTINGS_FILE)
+            settings = self.store.settings
+        else:
+            self.leaderboard = Leaderboard(":memory:")
+            self.store = None # settings are not saved, see persistent
+            settings = DEFAULT_SETTINGS
+        self.boundaries = settings["boundaries"]
+        self.dark_mode = settings["dark_mode"]
+        if self.dark_mode:
+            self.toggle_dark_mode(True)
+        self.startup_profile.add("settings and highscores", perf_counter() - start)
+        # Load the icon. The sprites are loaded when they are first drawn, only check that they exist
+        start = perf_counter()
         try:
-            self.icon = pg.image.load("icon.png") # icon should be a 32x32 file
-            self.apple_img = pg.image.load("apple.png") # block_size x block_size pixels
-            self.head_img = pg.image.load("head.png") # block_size x block_size pixels
-            self.tail_img = pg.image.load("tail.png") # block_size x block_size pixels
-            self.body_img = pg.image.load("body.png")
-            self.turn_img = pg.image.load("turn.png")
-        except pg.error as e:
+            self.icon = pg.image.load(ICON_FILE)
+            missing = [file for file in SPRITE_FILES.values() if not os.path.isfile(file)]
+            if missing:
+                raise pg.error(f"Couldn't open {', '.join(missing)}")
+        except (pg.error, FileNotFoundError) as e:
             print(f"Error: One or more sprites could not be located\n{e}")
             print("Shutting down")
             self.shutdown()
+        self.startup_profile.add("images", perf_counter() - start)
         # Initialize main program surface
+        start = perf_counter()
         self.program_surface = pg.display.set_mode((DISPLAY_WIDTH,DISPLAY_HEIGHT)) # returns a surface object with (w,h) wxh pixels
         pg.display.set_caption("DangerNoodle - A very original game by Jasper")
         pg.display.set_icon(self.icon)
+        self.startup_profile.add("display", perf_counter() - start)
+        # Every snake sprite is rotated once, the first time it is drawn
+        self.sprites = self.build_sprite_atlas()
         # Initialize clock object to tick every FPS times per second
         self.clock = pg.time.Clock() # pg clock object used to set fps
         # Call function to reset in-game variables, in this case initializing them
@@ -123,48 +506,82 @@ class Snake():
         self.game_over = False # True if snake is dead but program still running
         self.program_exit = False # True if program is quit
         self.in_game = False # True if the user is actively playing snake
-        self.lead_x = DISPLAY_WIDTH//2 # x-location of head, initially center of screen
-        self.lead_y = DISPLAY_HEIGHT//2 # y-ocation of head, initially center of screen
-        self.lead_x_change = 0 # Change in lead_x location every clock tick
-        self.lead_y_change = self.block_size # change in lead_y location every clock tick, initially snake moves down
-        # body, turn and tail rotation is based on the rotation of the previous snake segment
-        self.head_rotation = 180 # starting direction is down
-        self.head = self.rotate(self.head_img, self.head_rotation) # starting direction is down
-        # snake_list is a list of all squares currently occupied by the snake and their rotation
-        # initialize snake as size 2 and moving downwards
-        self.snake_list = [[self.lead_x, self.lead_y-self.block_size, self.head_rotation],
-                            [self.lead_x, self.lead_y, self.head_rotation]]
-        self.snake_length = 2 # max allowed length of the snake
-        self.current_score = self.snake_length - 2 # score == current length - base lengt
-        self.generate_apple() # Generate initial apple location
+        # All game rules live in the game state, this class only draws it and handles input
+        # The state works in grid cells, which are scaled by block_size when drawing
+        # Every game gets its own seed, so it can be replayed from the seed and the recorded inputs
+        self.seed = getrandbits(63)
+        state = GameState(self.columns, self.rows, self.boundaries, Random(self.seed))
+        self.use_state(state, ReplayRecorder(state, self.seed))
+        self.game_saved = False # True if SAVE_GAME_FILE holds the current game
+
+    def use_state(self, state, recorder):
+        """
+        Function to make a game state the one that is drawn and played, for a new or a resumed game
+        Parameters:
+            state (GameState): The game state
+            recorder (ReplayRecorder): The recorder of the game, which steps the state
+        """
+        self.state = state
+        self.recorder = recorder
+        # Cell the tail was in before the last tick, the tail is drawn sliding from there to its current cell
+        tail = self.state.body.tail()
+        self.last_tail = (tail.x, tail.y)
+        # Fraction of the time between the last tick and the next one, used to draw the head and tail part way
+        self.render_alpha = 1
+        self.update_camera(recenter=True)
+        self.rebuild_chunks()
+        if self.profiler is not None:
+            self.profiler.instrument(self.state)
+        # Buffered (direction, time of key press) tuples, one is consumed every tick
+        self.input_queue = deque()
 
     def shutdown(self):
         """
-        Function to properly shut the program down
-        and save local highscores and settings
+        Function to properly shut the program down.
+        Highscores and settings are saved as soon as they change, this only waits for pending writes.
+        A game in progress is saved, so it can be resumed from the main menu
         """
-        # Store highscores and settings on shutdown
-        with open("highscores.pickle", "wb") as file:
-            pickle.dump(self.highscores, file)
-        with open("settings.pickle", "wb") as file:
-            pickle.dump( (self.boundaries, self.dark_mode), file)
+        if self.in_game and not self.state.game_over and self.controller is None and self.store is not None:
+            self.save_game()
+        self.save_profile_trace()
+        self.close()
         pg.quit()
         exit()
 
+    def close(self):
+        """
+        Function to close the highscores and settings, waiting for pending writes.
+        Called by shutdown(), or directly by a program that only used the game to draw
+        """
+        if self.store is not None:
+            self.store.close()
+        self.leaderboard.close()
+
     def draw_main_menu(self, ind_pos):
         """
         Function called by main_menu() to draw the correct text on the screen
         Parameters:
             ind_pos (int): the position of the menu indicator
         """
+        entries = ["Play", "Resume", "Help", "High-scores", "Settings", "Quit"]
+        self.draw_menu_background("main", self.draw_main_menu_static)
+        # Resume is greyed out when there is no saved game, which can change every time the menu is shown
+        resume_color = self.text_color_normal if os.path.isfile(SAVE_GAME_FILE) else GREY
+        self.center_msg_to_screen("Resume", resume_color, 40, "med")
+        self.center_indicator_to_screen(entries[ind_pos], 40 * ind_pos, "med")
+        pg.display.update()
+
+    def draw_main_menu_static(self):
+        """
+        Function called by draw_main_menu() to draw the parts of the main menu that never change
+        """
         self.program_surface.fill(self.background_color)
         self.center_msg_to_screen("DangerNoodle", self.snake_color, -100, "large")
-        self.center_msg_to_screen("Play", self.text_color_normal, 0, "med", show_indicator=ind_pos==0)
-        self.center_msg_to_screen("Help", self.text_color_normal, 40, "med", show_indicator=ind_pos==1)
-        self.center_msg_to_screen("High-scores", self.text_color_normal, 80, "med", show_indicator=ind_pos==2)
-        self.center_msg_to_screen("Settings", self.text_color_normal, 120, "med", show_indicator=ind_pos==3)
-        self.center_msg_to_screen("Quit", self.text_color_normal, 160, "med", show_indicator=ind_pos==4)
-        pg.display.update()
+        self.center_msg_to_screen("Play", self.text_color_normal, 0, "med")
+        self.center_msg_to_screen("Help", self.text_color_normal, 80, "med")
+        self.center_msg_to_screen("High-scores", self.text_color_normal, 120, "med")
+        self.center_msg_to_screen("Settings", self.text_color_normal, 160, "med")
+        self.center_msg_to_screen("Quit", self.text_color_normal, 200, "med")
 
     def main_menu(self):
         """
@@ -172,29 +589,36 @@ class Snake():
         directly or indirectly called from here. 
         """
         indicator_pos = 0
-        number_of_entries = 4 # number of entries in menu - 1
+        number_of_entries = 5 # number of entries in menu - 1
         self.draw_main_menu(indicator_pos)
 
         while not self.program_exit:
-            for event in pg.event.get():
+            for event in self.wait_for_events():
                 if event.type == pg.QUIT:
                     self.shutdown()
                 elif event.type == pg.KEYDOWN:
                     if event.key == pg.K_RETURN:
                         # When enter is pressed, execute code depending on indicator position
                         if indicator_pos == 0:
-                            self.game_loop()
+                            if self.num_bots:
+                                self.versus_loop()
+                            else:
+                                self.game_loop()
                             self.draw_main_menu(indicator_pos)
                         elif indicator_pos == 1:
-                            self.help_menu()
+                            if self.resume_game():
+                                self.game_loop()
                             self.draw_main_menu(indicator_pos)
                         elif indicator_pos == 2:
-                            self.highscore_menu()
+                            self.help_menu()
                             self.draw_main_menu(indicator_pos)
                         elif indicator_pos == 3:
-                            self.settings_menu()
+                            self.highscore_menu()
                             self.draw_main_menu(indicator_pos)
                         elif indicator_pos == 4:
+                            self.settings_menu()
+                            self.draw_main_menu(indicator_pos)
+                        elif indicator_pos == 5:
                             self.shutdown()
                     # Move indicator position up/down with arrow keys, wrap when exceeding entry number
                     elif event.key == pg.K_DOWN:
@@ -208,11 +632,6 @@ class Snake():
                             indicator_pos = number_of_entries
                         self.draw_main_menu(indicator_pos)
 
-            # no need for high fps, just dont make the delay on keydown too long
-            # Could remove clock.tick() entirely in menus, but that would cause the while
-            # loop to run as fast as it can, demanding a lot of unnecessary resources
-            self.clock.tick(self.menu_fps)
-
     def draw_settings_menu(self, ind_pos):
         """
         Function called by settings_menu() to draw the correct text on the screen
@@ -232,18 +651,25 @@ class Snake():
         else:
             dark_enabled_txt_color = self.text_color_emphasis_bad
             dark_disabled_txt_color = self.text_color_emphasis_good    
-        self.program_surface.fill(self.background_color)
-        self.center_msg_to_screen("Settings", self.text_color_normal, -100, "large")
-        self.center_msg_to_screen("Dark mode:", self.text_color_normal)
+        self.draw_menu_background("settings", self.draw_settings_menu_static)
         self.msg_to_screen("Enabled", dark_enabled_txt_color, DISPLAY_WIDTH//2 - 200, DISPLAY_HEIGHT // 2 + 20, show_indicator=ind_pos==[0,0])
         self.msg_to_screen("Disabled", dark_disabled_txt_color, DISPLAY_WIDTH//2 + 100, DISPLAY_HEIGHT // 2 + 20, show_indicator=ind_pos==[1,0])
-        
-        self.center_msg_to_screen(f"Edge boundaries", self.text_color_normal, 100)
         self.msg_to_screen("Enabled", bound_enabled_txt_color, DISPLAY_WIDTH//2 - 200, DISPLAY_HEIGHT // 2 + 120, show_indicator=ind_pos==[0,1])
         self.msg_to_screen("Disabled", bound_disabled_txt_color, DISPLAY_WIDTH//2 + 100, DISPLAY_HEIGHT // 2 + 120, show_indicator=ind_pos==[1,1])
-        self.center_msg_to_screen("Return to main menu", self.text_color_normal, 250, show_indicator=ind_pos[1]==2)
+        if ind_pos[1] == 2:
+            self.center_indicator_to_screen("Return to main menu", 250)
         pg.display.update()
 
+    def draw_settings_menu_static(self):
+        """
+        Function called by draw_settings_menu() to draw the parts of the settings menu that never change
+        """
+        self.program_surface.fill(self.background_color)
+        self.center_msg_to_screen("Settings", self.text_color_normal, -100, "large")
+        self.center_msg_to_screen("Dark mode:", self.text_color_normal)
+        self.center_msg_to_screen(f"Edge boundaries", self.text_color_normal, 100)
+        self.center_msg_to_screen("Return to main menu", self.text_color_normal, 250)
+
     def settings_menu(self):
         """
         The settings menu is a submenu of the main menu. It allows the user
@@ -257,7 +683,7 @@ class Snake():
 
         in_submenu = True
         while in_submenu:
-            for event in pg.event.get():
+            for event in self.wait_for_events():
                 if event.type == pg.KEYDOWN:
                     if event.key == pg.K_RETURN:
                         # When the user hits enter, execute code depending on indicator position
@@ -275,6 +701,8 @@ class Snake():
                             self.draw_settings_menu(indicator_pos)
                         elif indicator_pos[1] == 2:
                             in_submenu = False
+                        if in_submenu:
+                            self.store.set_settings(boundaries=self.boundaries, dark_mode=self.dark_mode)
                     # Move indicator position with arrow keys, wrap when exceeding entry number 
                     if event.key == pg.K_RIGHT:
                         indicator_pos[0] += 1
@@ -298,13 +726,18 @@ class Snake():
                         self.draw_settings_menu(indicator_pos)
                 elif event.type == pg.QUIT:
                     self.shutdown()
-            
-            self.clock.tick(self.menu_fps)
 
     def draw_help_menu(self):
         """
         Function called by help_menu() to draw the correct text on the screen
         """
+        self.draw_menu_background("help", self.draw_help_menu_static)
+        pg.display.update()
+
+    def draw_help_menu_static(self):
+        """
+        Function called by draw_help_menu() to draw the help menu, which never changes
+        """
         self.program_surface.fill(self.background_color)
         self.center_msg_to_screen("Help", self.text_color_normal, -200, "large")
         self.center_msg_to_screen("You are a hungry snake, looking for food. The objective of", self.text_color_normal, -100 )
@@ -315,7 +748,6 @@ class Snake():
         self.center_msg_to_screen("Pause the game by pressing P or Esc", self.text_color_normal, 80)
         self.center_msg_to_screen("Good luck!", self.text_color_normal, 140)
         self.center_msg_to_screen("Back", self.text_color_normal, 250, "med", show_indicator=True)
-        pg.display.update()
 
     def help_menu(self):
         """
@@ -325,43 +757,70 @@ class Snake():
         self.draw_help_menu()
         in_submenu = True
         while in_submenu:
-            for event in pg.event.get():
+            for event in self.wait_for_events():
                 if event.type == pg.KEYDOWN:
                     if event.key == pg.K_RETURN:
                         in_submenu = False
                 elif event.type == pg.QUIT:
                     self.shutdown()
-            self.clock.tick(self.menu_fps)
 
-    def draw_highscore_menu(self):
+    def draw_highscore_menu(self, page=0):
         """
         Function called by highscore_menu() to draw the correct text on the screen
+        Parameters:
+            page (int): The page of highscores to show. Defaults to 0, the highest scores
+        """
+        self.draw_menu_background("highscore", lambda: self.draw_highscore_menu_static(page), page)
+        pg.display.update()
+
+    def draw_highscore_menu_static(self, page):
+        """
+        Function called by draw_highscore_menu() to draw a page of the highscore menu,
+        which only changes when a new highscore is set
+        Parameters:
+            page (int): The page of highscores to show
         """
         self.program_surface.fill(self.background_color)
         self.center_msg_to_screen("High-scores", self.text_color_normal, -100, "large")
         offset = 30
-        for idx, (name, score) in enumerate(self.highscores):
-            # Only draw the score if there is a valid name
-            if name:
-                self.center_msg_to_screen(f"{name}: {score}", self.text_color_normal, (idx+1) * offset, "med")
+        first = page * HIGHSCORES_PER_PAGE
+        for idx, (name, score) in enumerate(self.leaderboard.top(HIGHSCORES_PER_PAGE, first)):
+            self.center_msg_to_screen(f"{first + idx + 1}. {name}: {score}", self.text_color_normal,
+                                      (idx+1) * offset, "med")
+        pages = self.highscore_pages()
+        if pages > 1:
+            self.center_msg_to_screen(f"< Page {page + 1}/{pages} >", self.text_color_normal, 200, "small")
         self.center_msg_to_screen("Back", self.text_color_normal, 250, "med", show_indicator=True)
-        pg.display.update()
+
+    def highscore_pages(self):
+        """
+        Function to return the amount of pages in the highscore menu, at least 1
+        """
+        return max(1, -(-len(self.leaderboard) // HIGHSCORES_PER_PAGE))
 
     def highscore_menu(self):
         """
         The highscore menu is a submenu of the main menu. Local highscores are displayed
-        here. These highscores are saved locally and persist through sessions.
+        here, the left and right arrow keys go to the previous and next page.
+        These highscores are saved locally and persist through sessions.
         """
-        self.draw_highscore_menu()
+        page = 0
+        self.draw_highscore_menu(page)
         in_submenu = True
         while in_submenu:
-            for event in pg.event.get():
+            for event in self.wait_for_events():
                 if event.type == pg.KEYDOWN:
                     if event.key == pg.K_RETURN:
                         in_submenu = False
+                    # Move between pages with arrow keys, wrap when exceeding the amount of pages
+                    elif event.key == pg.K_RIGHT:
+                        page = (page + 1) % self.highscore_pages()
+                        self.draw_highscore_menu(page)
+                    elif event.key == pg.K_LEFT:
+                        page = (page - 1) % self.highscore_pages()
+                        self.draw_highscore_menu(page)
                 elif event.type == pg.QUIT:
                     self.shutdown()
-            self.clock.tick(self.menu_fps)
 
     def update_highscores(self):
         """
@@ -369,18 +828,20 @@ class Snake():
         new highscore. If so, call highscore_name_input() to allow the user
         to save their name
         """
-        # Max amount of highscores is currently 5
-        if len(self.highscores) >= 5:
-            for idx, (_, old_score) in enumerate(self.highscores):
-                if self.current_score > old_score:
-                    new_name = self.highscore_name_input()
-                    if new_name: # don't save score when name is empty
-                        self.highscores.insert(idx, (new_name, self.current_score) )
-                        self.highscores.pop()
-                    return # End loop after inserting the new highscore
-        else:
-            self.highscores.append( ("", self.current_score) )
-            self.highscores.sort(reverse=True) # Is this possible for the desired data structure?
+        # Games played by the autopilot are not the player's, they never make the highscores
+        if self.controller is not None:
+            return
+        # Only scores that can be reproduced by re-simulating the replay of the game are accepted
+        result = verify_replay(self.recorder.replay())
+        if not result.valid:
+            print(f"{result.reason}: The score of this game could not be verified and is not saved")
+            return
+        # The score has to make the first page of the leaderboard, ties go to the older score
+        if self.state.score > 0 and self.leaderboard.placement(self.state.score) <= HIGHSCORES_PER_PAGE:
+            new_name = self.highscore_name_input()
+            if new_name: # don't save score when name is empty
+                self.leaderboard.add_score(new_name, self.state.score)
+                self.invalidate_menu_background("highscore")
 
     def draw_highscore_name_input(self, string):
         """
@@ -409,7 +870,11 @@ class Snake():
             if bkspace:
                 user_string = user_string[:-1]
                 self.draw_highscore_name_input(user_string)
-            for event in pg.event.get():
+                # Keep deleting characters at menu_fps while backspace is held down
+                timeout = 1000 // self.menu_fps
+            else:
+                timeout = MENU_EVENT_TIMEOUT
+            for event in self.wait_for_events(timeout):
                 if event.type == pg.KEYDOWN:
                     if event.key == pg.K_RETURN:
                         inputting = False
@@ -423,64 +888,70 @@ class Snake():
                         bkspace = False
                 elif event.type == pg.QUIT:
                     self.shutdown()
-            
-            self.clock.tick(self.menu_fps)
         return user_string
 
-    def draw_pause_menu(self, ind_pos):
+    def draw_pause_menu(self, ind_pos, saved=False):
         """
         Function called by pause_menu() to draw the correct text on the screen
         Unlike most menus this menu behaves like an in-game overlay, allowing
         the user to see the current state of the game behind the menu text
         Parameters:
             ind_pos (int): the position of the menu indicator
+            saved (bool): If True, show that the game was saved. Defaults to False
         """
         # Re-draw the background images to create a transparent pause menu
         self.draw_in_game_screen()
         self.center_msg_to_screen("Game paused", self.text_color_normal, -50, size="large")
         self.center_msg_to_screen("Continue", self.text_color_normal, 50, size="med", show_indicator=ind_pos==0)
-        self.center_msg_to_screen("Main menu", self.text_color_normal, 100, size="med", show_indicator=ind_pos==1)
-        self.center_msg_to_screen("Quit", self.text_color_normal, 150, size="med", show_indicator=ind_pos==2)
+        if saved:
+            self.center_msg_to_screen("Game saved", self.text_color_emphasis_good, 100, size="med", show_indicator=ind_pos==1)
+        else:
+            self.center_msg_to_screen("Save game", self.text_color_normal, 100, size="med", show_indicator=ind_pos==1)
+        self.center_msg_to_screen("Main menu", self.text_color_normal, 150, size="med", show_indicator=ind_pos==2)
+        self.center_msg_to_screen("Quit", self.text_color_normal, 200, size="med", show_indicator=ind_pos==3)
         pg.display.update()
 
     def pause_menu(self):
         """
         Pause function, called by pressing either P or ESC while in game.
-        Players can either continue, go to the main menu or exit the application
+        Players can either continue, save the game to resume it later, go to the main menu or exit the application
         """
         paused = True
+        saved = False
         indicator_pos = 0
-        number_of_entries = 2 # number of menu entries - 1
+        number_of_entries = 3 # number of menu entries - 1
         self.draw_pause_menu(indicator_pos)
 
         while paused:
-            for event in pg.event.get():
+            for event in self.wait_for_events():
                 if event.type == pg.KEYDOWN:
                     if event.key == pg.K_RETURN:
                         if indicator_pos == 0:
                             paused = False
                         elif indicator_pos == 1:
+                            saved = self.save_game()
+                            self.draw_pause_menu(indicator_pos, saved)
+                        elif indicator_pos == 2:
                             # Return to main menu
                             self.reset_game_variables()
                             paused = False
-                        elif indicator_pos == 2:
+                        elif indicator_pos == 3:
                             self.shutdown()
                     elif event.key == pg.K_DOWN:
                         indicator_pos += 1
                         if indicator_pos > number_of_entries:
                             indicator_pos = 0
-                        self.draw_pause_menu(indicator_pos)
+                        self.draw_pause_menu(indicator_pos, saved)
                     elif event.key == pg.K_UP:
                         indicator_pos -= 1
                         if indicator_pos < 0:
                             indicator_pos = number_of_entries
-                        self.draw_pause_menu(indicator_pos)
+                        self.draw_pause_menu(indicator_pos, saved)
                     # Also allow closing the pause menu with the P and Esc keys
                     elif event.key == pg.K_p or event.key == pg.K_ESCAPE:
                         paused = False
                 elif event.type == pg.QUIT:
                     self.shutdown()
-            self.clock.tick(self.menu_fps) # dont need high fps
 
     def draw_game_over_menu(self, ind_pos):
         """
@@ -510,7 +981,7 @@ class Snake():
         self.draw_game_over_menu(indicator_pos)
 
         while self.game_over:
-            for event in pg.event.get():
+            for event in self.wait_for_events():
                 if event.type == pg.KEYDOWN:
                     if event.key == pg.K_RETURN:
                         if indicator_pos == 0:
@@ -541,8 +1012,32 @@ class Snake():
         """
         Function to draw the current score in the top left corner of the in-game screen
         """
-        text = self.smallfont.render(f"Score: {self.current_score}", True, self.text_color_normal)
-        self.program_surface.blit(text, [0,0])
+        self.score_rect = self.blit_glyphs(self.score_glyphs(self.state.score), 0, 0)
+
+    def score_glyphs(self, score):
+        """
+        Function to return the list of cached surfaces that make up the score text.
+        The score is composited from the label and separate digits, so a new score never needs rendering
+        Parameters:
+            score (int): The score to show
+        """
+        render = self.text_cache.render
+        color = self.text_color_normal
+        return [render("Score: ", color, "small")] + [render(digit, color, "small") for digit in str(score)]
+
+    def blit_glyphs(self, glyphs, x_coord, y_coord):
+        """
+        Function to blit a list of surfaces next to each other and return their bounding rectangle
+        Parameters:
+            glyphs (list): The surfaces to blit, from left to right
+            x_coord (int): The x coordinate of the top left corner of the first surface
+            y_coord (int): The y coordinate of the top left corner of the first surface
+        """
+        rect = pg.Rect(x_coord, y_coord, 0, 0)
+        for glyph in glyphs:
+            rect.union_ip(self.program_surface.blit(glyph, (x_coord, y_coord)))
+            x_coord += glyph.get_width()
+        return rect
 
     def toggle_dark_mode(self, enable):
         """
@@ -558,86 +1053,428 @@ class Snake():
             self.dark_mode = False
             self.background_color = WHITE
             self.text_color_normal = BLACK
+        # Cached text was rendered in the old colors
+        self.text_cache.clear()
 
-    def generate_apple(self):
+    def segment_sprite(self, segment, next_rotation, is_tail=False):
         """
-        Function to generate a random location for the apple, while not allowing
-        it to spawn directly under the snake
+        Function to look up the sprite of a non-head segment in the sprite atlas.
+        The sprite depends on the rotation of the next segment, towards the head
+        Parameters:
+            segment (Segment): The segment to look up the sprite for
+            next_rotation (int): The rotation of the next segment in degrees
+            is_tail (bool): If True, return the tail sprite. Defaults to False
         """
-        # randint(0,display_width) could return display_width, meaning we would get an apple with coordinates
-        # [display_width, display_height, block_size, block_size], which would appear offscreen
-        self.apple_x = round(randint(0, DISPLAY_WIDTH - self.block_size)  / self.block_size) * self.block_size # round to nearest block_size
-        self.apple_y = round(randint(0, DISPLAY_HEIGHT - self.block_size) / self.block_size) * self.block_size # round to nearest block_size
-        # Disallow apple to spawn under snake
-        checklist = [segment[:2] for segment in self.snake_list]
-        while [self.apple_x, self.apple_y] in checklist:
-            self.apple_x = round(randint(0, DISPLAY_WIDTH - self.block_size)  / self.block_size) * self.block_size # round to nearest block_size
-            self.apple_y = round(randint(0, DISPLAY_HEIGHT - self.block_size) / self.block_size) * self.block_size # round to nearest block_size
+        if is_tail:
+            return self.sprites["tail"][next_rotation]
+        # currently fails when moving up and turning right, and when moving right and turning up
+        # needs respectively extra 270 and 90 degree turns
+        # movign up, then right: current segment rotation == 0, next == 270
+        # moving right then up: current segment rotaion == 270, then 0
+        if segment.rotation != next_rotation:
+            turn_sprites = self.sprites["turn"]
+            # First two conditional statements are filthy hardcoding
+            if next_rotation == 0 and segment.rotation == 270:
+                return turn_sprites[0]
+            elif next_rotation == 270 and segment.rotation == 0:
+                return turn_sprites[180]
+            # This is actual calculation
+            elif next_rotation > segment.rotation:
+                return turn_sprites[next_rotation]
+            else:
+                return turn_sprites[(next_rotation + 270) % 360]
+        return self.sprites["body"][next_rotation]
 
     def draw_snake(self):
         """
         Function to draw the head, body, turns and tail of the snake on the screen.
+        Only the chunks of body segments in view of the camera are visited, and all sprites
+        are looked up in advance, so the cost depends on the visible part of the snake
+        """
+        blit = self.program_surface.blit
+        block_size = self.block_size
+        offset_x = -self.camera.x
+        offset_y = -self.camera.y
+        # The tail, the segment behind the head and the head itself are drawn by draw_snake_ends()
+        for segment, sprite in self.chunks.in_cells(*self.visible_cells()):
+            blit(sprite, (segment.x * block_size + offset_x, segment.y * block_size + offset_y))
+        self.draw_snake_ends()
+
+    def rebuild_chunks(self):
+        """
+        Function to fill the chunks with the body segments from scratch, called when the game state is replaced
         """
-        draw_tail = 0 # used in list slicing to determine whether or not to draw the tail without raising index errors
-        for idx, segment in enumerate(self.snake_list[draw_tail:-1]): # the last element is the head, so dont put a square there
-            if idx == 0:
-                body = self.rotate(self.tail_img, self.snake_list[idx+1][2])
+        self.chunks.clear()
+        segments = self.state.body.segments
+        if len(segments) > 3:
+            body = iter(segments)
+            next(body) # skip the tail
+            segment = next(body)
+            for _ in range(len(segments) - 3):
+                next_segment = next(body)
+                self.chunks.add(segment, self.segment_sprite(segment, next_segment.rotation))
+                segment = next_segment
+        self.body_layer = None
+
+    def update_chunks(self, ticks=1):
+        """
+        Function called after every tick to update the chunks: the new tail is drawn by draw_snake_ends()
+        from now on, and the segments that moved out from behind the head are added with their final sprite.
+        The cost depends on the amount of ticks, not on the length of the snake
+        Parameters:
+            ticks (int): The amount of ticks since the last update, less than the length of the snake. Defaults to 1
+        """
+        segments = self.state.body.segments
+        chunks = self.chunks
+        tail = segments[0]
+        if tail in chunks:
+            chunks.remove(tail)
+        length = len(segments)
+        # The tails popped during the ticks are reused for the new heads, and may still be in the chunks
+        for index in range(max(1, length - ticks), length):
+            if segments[index] in chunks:
+                chunks.remove(segments[index])
+        for index in range(max(1, length - 2 - ticks), length - 2):
+            segment = segments[index]
+            if segment not in chunks:
+                chunks.add(segment, self.segment_sprite(segment, segments[index + 1].rotation))
+
+    def draw_snake_ends(self):
+        """
+        Function to draw the tail, the segment behind the head (the neck) and the head.
+        Between game ticks these are drawn part way, depending on render_alpha: the tail slides from its
+        previous cell into its current one, and the head slides from the neck into its current cell.
+        The parts of the tail and neck cells that are not covered by a sliding sprite are drawn as body.
+        The ends only ever cover the cells returned by changing_cells()
+        """
+        segments = self.state.body.segments
+        blit = self.program_surface.blit
+        block_size = self.block_size
+        alpha = self.render_alpha
+        if len(segments) < 3:
+            alpha = 1 # too short to draw the tail and the head end separately
+        tail = segments[0]
+        head = segments[-1]
+
+        tail_rect = self.cell_rect(tail.x, tail.y)
+        tail_sprite = self.segment_sprite(tail, segments[1].rotation, True)
+        dx = tail.x - self.last_tail[0]
+        dy = tail.y - self.last_tail[1]
+        # Only slide between neighbouring cells, not when the snake did not move or wrapped around the edge
+        if alpha < 1 and abs(dx) + abs(dy) == 1:
+            offset = round((1 - alpha) * block_size)
+            sprite_rect = tail_rect.move(-dx * offset, -dy * offset)
+            ahead = sprite_rect.move(dx * block_size, dy * block_size).clip(tail_rect)
+            blit(self.segment_sprite(tail, segments[1].rotation), ahead, ahead.move(-tail_rect.x, -tail_rect.y))
+            blit(tail_sprite, sprite_rect)
+        else:
+            blit(tail_sprite, tail_rect)
+
+        head_rect = self.cell_rect(head.x, head.y)
+        if len(segments) > 2:
+            neck = segments[-2]
+            neck_rect = self.cell_rect(neck.x, neck.y)
+            neck_sprite = self.segment_sprite(neck, head.rotation)
+            dx = head.x - neck.x
+            dy = head.y - neck.y
+            if alpha < 1 and abs(dx) + abs(dy) == 1:
+                offset = round(alpha * block_size)
+                head_rect = neck_rect.move(dx * offset, dy * offset)
+                behind = head_rect.move(-dx * block_size, -dy * block_size).clip(neck_rect)
+                blit(neck_sprite, behind, behind.move(-neck_rect.x, -neck_rect.y))
             else:
-                # currently fails when moving up and turning right, and when moving right and turning up
-                # needs respectively extra 270 and 90 degree turns
-                # movign up, then right: current segment rotation == 0, next == 270
-                # moving right then up: current segment rotaion == 270, then 0
-                if segment[2] != self.snake_list[idx+1][2]:
-                    # First two conditional statements are filthy hardcoding
-                    if self.snake_list[idx+1][2] == 0 and segment[2] == 270:
-                        body = self.turn_img
-                    elif self.snake_list[idx+1][2] == 270 and segment[2] == 0:
-                        body = self.rotate(self.turn_img, 180)
-                    # This is actual calculation
-                    elif self.snake_list[idx+1][2] > segment[2]:
-                        body = self.rotate(self.turn_img, self.snake_list[idx+1][2])
-                    elif self.snake_list[idx+1][2] < segment[2]:
-                        body = self.rotate(self.turn_img, (self.snake_list[idx+1][2] + 270) % 360)
-                else:
-                    body = self.rotate(self.body_img, self.snake_list[idx+1][2])
-            self.program_surface.blit(body, (segment[0], segment[1]))
-        
+                blit(neck_sprite, neck_rect)
         # blit the snake head image last, so it still shows after self-collision
-        self.program_surface.blit(self.head, (self.snake_list[-1][0], self.snake_list[-1][1]))
+        blit(self.sprites["head"][head.rotation], head_rect)
+
+    def changing_cells(self):
+        """
+        Function to return the cells that can change between two frames,
+        which are the cells covered by the snake ends (see draw_snake_ends()) and the apple
+        """
+        segments = self.state.body.segments
+        tail = segments[0]
+        neck = segments[-2]
+        head = segments[-1]
+        return [self.last_tail, (tail.x, tail.y), (neck.x, neck.y), (head.x, head.y),
+                (self.state.apple_x, self.state.apple_y)]
+
+    def draw_in_game_changes(self, old_cells, old_score):
+        """
+        Function to redraw only the parts of the in-game screen that changed since the last frame.
+        These are the cells covered by the snake ends before and after the last tick (the old head is now
+        a body or turn piece), the old and new apple and the score. Returns the list of rects that were redrawn,
+        to be passed to pg.display.update(). Falls back to a full redraw when the changes touch the score
+        Parameters:
+            old_cells (list): The cells returned by changing_cells() before the last tick
+            old_score (int): The score before the last tick
+        """
+        state = self.state
+        segments = state.body.segments
+        block_size = self.block_size
+        cells = set(old_cells)
+        cells.update(self.changing_cells())
+        screen_rect = self.program_surface.get_rect()
+        rects = [self.cell_rect(x, y).clip(screen_rect) for x, y in cells]
+        rects = [rect for rect in rects if rect] # drop the cells that are out of view
+
+        # The snake is drawn on top of the score, redraw everything if they overlap
+        if self.score_rect.collidelist(rects) != -1:
+            return self.redraw_in_game_screen()
+        if state.score != old_score:
+            score_glyphs = self.score_glyphs(state.score)
+            score_width = sum(glyph.get_width() for glyph in score_glyphs)
+            score_height = max(glyph.get_height() for glyph in score_glyphs)
+            score_rect = self.score_rect.union(pg.Rect(0, 0, score_width, score_height))
+            # Outside the board the background is grey, leave that to a full redraw
+            if not self.board_rect().contains(score_rect):
+                return self.redraw_in_game_screen()
+            board_rect = score_rect.move(self.camera.topleft)
+            for y in range(board_rect.top // block_size, (board_rect.bottom - 1) // block_size + 1):
+                for x in range(board_rect.left // block_size, (board_rect.right - 1) // block_size + 1):
+                    if state.grid.in_bounds(x, y) and state.grid.is_occupied(state.grid.cell(x, y)):
+                        return self.redraw_in_game_screen()
+
+        blit = self.program_surface.blit
+        for rect in rects:
+            self.program_surface.fill(self.background_color, rect)
+        if (state.apple_x, state.apple_y) in cells:
+            blit(self.sprites["apple"][UP], self.cell_rect(state.apple_x, state.apple_y))
+        if state.score != old_score:
+            self.program_surface.fill(self.background_color, score_rect)
+            self.score_rect = self.blit_glyphs(score_glyphs, 0, 0)
+            rects.append(score_rect)
+        # Before the last tick the head partly covered the segment that is now two behind the head
+        if len(segments) > 3:
+            segment = segments[-3]
+            if (segment.x, segment.y) in cells:
+                blit(self.segment_sprite(segment, segments[-2].rotation), self.cell_rect(segment.x, segment.y))
+        self.draw_snake_ends()
+        return rects
+
+    def redraw_in_game_screen(self):
+        """
+        Function to redraw the complete in-game screen, the fallback of draw_in_game_changes().
+        Returns a list containing the rect of the whole screen
+        """
+        self.draw_in_game_screen()
+        return [self.program_surface.get_rect()]
 
     def draw_in_game_screen(self):
         """
         Function to draw the in-game screen. This includes the background,
         apple, score and the snake itself.
         """
-        self.program_surface.fill(self.background_color)
-        self.program_surface.blit(self.apple_img, (self.apple_x, self.apple_y))
+        board_rect = self.board_rect()
+        if not board_rect.contains(self.program_surface.get_rect()):
+            # The board is smaller than the window or the camera is at an edge, grey out the area around it
+            self.program_surface.fill(GREY)
+        self.program_surface.fill(self.background_color, board_rect)
+        self.draw_apple()
         self.draw_score()
         self.draw_snake()
 
-    def rotate(self, img, degrees):
+    def draw_apple(self):
+        """
+        Function to draw the apple of the state, if there is one. The state of a game drawn for someone else,
+        such as the followed snake of the spectator, has None as apple_x when there is no apple on the board
         """
-        Rotate a given image a given amount of degrees anti-clockwise
+        if self.state.apple_x is not None:
+            self.program_surface.blit(self.sprites["apple"][UP], self.cell_rect(self.state.apple_x, self.state.apple_y))
+
+    def draw_other_snakes(self, bodies, alive, apples, followed):
+        """
+        Function to draw the snakes of a multiplayer game other than the one drawn as the state, and every apple,
+        skipping what is out of view. The tail, turns and head are looked up like those of the state,
+        see segment_sprite()
         Parameters:
-            img (image): The image to rotate
-            degrees (int): The amount of degrees to rotate the image
+            bodies (list): The SnakeBody of every snake
+            alive (list): Whether every snake is alive, dead snakes are not drawn
+            apples (list): The cell of every apple, None for an apple that is not on the board
+            followed (int): The index of the snake drawn as the state, which is skipped
+        """
+        sprites = self.sprites
+        segment_sprite = self.segment_sprite
+        blit = self.program_surface.blit
+        cell_rect = self.cell_rect
+        left, top, right, bottom = self.visible_cells()
+        for index, body in enumerate(bodies):
+            if index == followed or not alive[index] or not len(body):
+                continue
+            segments = iter(body)
+            segment = next(segments)
+            is_tail = True
+            for next_segment in segments:
+                if left <= segment.x < right and top <= segment.y < bottom:
+                    blit(segment_sprite(segment, next_segment.rotation, is_tail), cell_rect(segment.x, segment.y))
+                segment = next_segment
+                is_tail = False
+            if left <= segment.x < right and top <= segment.y < bottom:
+                blit(sprites["head"][segment.rotation], cell_rect(segment.x, segment.y))
+        for cell in apples:
+            if cell is not None:
+                y, x = divmod(cell, self.state.columns)
+                if left <= x < right and top <= y < bottom:
+                    blit(sprites["apple"][UP], cell_rect(x, y))
+
+    def draw_following_frame(self):
         """
-        return pg.transform.rotate(img, degrees)
+        Function to draw the in-game screen when the camera follows the head. The background and the body
+        are kept on a cached layer, which is scrolled along with the camera instead of being redrawn.
+        Only the strips scrolled into view and the cells where segments were added or removed are drawn
+        on the layer, then the apple, score and snake ends are drawn on top of it.
+        Returns a list containing the rect of the whole screen
+        """
+        layer = self.body_layer
+        screen_rect = self.program_surface.get_rect()
+        added, removed = self.chunks.take_changes()
+        if layer is None:
+            layer = self.body_layer = pg.Surface(screen_rect.size).convert()
+            self.draw_body_layer_area(screen_rect)
+        else:
+            dx = self.body_layer_camera.x - self.camera.x
+            dy = self.body_layer_camera.y - self.camera.y
+            if abs(dx) >= screen_rect.width or abs(dy) >= screen_rect.height:
+                self.draw_body_layer_area(screen_rect)
+            elif dx or dy:
+                layer.scroll(dx, dy)
+                # Redraw the strips that scrolled into view
+                if dx > 0:
+                    self.draw_body_layer_area(pg.Rect(0, 0, dx, screen_rect.height))
+                elif dx < 0:
+                    self.draw_body_layer_area(pg.Rect(screen_rect.width + dx, 0, -dx, screen_rect.height))
+                if dy > 0:
+                    self.draw_body_layer_area(pg.Rect(0, 0, screen_rect.width, dy))
+                elif dy < 0:
+                    self.draw_body_layer_area(pg.Rect(0, screen_rect.height + dy, screen_rect.width, -dy))
+            # Removed segments are drawn over with the background first, in case a segment was added on the same cell.
+            # Cells are clipped to the layer, fill() doesn't clip rects sticking out above or left of a surface
+            for x, y in removed:
+                layer.fill(self.background_color, self.cell_rect(x, y).clip(screen_rect))
+            for segment in added:
+                if segment in self.chunks:
+                    layer.blit(self.chunks.chunks[self.chunks.members[segment]][segment],
+                               self.cell_rect(segment.x, segment.y))
+        self.body_layer_camera = self.camera.copy()
+        self.chunks.track_changes = True
+
+        self.program_surface.blit(layer, (0, 0))
+        self.draw_apple()
+        self.draw_score()
+        # The snake is drawn on top of the score, so the segments under it are blitted again
+        board_area = self.score_rect.move(self.camera.topleft)
+        block_size = self.block_size
+        self.program_surface.set_clip(self.score_rect)
+        for segment, sprite in self.chunks.in_cells(board_area.left // block_size, board_area.top // block_size,
+                                                    (board_area.right - 1) // block_size + 1,
+                                                    (board_area.bottom - 1) // block_size + 1):
+            self.program_surface.blit(sprite, self.cell_rect(segment.x, segment.y))
+        self.program_surface.set_clip(None)
+        self.draw_snake_ends()
+        return [screen_rect]
+
+    def draw_body_layer_area(self, area):
+        """
+        Function to draw the background and the body segments in part of the body layer,
+        see draw_following_frame()
+        Parameters:
+            area (Rect): The part of the layer to draw, in screen coordinates
+        """
+        layer = self.body_layer
+        layer.set_clip(area)
+        board_rect = self.board_rect()
+        if not board_rect.contains(area):
+            layer.fill(GREY, area)
+        layer.fill(self.background_color, board_rect.clip(area))
+        block_size = self.block_size
+        offset_x = -self.camera.x
+        offset_y = -self.camera.y
+        board_area = area.move(self.camera.topleft)
+        cells = (max(0, board_area.left // block_size), max(0, board_area.top // block_size),
+                 min(self.state.columns, (board_area.right - 1) // block_size + 1),
+                 min(self.state.rows, (board_area.bottom - 1) // block_size + 1))
+        if cells[0] < cells[2] and cells[1] < cells[3]:
+            for segment, sprite in self.chunks.in_cells(*cells):
+                layer.blit(sprite, (segment.x * block_size + offset_x, segment.y * block_size + offset_y))
+        layer.set_clip(None)
+
+    def board_rect(self):
+        """
+        Function to return the rect of the whole board on the screen, taking the camera into account
+        """
+        return pg.Rect(-self.camera.x, -self.camera.y,
+                       self.state.columns * self.block_size, self.state.rows * self.block_size)
+
+    def cell_rect(self, x, y):
+        """
+        Function to return the rect of a cell of the board on the screen, taking the camera into account
+        Parameters:
+            x (int): The column of the cell
+            y (int): The row of the cell
+        """
+        block_size = self.block_size
+        return pg.Rect(x * block_size - self.camera.x, y * block_size - self.camera.y, block_size, block_size)
+
+    def visible_cells(self):
+        """
+        Function to return the range of cells in view of the camera as a tuple of
+        (left, top, right, bottom), where right and bottom are exclusive
+        """
+        block_size = self.block_size
+        camera = self.camera
+        return (max(0, camera.left // block_size), max(0, camera.top // block_size),
+                min(self.state.columns, (camera.right - 1) // block_size + 1),
+                min(self.state.rows, (camera.bottom - 1) // block_size + 1))
+
+    def update_camera(self, recenter=False):
+        """
+        Function to move the camera to center the head when the head comes within CAMERA_MARGIN cells
+        of the edge of the window, or on every frame if camera_follow is set. The camera never shows more
+        outside the board than it has to, a board smaller than the window is centered. Returns True if the camera moved
+        Parameters:
+            recenter (bool): If True, center the head even if it is not near the edge. Defaults to False
+        """
+        block_size = self.block_size
+        segments = self.state.body.segments
+        head = segments[-1]
+        head_rect = pg.Rect(head.x * block_size, head.y * block_size, block_size, block_size)
+        if self.camera_follow:
+            # Follow the head as it is drawn, part way between the neck and its cell
+            neck = segments[-2]
+            dx = head.x - neck.x
+            dy = head.y - neck.y
+            if len(segments) > 2 and self.render_alpha < 1 and abs(dx) + abs(dy) == 1:
+                offset = round(self.render_alpha * block_size)
+                head_rect.topleft = (neck.x * block_size + dx * offset, neck.y * block_size + dy * offset)
+            recenter = True
+        margin = CAMERA_MARGIN * block_size
+        if not recenter and self.camera.inflate(-2 * margin, -2 * margin).contains(head_rect):
+            return False
+        camera = self.camera.copy()
+        camera.center = head_rect.center
+        camera.clamp_ip(pg.Rect(0, 0, self.state.columns * block_size, self.state.rows * block_size))
+        if camera == self.camera:
+            return False
+        self.camera = camera
+        return True
+
+    def build_sprite_atlas(self):
+        """
+        Function to create the sprite atlas, called once on startup.
+        Returns a SpriteAtlas, which loads every sprite and its four rotations the first time it is used
+        """
+        return SpriteAtlas(self.block_size)
 
     def text_objects(self, text, color, size):
         """
-        Function to a text object and return the text object and its bounding rectangle
+        Function to a text object and return the text object and its bounding rectangle.
+        Text surfaces come from the text cache, so repeated text is only rendered once
         Parameters:
             text (str): The text to transform into a text object
             color (tup): A tuple of the int values of the desired RGB colors
             size (str): Determines the size of the font, either 'small', 'med' or 'large'
         """
-        if size == "small":
-            text_surface = self.smallfont.render(text, True, color) # render message, True (for anti-aliasing), color
-        elif size == "med":
-            text_surface = self.medfont.render(text, True, color) # render message, True (for anti-aliasing), color
-        elif size == "large":
-            text_surface = self.largefont.render(text, True, color) # render message, True (for anti-aliasing), color
+        text_surface = self.text_cache.render(text, color, size)
         return text_surface, text_surface.get_rect()
 
     def center_msg_to_screen(self, msg, color, y_displace=0, size="small", show_indicator=False, indicator_offset=-50):
@@ -689,102 +1526,437 @@ class Snake():
         indicator = self.text_objects(">", self.text_color_normal, size)[0] # first entry of (surface, rect) tuple
         self.program_surface.blit(indicator, [text_rect.x + offset, text_rect.y])
 
+    def center_indicator_to_screen(self, msg, y_displace=0, size="small", indicator_offset=-50):
+        """
+        Function to print only the indicator next to a centered message that is already on the screen,
+        for example as part of a menu background
+        Parameters:
+            msg (str): The message next to which the indicator should appear
+            y_displace (int): Vertical displacement of the message relative to the center. Defaults to 0
+            size (str): The size of the font of the message, either 'small', 'med' or 'large'. Defaults to 'small'
+            indicator_offset (int): Determine horiontal offset of the indicator to the message
+        """
+        text_rect = self.text_objects(msg, self.text_color_normal, size)[1]
+        text_rect.center = (DISPLAY_WIDTH//2, DISPLAY_HEIGHT//2 + y_displace)
+        self.indicator_to_screen(text_rect, size, indicator_offset)
+
+    def draw_menu_background(self, menu, draw_static, page=0):
+        """
+        Function to draw the static layer of a menu. The layer is drawn once per menu, page and color scheme,
+        after that a copy of the result is blitted to the screen
+        Parameters:
+            menu (str): The name of the menu
+            draw_static (callable): Function drawing the static layer of the menu onto the screen
+            page (int): The page of the menu, for menus with multiple pages. Defaults to 0
+        """
+        key = (menu, self.dark_mode, page)
+        background = self.menu_backgrounds.get(key)
+        if background is None:
+            draw_static()
+            self.menu_backgrounds[key] = self.program_surface.copy()
+        else:
+            self.program_surface.blit(background, (0, 0))
+
+    def invalidate_menu_background(self, menu):
+        """
+        Function to throw away the static layers of a menu, so they are drawn again with up to date content
+        Parameters:
+            menu (str): The name of the menu
+        """
+        for key in [key for key in self.menu_backgrounds if key[0] == menu]:
+            del self.menu_backgrounds[key]
+
+    def wait_for_events(self, timeout=MENU_EVENT_TIMEOUT):
+        """
+        Function used by the menus to sleep until an event arrives, instead of polling at a fixed fps.
+        Returns a list of all pending events, which is empty if none arrived within the timeout
+        Parameters:
+            timeout (int): The maximum time to wait in ms. Defaults to MENU_EVENT_TIMEOUT
+        """
+        event = pg.event.wait(timeout)
+        if event.type == pg.NOEVENT:
+            return []
+        return [event] + pg.event.get()
+
     def game_loop(self):
         """
         The game loop of the snake game. All in-game events such as direction are handled here,
         as well as calling for a new apple location etc.
         """
         self.in_game = True
+        self.state.boundaries = self.boundaries # settings may have changed since the state was created
+        # The game ticks at game_fps, frames are drawn at render_fps. Time since the last tick is accumulated
+        # and for every tick_ms of it a tick is done, the remainder determines how far the ends are drawn
+        tick_ms = 1000 / self.game_fps
+        accumulator = tick_ms # take the first step straight away
+        # Menus draw over the in-game screen, so after every menu the whole screen is redrawn once
+        full_redraw = True
+        self.clock.tick() # don't count the time spent in menus
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.begin_frame()
         while self.in_game:
-            # Moved event handling down so screen isn't redrawn when returning to main menu from pause menu
-
-            self.lead_x += self.lead_x_change
-            self.lead_y += self.lead_y_change
-
-            # Add boundaries to the game. If x or y is outside the game window, game over
-            if self.lead_x >= DISPLAY_WIDTH or self.lead_x < 0 or self.lead_y >= DISPLAY_HEIGHT or self.lead_y < 0:
-                if self.boundaries:
-                    self.game_over = True
-                elif not self.boundaries:
-                    if self.lead_x >= DISPLAY_WIDTH:
-                        self.lead_x = 0
-                    elif self.lead_x < 0:
-                        self.lead_x = DISPLAY_WIDTH - self.block_size
-                    elif self.lead_y >= DISPLAY_HEIGHT:
-                        self.lead_y = 0
-                    elif self.lead_y < 0:
-                        self.lead_y = DISPLAY_HEIGHT-self.block_size
-            
-            snake_head = [self.lead_x, self.lead_y, self.head_rotation]
-            self.snake_list.append(snake_head)
-            
-            if len(self.snake_list) >  self.snake_length:
-                del self.snake_list[0] # remove the first (oldest) element of the list
-            
-            # If the head overlaps with any other segment of the snake, game over
-            for segment in self.snake_list[:-1]:
-                if segment[:2] == snake_head[:2]:
-                    self.game_over = True
-            
-            self.draw_in_game_screen()
-
-            # Collision checking for grid-based and same-size apple/snake
-            if snake_head[:2] == [self.apple_x, self.apple_y]:
-                self.generate_apple()
-                self.snake_length += 1
-                self.current_score += 1
+            for event in pg.event.get(): # gets all events (mouse movenent, key press/release, quit etc)
+                if event.type == pg.KEYDOWN:
+                    if event.key in KEY_DIRECTIONS and self.controller is None:
+                        # Buffer direction changes, so several key presses within a tick are all used
+                        if len(self.input_queue) < INPUT_QUEUE_SIZE:
+                            self.input_queue.append( (KEY_DIRECTIONS[event.key], perf_counter()) )
+                    elif event.key == pg.K_p or event.key == pg.K_ESCAPE:
+                        self.pause_menu()
+                        full_redraw = True
+                        self.clock.tick() # don't count the time spent paused
+                        if profiler is not None:
+                            profiler.begin_frame()
+                    elif event.key == pg.K_F3 and profiler is not None:
+                        self.show_profile_overlay = not self.show_profile_overlay
+                        full_redraw = True
+                elif event.type == pg.QUIT:
+                    self.shutdown()
+            # Don't redraw the screen when returning to the main menu from the pause menu
+            if not self.in_game:
+                break
+            if profiler is not None:
+                profiler.lap("events")
 
-            # Non grid-based collision checking for any size snake/apple
-            # if (self.lead_x + self.block_size > self.apple_x and self.lead_y + self.block_size > self.apple_y
-            #     and self.lead_x < self.apple_x + self.block_size and self.lead_y < self.apple_y + self.block_size):
-            #     self.generate_apple()
-            #     self.snake_length += 1
-            #     self.score += 1
+            # Move the snake, handle collisions and eat the apple, once for every tick that is due
+            old_cells = self.changing_cells()
+            old_score = self.state.score
+            ticks = 0
+            while accumulator >= tick_ms and ticks < MAX_TICKS_PER_FRAME and not self.state.game_over:
+                tail = self.state.body.tail()
+                self.last_tail = (tail.x, tail.y)
+                if self.controller is not None:
+                    # The controller presses its key right before the tick, through the same queue as the player
+                    direction = self.controller(self.state)
+                    if direction is not None:
+                        self.input_queue.append( (direction, perf_counter()) )
+                self.recorder.step(self.next_direction())
+                self.update_chunks()
+                accumulator -= tick_ms
+                ticks += 1
+            if self.state.game_over:
+                accumulator = 0
+            elif accumulator >= tick_ms:
+                # Rendering is too slow to keep up, drop the ticks that can't be caught up on
+                dropped = int(accumulator // tick_ms)
+                self.frame_stats.dropped_ticks += dropped
+                accumulator -= dropped * tick_ms
+            self.game_over = self.state.game_over
+            self.render_alpha = 1 if self.game_over else accumulator / tick_ms
+            if profiler is not None:
+                profiler.lap("simulation")
 
-            pg.display.update() # update the display
-            self.clock.tick(self.game_fps) # tick(x) for a game of x frames per second, put this after display.update()
+            if self.camera_follow:
+                # The camera moves on every frame, so the whole screen is updated
+                self.update_camera()
+                if full_redraw:
+                    self.body_layer = None
+                    full_redraw = False
+                rects = self.draw_following_frame()
+            elif (ticks and self.update_camera()) or full_redraw or ticks > 1:
+                # Redraw everything when the camera moved, after a menu, or when the snake moved more than a cell
+                rects = self.redraw_in_game_screen()
+                full_redraw = False
+            else:
+                # Only redraw and update the cells that changed since the last frame
+                rects = self.draw_in_game_changes(old_cells, old_score)
+            if profiler is not None:
+                if self.show_profile_overlay:
+                    rects.append(self.draw_profile_overlay())
+                profiler.lap("draw")
+            pg.display.update(rects)
+            if profiler is not None:
+                profiler.lap("display")
+            frame_time = self.clock.tick(self.render_fps) # put this after display.update()
+            accumulator += frame_time
+            self.frame_stats.add_frame(frame_time, ticks)
+            if profiler is not None:
+                profiler.lap("sleep")
+                profiler.end_frame(ticks)
 
-            if self.game_over:  
+            if self.game_over:
+                if self.print_frame_stats:
+                    print(self.frame_stats.summary())
+                if profiler is not None:
+                    print(profiler.summary())
+                    self.save_profile_trace()
+                self.save_replay()
+                self.discard_saved_game()
                 self.game_over_menu()
-            
-            for event in pg.event.get(): # gets all events (mouse movenent, key press/release, quit etc)
+                full_redraw = True
+                accumulator = tick_ms
+                self.clock.tick()
+                if profiler is not None:
+                    profiler.begin_frame()
+
+    def versus_loop(self):
+        """
+        The game loop of a game against num_bots bot snakes on the same board, see multiplayer.py.
+        The player plays the first snake with the arrow keys and the bots are played by greedy_bot().
+        Every tick the in-game screen is drawn following the snake of the player, with the bots and all apples
+        on top of it. These games have no replay, save game or highscore. The game ends when the snake of the
+        player dies or the board is too full for another apple, P or Esc returns to the main menu straight away
+        """
+        try:
+            multi = MultiGameState(self.columns, self.rows, self.num_bots + 1, boundaries=self.boundaries,
+                                   rng=Random(getrandbits(63)))
+        except ValueError as e:
+            print(f"{e}: Could not start a game against {self.num_bots} bots")
+            return
+        player = multi.snakes[0]
+        self.state = VersusState(multi)
+        tail = player.body.tail()
+        self.last_tail = (tail.x, tail.y)
+        self.render_alpha = 1
+        self.update_camera(recenter=True)
+        self.rebuild_chunks()
+        self.input_queue = deque()
+        playing = True
+        while playing:
+            for event in pg.event.get():
                 if event.type == pg.KEYDOWN:
-                    if event.key == pg.K_LEFT:
-                        # If moving right, don't allow the user to move left, instead 
-                        # break out of loop and get next event
-                        if self.lead_x_change == self.block_size:
-                            break
-                        self.lead_x_change = -self.block_size
-                        self.lead_y_change = 0
-                        # Rotate head to face the right way
-                        self.head_rotation = 90
-                        self.head = self.rotate(self.head_img, self.head_rotation)
-                    elif event.key == pg.K_RIGHT:
-                        if self.lead_x_change == -self.block_size: # disallow running into self
-                            break
-                        self.lead_x_change = self.block_size
-                        self.lead_y_change = 0
-                        self.head_rotation = 270
-                        self.head = self.rotate(self.head_img, self.head_rotation)
-                    elif event.key == pg.K_UP:
-                        if self.lead_y_change == self.block_size: # disallow running into self
-                            break
-                        self.lead_y_change = -self.block_size
-                        self.lead_x_change = 0
-                        self.head_rotation = 0
-                        self.head = self.head_img
-                    elif event.key == pg.K_DOWN:
-                        if self.lead_y_change == -self.block_size: # disallow running into self
-                            break
-                        self.lead_y_change = self.block_size
-                        self.lead_x_change = 0
-                        self.head_rotation = 180
-                        self.head = self.rotate(self.head_img, self.head_rotation)
+                    if event.key in KEY_DIRECTIONS and len(self.input_queue) < INPUT_QUEUE_SIZE:
+                        self.input_queue.append( (KEY_DIRECTIONS[event.key], perf_counter()) )
                     elif event.key == pg.K_p or event.key == pg.K_ESCAPE:
-                        self.pause_menu()
+                        playing = False
+                elif event.type == pg.QUIT:
+                    self.shutdown()
+            if not playing:
+                break
+            tail = player.body.tail()
+            self.last_tail = (tail.x, tail.y)
+            directions = [self.next_direction()] + [greedy_bot(multi, snake) for snake in multi.snakes[1:]]
+            multi.step(directions)
+            if player.alive:
+                self.update_chunks()
+                self.update_camera()
+            else:
+                # The tail of a snake that dies is already gone, while its head never moved
+                self.rebuild_chunks()
+                playing = False
+            if multi.game_over:
+                playing = False
+            self.draw_in_game_screen()
+            self.draw_other_snakes([snake.body for snake in multi.snakes], [snake.alive for snake in multi.snakes],
+                                   multi.apples, 0)
+            if not playing:
+                self.center_msg_to_screen("Game over", self.text_color_emphasis_bad, y_displace=-50, size="large")
+                self.center_msg_to_screen("Press enter to return to the main menu", self.text_color_normal, 50,
+                                          size="med")
+            pg.display.update()
+            self.clock.tick(self.game_fps)
+        if multi.game_over or not player.alive:
+            self.wait_for_enter()
+        # Continue with a normal game state, for the next game and for the pause and game over menus
+        self.reset_game_variables()
+
+    def wait_for_enter(self):
+        """
+        Function to wait until enter, P or Esc is pressed
+        """
+        while True:
+            for event in self.wait_for_events():
+                if event.type == pg.QUIT:
+                    self.shutdown()
+                elif event.type == pg.KEYDOWN and event.key in (pg.K_RETURN, pg.K_p, pg.K_ESCAPE):
+                    return
+
+    def enable_profiling(self, overlay=True, trace_file=None):
+        """
+        Function to start profiling the phases of every frame of the game loop
+        Parameters:
+            overlay (bool): If True, show the frame rate and the time of every phase in game. Defaults to True.
+                The overlay can be toggled in game with F3
+            trace_file (str): If given, every frame is traced and exported to this file after every game,
+                as CSV if it ends with .csv and as JSON otherwise. Defaults to None
+        """
+        self.profiler = FrameProfiler(trace=trace_file is not None)
+        self.profiler.instrument(self.state)
+        self.show_profile_overlay = overlay
+        self.profile_trace_file = trace_file
+
+    def save_profile_trace(self):
+        """
+        Function to export the trace of the profiler to profile_trace_file, if tracing is enabled
+        """
+        if self.profiler is None or self.profile_trace_file is None:
+            return
+        try:
+            self.profiler.export(self.profile_trace_file)
+        except OSError as e:
+            print(f"{e}: Could not save the profile trace")
+
+    def draw_profile_overlay(self):
+        """
+        Function to draw the profiler overlay in the top right corner of the in-game screen.
+        The text is only rendered again every PROFILE_OVERLAY_INTERVAL ms, in between the rendered overlay is blitted.
+        Returns the rect of the overlay
+        """
+        now = pg.time.get_ticks()
+        if self.profile_overlay is None or now - self.profile_overlay_time >= PROFILE_OVERLAY_INTERVAL:
+            font = self.text_cache.fonts["tiny"]
+            # Rendered without the text cache, the numbers change all the time
+            lines = [font.render(line, True, self.text_color_normal) for line in self.profiler.overlay_lines()]
+            # The overlay never gets narrower, so a shorter text never leaves parts of the previous overlay
+            width = max(line.get_width() for line in lines) + 10
+            if self.profile_overlay is not None:
+                width = max(width, self.profile_overlay.get_width())
+            height = sum(line.get_height() for line in lines) + 10
+            self.profile_overlay = pg.Surface((width, height)).convert()
+            self.profile_overlay.fill(self.background_color)
+            pg.draw.rect(self.profile_overlay, self.text_color_normal, self.profile_overlay.get_rect(), 1)
+            y_coord = 5
+            for line in lines:
+                self.profile_overlay.blit(line, (5, y_coord))
+                y_coord += line.get_height()
+            self.profile_overlay_time = now
+        rect = self.profile_overlay.get_rect(topright=(self.program_surface.get_width(), 0))
+        self.program_surface.blit(self.profile_overlay, rect)
+        return rect
+
+    def save_replay(self):
+        """
+        Function to save the replay of the game that just ended to LAST_REPLAY_FILE
+        """
+        try:
+            self.recorder.replay().save(LAST_REPLAY_FILE)
+        except OSError as e:
+            print(f"{e}: Could not save the replay")
+
+    def save_game(self):
+        """
+        Function to save the game in progress to SAVE_GAME_FILE, so it can be resumed from the main menu.
+        Returns True if the game was saved
+        """
+        try:
+            savegame.save_game(SAVE_GAME_FILE, self.state, self.recorder)
+        except OSError as e:
+            print(f"{e}: Could not save the game")
+            return False
+        self.game_saved = True
+        return True
+
+    def resume_game(self):
+        """
+        Function to load the game saved in SAVE_GAME_FILE. The game keeps the boundaries it was played with
+        until the game is closed, the saved settings are left as they are.
+        Returns True if there was a game to resume, game_loop() then continues it
+        """
+        try:
+            state, recorder = savegame.load_game(SAVE_GAME_FILE)
+        except FileNotFoundError:
+            return False
+        except (OSError, savegame.SaveGameError) as e:
+            print(f"{e}: Could not resume the saved game")
+            return False
+        self.boundaries = state.boundaries # game_loop() plays with the boundaries of the settings
+        self.use_state(state, recorder)
+        self.game_saved = True
+        return True
+
+    def discard_saved_game(self):
+        """
+        Function to delete SAVE_GAME_FILE once the game it holds is over, so a finished game can't be resumed.
+        A saved game other than the current one is kept
+        """
+        if not self.game_saved:
+            return
+        try:
+            os.remove(SAVE_GAME_FILE)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"{e}: Could not delete the saved game")
+        self.game_saved = False
+
+    def play_replay(self, replay):
+        """
+        Function to play back a recorded game at the tick rate of the game.
+        Pressing escape or p stops the playback
+        Parameters:
+            replay (Replay): The replay to play back
+        """
+        self.state = replay.new_state()
+        self.render_alpha = 1 # ticks are drawn as they are, without sliding the ends
+        self.update_camera(recenter=True)
+        self.rebuild_chunks()
+        for direction in replay.directions():
+            for event in pg.event.get():
+                if event.type == pg.KEYDOWN and event.key in (pg.K_p, pg.K_ESCAPE):
+                    self.reset_game_variables()
+                    return
                 elif event.type == pg.QUIT:
                     self.shutdown()
+            tail = self.state.body.tail()
+            self.last_tail = (tail.x, tail.y)
+            self.state.step(direction)
+            self.update_chunks()
+            self.update_camera()
+            self.draw_in_game_screen()
+            pg.display.update()
+            self.clock.tick(self.game_fps)
+        print(f"Replay finished with score {self.state.score} after {self.state.ticks} ticks"
+              + (f", expected score {replay.score}" if self.state.score != replay.score else ""))
+        self.reset_game_variables()
+
+    def next_direction(self):
+        """
+        Function called once per tick to take the next valid direction from the input queue.
+        Directions that would reverse the snake into itself, or that it is already moving in, are skipped.
+        Returns None if there is no valid direction in the queue
+        """
+        while self.input_queue:
+            direction, pressed = self.input_queue.popleft()
+            if self.state.is_turn(direction):
+                self.frame_stats.add_input_latency((perf_counter() - pressed) * 1000)
+                return direction
+        return None
+
+    def display_refresh_rate(self):
+        """
+        Function to return the refresh rate of the display, used as the in-game render_fps.
+        Defaults to 60 when it can not be determined
+        """
+        try:
+            refresh_rates = pg.display.get_desktop_refresh_rates()
+        except (AttributeError, pg.error):
+            refresh_rates = []
+        return refresh_rates[0] if refresh_rates and refresh_rates[0] > 0 else 60
 
 if __name__ == "__main__":
-    snek = Snake()
+    parser = argparse.ArgumentParser(description="DangerNoodle - A very original game by Jasper")
+    parser.add_argument("--frame-stats", action="store_true", help="print frame pacing statistics after every game")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="print the time spent in every phase of starting the game, up to the first menu")
+    parser.add_argument("--columns", type=int, default=None, help="width of the board in cells")
+    parser.add_argument("--rows", type=int, default=None, help="height of the board in cells")
+    parser.add_argument("--block-size", type=int, default=20, help="size of a cell in pixels")
+    parser.add_argument("--follow-camera", action="store_true", help="keep the head in the center of the screen")
+    parser.add_argument("--profile", action="store_true",
+                        help="time every phase of the game loop, show an overlay (toggle with F3) and print a summary after every game")
+    parser.add_argument("--profile-trace", metavar="FILE",
+                        help="with --profile, export the time of every frame to FILE, as CSV if it ends with .csv and JSON otherwise")
+    parser.add_argument("--autopilot", action="store_true", help="let the computer play, for demos and attract mode")
+    parser.add_argument("--replay", metavar="FILE", help=f"play back a replay, such as {LAST_REPLAY_FILE}")
+    parser.add_argument("--bots", type=int, default=0, help="play against this many bot snakes on the same board")
+    args = parser.parse_args()
+    snek = Snake(args.columns, args.rows, args.block_size)
+    snek.print_frame_stats = args.frame_stats
+    snek.camera_follow = args.follow_camera
+    snek.num_bots = args.bots
+    if args.autopilot:
+        snek.controller = PathfindingController()
+    if args.profile:
+        snek.enable_profiling(trace_file=args.profile_trace)
+    if args.profile_startup:
+        start = perf_counter()
+        loading = sum(snek.startup_profile.phases.values())
+        snek.draw_main_menu(0)
+        # Fonts loaded for the first frame are already counted, only add the time spent drawing
+        loading = sum(snek.startup_profile.phases.values()) - loading
+        snek.startup_profile.add("first frame", perf_counter() - start - loading)
+        print(snek.startup_profile.summary())
+    if args.replay:
+        snek.play_replay(Replay.load(args.replay))
     snek.main_menu()
\ No newline at end of file
@@ -0,0 +1,500 @@
+"""
+Pure-Python building blocks for the DangerNoodle game rules.
+Nothing in this module depends on pygame, so it can be used without a window.
+Positions on the board are grid cells, stored as a single index: cell = y * columns + x
+"""
+
+import random
+from array import array
+from bisect import bisect_right
+from collections import deque
+from itertools import accumulate
+
+# Directions are stored as the rotation of the head sprite, in degrees anti-clockwise from up
+UP = 0
+LEFT = 90
+DOWN = 180
+RIGHT = 270
+# Change in (x, y) cell coordinates for a single step in each direction
+DIRECTION_STEPS = {UP: (0, -1), LEFT: (-1, 0), DOWN: (0, 1), RIGHT: (1, 0)}
+OPPOSITE_DIRECTIONS = {UP: DOWN, LEFT: RIGHT, DOWN: UP, RIGHT: LEFT}
+# Boards with more cells than this use a SparseOccupancyGrid, which stores a bit per cell instead of a count
+DENSE_GRID_MAX_CELLS = 1 << 20
+# An OccupancyGrid counts the free cells per block of FREE_BLOCK_SIZE cells, to find the n-th free cell quickly
+FREE_BLOCK_BITS = 10
+FREE_BLOCK_SIZE = 1 << FREE_BLOCK_BITS
+# Random cells a SparseOccupancyGrid tries for a free cell before it falls back to scanning the board
+SPARSE_SPAWN_ATTEMPTS = 64
+
+
+def nth_free_cell(counts, block_free, rank):
+    """
+    Function to return the free cell with the given rank, counting the free cells in the order of the board.
+    The block holding it is found from the free cells per block, then the cell by halving the block
+    until a single cell is left, counting the free cells of a half with bytearray.count()
+    Parameters:
+        counts (bytearray): The amount of segments on every cell, see OccupancyGrid
+        block_free (array): The amount of free cells in every block of FREE_BLOCK_SIZE cells
+        rank (int): The rank of the cell, less than the amount of free cells
+    """
+    totals = list(accumulate(block_free))
+    block = bisect_right(totals, rank)
+    if block:
+        rank -= totals[block - 1]
+    start = block << FREE_BLOCK_BITS
+    end = min(start + FREE_BLOCK_SIZE, len(counts))
+    while end - start > 1:
+        middle = (start + end) // 2
+        free = counts.count(0, start, middle)
+        if rank < free:
+            end = middle
+        else:
+            rank -= free
+            start = middle
+    return start
+
+
+class OccupancyGrid():
+    """
+    Keeps track of which cells of the board are occupied by the snake.
+    The grid is updated incrementally when the head is pushed and the tail is popped,
+    so checking a cell is O(1). The free cells of every block of FREE_BLOCK_SIZE cells are counted alongside,
+    so a random free cell is picked by its rank among the free cells in the order of the board.
+    Which cell is picked only depends on which cells are occupied, not on the order they were occupied in,
+    so a grid restored from the cells of the snake spawns the same apples as the grid it was saved from.
+    Usage:
+    grid = OccupancyGrid(40, 30)
+    grid.occupy(grid.cell(20, 15))
+    apple = grid.random_free_cell()
+    """
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+        size = columns * rows
+        # Amount of segments on every cell. Usually 0 or 1, but the head can overlap the body on death
+        self.counts = bytearray(size)
+        # Free cells per block of FREE_BLOCK_SIZE cells, the last block can be smaller
+        self.block_free = array('l', (min(FREE_BLOCK_SIZE, size - start) for start in range(0, size, FREE_BLOCK_SIZE)))
+        self.free = size
+
+    def cell(self, x, y):
+        """
+        Function to convert a column and row to a cell index
+        Parameters:
+            x (int): The column of the cell
+            y (int): The row of the cell
+        """
+        return y * self.columns + x
+
+    def in_bounds(self, x, y):
+        """
+        Function to check if a column and row lie on the board
+        Parameters:
+            x (int): The column of the cell
+            y (int): The row of the cell
+        """
+        return 0 <= x < self.columns and 0 <= y < self.rows
+
+    def is_occupied(self, cell):
+        """
+        Function to check in O(1) if a cell is occupied
+        Parameters:
+            cell (int): The index of the cell
+        """
+        return self.counts[cell] != 0
+
+    def occupy(self, cell):
+        """
+        Function to mark a cell as occupied, called when the head is pushed
+        Parameters:
+            cell (int): The index of the cell
+        """
+        self.counts[cell] += 1
+        if self.counts[cell] == 1:
+            self.block_free[cell >> FREE_BLOCK_BITS] -= 1
+            self.free -= 1
+
+    def release(self, cell):
+        """
+        Function to mark a cell as no longer occupied by a segment, called when the tail is popped
+        Parameters:
+            cell (int): The index of the cell
+        """
+        self.counts[cell] -= 1
+        if self.counts[cell] == 0:
+            self.block_free[cell >> FREE_BLOCK_BITS] += 1
+            self.free += 1
+
+    def free_count(self):
+        """
+        Function to return the amount of unoccupied cells
+        """
+        return self.free
+
+    def random_free_cell(self, rng=random):
+        """
+        Function to pick a random unoccupied cell, see nth_free_cell().
+        Returns None if the board is completely filled
+        Parameters:
+            rng (Random): The random number generator to use. Defaults to the random module
+        """
+        if not self.free:
+            return None
+        return nth_free_cell(self.counts, self.block_free, rng.randrange(self.free))
+
+    @classmethod
+    def restore(cls, columns, rows, cells):
+        """
+        Function to create a grid with the cells of a saved game. The free cells are counted from scratch,
+        as the order the cells were occupied in doesn't matter
+        Parameters:
+            columns (int): The width of the board in cells
+            rows (int): The height of the board in cells
+            cells (iterable): The cell of every segment
+        """
+        grid = cls(columns, rows)
+        counts = grid.counts
+        for cell in cells:
+            counts[cell] += 1
+        block_free = grid.block_free
+        for block in range(len(block_free)):
+            start = block << FREE_BLOCK_BITS
+            block_free[block] = counts.count(0, start, start + FREE_BLOCK_SIZE)
+        grid.free = sum(block_free)
+        return grid
+
+
+class SparseOccupancyGrid(OccupancyGrid):
+    """
+    Occupancy grid for huge boards, storing a single bit per cell, so a 10000x10000 board takes 12.5MB.
+    A cell is either free or occupied, a head overlapping the body on death is not counted twice.
+    Random free cells are found by trying random cells, which almost always succeeds on the first try
+    unless the snake covers most of the board, in which case the board is scanned
+    Usage:
+    grid = SparseOccupancyGrid(10000, 10000)
+    grid.occupy(grid.cell(5000, 5000))
+    apple = grid.random_free_cell()
+    """
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+        self.size = columns * rows
+        self.occupied = 0
+        self.bits = bytearray((self.size + 7) // 8)
+        # Mark the padding bits after the last cell as occupied, so scanning never returns them
+        for cell in range(self.size, len(self.bits) * 8):
+            self.bits[cell >> 3] |= 1 << (cell & 7)
+
+    def is_occupied(self, cell):
+        """
+        Function to check in O(1) if a cell is occupied
+        Parameters:
+            cell (int): The index of the cell
+        """
+        return self.bits[cell >> 3] & (1 << (cell & 7)) != 0
+
+    def occupy(self, cell):
+        """
+        Function to mark a cell as occupied, called when the head is pushed
+        Parameters:
+            cell (int): The index of the cell
+        """
+        mask = 1 << (cell & 7)
+        if not self.bits[cell >> 3] & mask:
+            self.bits[cell >> 3] |= mask
+            self.occupied += 1
+
+    def release(self, cell):
+        """
+        Function to mark a cell as no longer occupied, called when the tail is popped
+        Parameters:
+            cell (int): The index of the cell
+        """
+        mask = 1 << (cell & 7)
+        if self.bits[cell >> 3] & mask:
+            self.bits[cell >> 3] &= ~mask
+            self.occupied -= 1
+
+    def free_count(self):
+        """
+        Function to return the amount of unoccupied cells
+        """
+        return self.size - self.occupied
+
+    def random_free_cell(self, rng=random):
+        """
+        Function to pick a random unoccupied cell. Returns None if the board is completely filled
+        Parameters:
+            rng (Random): The random number generator to use. Defaults to the random module
+        """
+        free = self.size - self.occupied
+        if not free:
+            return None
+        bits = self.bits
+        for _ in range(SPARSE_SPAWN_ATTEMPTS):
+            cell = rng.randrange(self.size)
+            if not bits[cell >> 3] & (1 << (cell & 7)):
+                return cell
+        # The board is nearly full, pick the n-th free cell instead
+        target = rng.randrange(free)
+        for idx, byte in enumerate(bits):
+            zeros = 8 - byte.bit_count()
+            if target < zeros:
+                for bit in range(8):
+                    if not byte & (1 << bit):
+                        if not target:
+                            return idx * 8 + bit
+                        target -= 1
+            target -= zeros
+        return None
+
+    @classmethod
+    def restore(cls, columns, rows, cells):
+        """
+        Function to create a grid with the cells of a saved game
+        Parameters:
+            columns (int): The width of the board in cells
+            rows (int): The height of the board in cells
+            cells (iterable): The cell of every segment
+        """
+        grid = cls(columns, rows)
+        bits = grid.bits
+        for cell in cells:
+            bits[cell >> 3] |= 1 << (cell & 7)
+        # Every set bit is occupied, except the padding after the last cell
+        grid.occupied = int.from_bytes(bits, "little").bit_count() - (len(bits) * 8 - grid.size)
+        return grid
+
+
+def make_grid(columns, rows):
+    """
+    Function to create the occupancy grid for a board. Boards up to DENSE_GRID_MAX_CELLS cells get
+    an OccupancyGrid, larger boards a SparseOccupancyGrid, so memory stays at a bit per cell
+    Parameters:
+        columns (int): The width of the board in cells
+        rows (int): The height of the board in cells
+    """
+    if columns * rows <= DENSE_GRID_MAX_CELLS:
+        return OccupancyGrid(columns, rows)
+    return SparseOccupancyGrid(columns, rows)
+
+
+def restore_grid(columns, rows, cells):
+    """
+    Function to create the occupancy grid of a saved game, of the same kind as make_grid() creates for the board
+    Parameters:
+        columns (int): The width of the board in cells
+        rows (int): The height of the board in cells
+        cells (iterable): The cell of every segment
+    """
+    if columns * rows <= DENSE_GRID_MAX_CELLS:
+        return OccupancyGrid.restore(columns, rows, cells)
+    return SparseOccupancyGrid.restore(columns, rows, cells)
+
+
+class Segment():
+    """
+    A single segment of the snake. Uses __slots__ to keep the memory footprint of
+    long snakes small. x and y are in the coordinates of whoever owns the body,
+    rotation is the direction the snake was moving in, in degrees anti-clockwise from up
+    """
+    __slots__ = ("x", "y", "rotation")
+
+    def __init__(self, x, y, rotation):
+        self.x = x
+        self.y = y
+        self.rotation = rotation
+
+    def __repr__(self):
+        return f"Segment({self.x}, {self.y}, {self.rotation})"
+
+
+class SnakeBody():
+    """
+    The body of the snake, stored as a deque of segments ordered from tail to head.
+    Pushing the head and popping the tail are both O(1). The segment popped from the tail
+    can be handed back to push_head() to be reused, so a tick without growth allocates nothing.
+    Usage:
+    body = SnakeBody()
+    body.push_head(0, 0, 180)
+    tail = body.pop_tail()
+    body.push_head(0, 1, 180, tail)
+    """
+    def __init__(self):
+        self.segments = deque()
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    def head(self):
+        """
+        Function to return the head, the newest segment of the snake
+        """
+        return self.segments[-1]
+
+    def tail(self):
+        """
+        Function to return the tail, the oldest segment of the snake
+        """
+        return self.segments[0]
+
+    def push_head(self, x, y, rotation, recycled=None):
+        """
+        Function to add a new head to the snake and return it
+        Parameters:
+            x (int): The x coordinate of the new head
+            y (int): The y coordinate of the new head
+            rotation (int): The rotation of the new head in degrees
+            recycled (Segment): A segment that is no longer in use, to be reused for the new head.
+                Defaults to None, in which case a new segment is created
+        """
+        if recycled is None:
+            segment = Segment(x, y, rotation)
+        else:
+            segment = recycled
+            segment.x = x
+            segment.y = y
+            segment.rotation = rotation
+        self.segments.append(segment)
+        return segment
+
+    def pop_tail(self):
+        """
+        Function to remove the tail of the snake and return it
+        """
+        return self.segments.popleft()
+
+
+class GameState():
+    """
+    The complete state and rules of a single game of snake, without any rendering.
+    Movement, wrapping around or dying on the edges, growth, scoring and apple spawning
+    are all handled by step(), which advances the game by a single tick.
+    All coordinates are grid cells, it is up to the renderer to scale them to pixels.
+    The board can be as large as 10000x10000 cells, memory grows with the length of the snake
+    and a single bit per cell.
+    Usage:
+    state = GameState(40, 30)
+    while state.step(RIGHT):
+        pass
+    print(state.score, state.death_cause)
+    """
+    def __init__(self, columns, rows, boundaries=True, rng=random):
+        """
+        Parameters:
+            columns (int): The width of the board in cells
+            rows (int): The height of the board in cells
+            boundaries (bool): If True, running into the edges is game over. If False, the snake wraps around
+            rng (Random): The random number generator used to spawn apples. Defaults to the random module
+        """
+        self.columns = columns
+        self.rows = rows
+        self.boundaries = boundaries
+        self.rng = rng
+        self.reset()
+
+    def reset(self):
+        """
+        Function to initialize the game state at the start of the game, or reset it on game over
+        """
+        self.game_over = False
+        self.death_cause = None # "wall", "self" or "full" once the game is over
+        self.ticks = 0 # amount of steps taken this game
+        self.direction = DOWN # starting direction is down
+        # initialize snake as size 2 in the center of the board and moving downwards
+        head_x = self.columns // 2
+        head_y = self.rows // 2
+        self.body = SnakeBody()
+        self.body.push_head(head_x, head_y - 1, self.direction)
+        self.body.push_head(head_x, head_y, self.direction)
+        self.snake_length = 2 # max allowed length of the snake
+        self.score = self.snake_length - 2 # score == current length - base length
+        # The occupancy grid mirrors the body, it is updated on every head push and tail pop
+        self.grid = make_grid(self.columns, self.rows)
+        for segment in self.body:
+            self.grid.occupy(self.grid.cell(segment.x, segment.y))
+        self.spawn_apple()
+
+    def spawn_apple(self):
+        """
+        Function to place the apple on a random cell that is not occupied by the snake.
+        If the snake fills the entire board there is nowhere left to put it, which ends the game
+        """
+        cell = self.grid.random_free_cell(self.rng)
+        if cell is None:
+            self.game_over = True
+            self.death_cause = "full"
+            return
+        self.apple_y, self.apple_x = divmod(cell, self.columns)
+
+    def change_direction(self, direction):
+        """
+        Function to change the direction the snake will move in on the next step.
+        Returns False if the change is not allowed because the snake would reverse into itself
+        Parameters:
+            direction (int): One of UP, LEFT, DOWN or RIGHT
+        """
+        if direction == OPPOSITE_DIRECTIONS[self.direction]:
+            return False
+        self.direction = direction
+        return True
+
+    def is_turn(self, direction):
+        """
+        Function to check if moving in a direction changes the course of the snake,
+        meaning it is neither the current direction nor the opposite one, which would reverse into itself
+        Parameters:
+            direction (int): One of UP, LEFT, DOWN or RIGHT
+        """
+        return direction != self.direction and direction != OPPOSITE_DIRECTIONS[self.direction]
+
+    def step(self, direction=None):
+        """
+        Function to advance the game by a single tick. Returns True if the snake is still alive
+        Parameters:
+            direction (int): Optional new direction, see change_direction(). Defaults to None,
+                in which case the snake keeps moving in its current direction
+        """
+        if self.game_over:
+            return False
+        if direction is not None:
+            self.change_direction(direction)
+        self.ticks += 1 # the step that ends the game counts as well
+        columns = self.columns
+        dx, dy = DIRECTION_STEPS[self.direction]
+        head = self.body.head()
+        x = head.x + dx
+        y = head.y + dy
+
+        # If the head is outside the board, either game over or wrap around to the other side
+        if x < 0 or x >= columns or y < 0 or y >= self.rows:
+            if self.boundaries:
+                self.game_over = True
+                self.death_cause = "wall"
+                return False
+            x %= columns
+            y %= self.rows
+
+        # Pop the tail first when the snake is at max length, so its segment can be reused for the new head
+        grid = self.grid
+        old_tail = None
+        if len(self.body) >= self.snake_length:
+            old_tail = self.body.pop_tail()
+            grid.release(old_tail.y * columns + old_tail.x)
+        self.body.push_head(x, y, self.direction, old_tail)
+
+        # If the head overlaps with any other segment of the snake, game over
+        head_cell = y * columns + x
+        if grid.is_occupied(head_cell):
+            self.game_over = True
+            self.death_cause = "self"
+        grid.occupy(head_cell)
+
+        if not self.game_over and x == self.apple_x and y == self.apple_y:
+            self.snake_length += 1
+            self.score += 1
+            self.spawn_apple()
+        return not self.game_over
@@ -0,0 +1,191 @@
+"""
+Leaderboard holding every submitted score, stored in an SQLite database.
+Scores live in an indexed table, so the top of the leaderboard, a page of it and the best score
+of a player are all index lookups, no matter how many scores are stored. The rank of a score is
+answered in O(log n) by a Fenwick tree over the amount of scores per score value, which is kept
+in memory and built at startup from a small table holding those counts.
+Usage:
+leaderboard = Leaderboard("leaderboard.db")
+leaderboard.add_score("Jasper", 12)
+print(leaderboard.top(5), leaderboard.rank(12), leaderboard.best("Jasper"))
+leaderboard.close()
+"""
+
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (id INTEGER PRIMARY KEY, name TEXT NOT NULL, score INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS scores_by_score ON scores (score DESC, id);
+CREATE INDEX IF NOT EXISTS scores_by_name ON scores (name, score DESC);
+CREATE TABLE IF NOT EXISTS score_counts (score INTEGER PRIMARY KEY, count INTEGER NOT NULL);
+"""
+
+
+class ScoreCounts():
+    """
+    Fenwick tree (binary indexed tree) over the amount of scores per score value.
+    Adding a score and counting the scores up to a value are both O(log n) in the highest score.
+    The tree grows by doubling when a score doesn't fit
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.tree = [0] * (size + 1)
+        self.total = 0
+
+    def add(self, score, count=1):
+        """
+        Function to add a number of scores with the same value
+        Parameters:
+            score (int): The score value, at least 0
+            count (int): The amount of scores to add. Defaults to 1
+        """
+        while score >= self.size:
+            self.grow()
+        self.total += count
+        idx = score + 1
+        tree = self.tree
+        while idx <= self.size:
+            tree[idx] += count
+            idx += idx & -idx
+
+    def count_up_to(self, score):
+        """
+        Function to return the amount of scores lower than or equal to a value
+        Parameters:
+            score (int): The score value
+        """
+        if score < 0:
+            return 0
+        idx = min(score + 1, self.size)
+        tree = self.tree
+        count = 0
+        while idx > 0:
+            count += tree[idx]
+            idx -= idx & -idx
+        return count
+
+    def grow(self):
+        """
+        Function to double the size of the tree. Every node i of the old tree covers the same range
+        in the new tree, only the nodes covering the new upper half need to be filled in
+        """
+        old_size = self.size
+        self.size *= 2
+        self.tree.extend([0] * old_size)
+        # Node 2 * old_size covers the whole old range, all other new nodes start out empty
+        self.tree[self.size] = self.total
+
+
+class Leaderboard():
+    """
+    All scores ever submitted, with queries for the top of the leaderboard, ranks and per-player bests.
+    Every score is committed as soon as it is added
+    """
+    def __init__(self, path):
+        """
+        Parameters:
+            path (str): The path of the SQLite database, or ":memory:" for a leaderboard that isn't saved
+        """
+        self.connection = sqlite3.connect(path)
+        # Write-ahead logging makes a commit a single append, without syncing after every write
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.counts = ScoreCounts()
+        for score, count in self.connection.execute("SELECT score, count FROM score_counts"):
+            self.counts.add(score, count)
+
+    def __len__(self):
+        return self.counts.total
+
+    def add_score(self, name, score):
+        """
+        Function to add a single score
+        Parameters:
+            name (str): The name of the player
+            score (int): The score, at least 0
+        """
+        self.add_scores([(name, score)])
+
+    def add_scores(self, entries):
+        """
+        Function to add many scores in a single transaction
+        Parameters:
+            entries (iterable): (name, score) tuples, scores are at least 0
+        """
+        entries = [(name, score) for name, score in entries]
+        if any(score < 0 for _, score in entries):
+            raise ValueError("Scores can not be negative")
+        added = {}
+        for _, score in entries:
+            added[score] = added.get(score, 0) + 1
+        with self.connection:
+            self.connection.executemany("INSERT INTO scores (name, score) VALUES (?, ?)", entries)
+            self.connection.executemany("INSERT INTO score_counts (score, count) VALUES (?, ?) "
+                                        "ON CONFLICT (score) DO UPDATE SET count = count + excluded.count",
+                                        added.items())
+        for score, count in added.items():
+            self.counts.add(score, count)
+
+    def top(self, count, offset=0):
+        """
+        Function to return a list of (name, score) tuples of the highest scores, from high to low.
+        Equal scores are ordered from old to new
+        Parameters:
+            count (int): The maximum amount of scores to return
+            offset (int): The amount of highest scores to skip, for pagination. Defaults to 0
+        """
+        return self.connection.execute("SELECT name, score FROM scores ORDER BY score DESC, id LIMIT ? OFFSET ?",
+                                       (count, offset)).fetchall()
+
+    def rank(self, score):
+        """
+        Function to return the rank of a score in O(log n): 1 plus the amount of strictly higher scores
+        Parameters:
+            score (int): The score
+        """
+        return self.counts.total - self.counts.count_up_to(score) + 1
+
+    def placement(self, score):
+        """
+        Function to return the position a newly added score would get on the leaderboard,
+        which is below all scores that are equally high
+        Parameters:
+            score (int): The score
+        """
+        return self.counts.total - self.counts.count_up_to(score - 1) + 1
+
+    def best(self, name):
+        """
+        Function to return the best score of a player, or None if the player has no scores
+        Parameters:
+            name (str): The name of the player
+        """
+        return self.connection.execute("SELECT MAX(score) FROM scores WHERE name = ?", (name,)).fetchone()[0]
+
+    def occurrences(self, name, score):
+        """
+        Function to return how many times a player got a score
+        Parameters:
+            name (str): The name of the player
+            score (int): The score
+        """
+        return self.connection.execute("SELECT COUNT(*) FROM scores WHERE name = ? AND score = ?",
+                                       (name, score)).fetchone()[0]
+
+    def history(self, name, count=10):
+        """
+        Function to return the most recent scores of a player, from new to old
+        Parameters:
+            name (str): The name of the player
+            count (int): The maximum amount of scores to return. Defaults to 10
+        """
+        rows = self.connection.execute("SELECT score FROM scores WHERE name = ? ORDER BY id DESC LIMIT ?",
+                                       (name, count))
+        return [score for score, in rows]
+
+    def close(self):
+        """
+        Function to close the database
+        """
+        self.connection.close()
@@ -0,0 +1,325 @@
+"""
+Multiplayer rules for DangerNoodle: any amount of snakes, played by people or bots, on a single board
+with several apples. Like engine.GameState nothing here depends on pygame.
+All snakes share one OccupancyGrid, next to an array holding the snake on every occupied cell,
+so every collision is a single lookup of the cell the head moves into. A tick costs the same for every
+snake, no matter how many other snakes there are or how long they are, instead of scanning the bodies
+of all snakes for every head.
+All snakes move at the same time: the tails move away first, then heads moving into the same cell
+die head-on, and heads moving into any body die. The body of a dead snake is removed from the board.
+Usage:
+state = MultiGameState(80, 60, num_snakes=4)
+while state.step([greedy_bot(state, snake) for snake in state.snakes]):
+    pass
+print([snake.score for snake in state.snakes])
+"""
+
+from array import array
+from math import ceil, sqrt
+import random
+
+from engine import (UP, LEFT, DOWN, RIGHT, DIRECTION_STEPS, OPPOSITE_DIRECTIONS, DENSE_GRID_MAX_CELLS,
+                    OccupancyGrid, SnakeBody)
+
+# The owner of a cell that no snake is on
+NO_OWNER = -1
+# Random cells tried for a new apple that aren't occupied by another apple, before giving up on that apple
+APPLE_SPAWN_ATTEMPTS = 16
+
+
+class PlayerSnake():
+    """
+    A single snake of a multiplayer game, see MultiGameState. index is its position in MultiGameState.snakes
+    """
+    def __init__(self, index, x, y, direction=DOWN):
+        """
+        Parameters:
+            index (int): The index of the snake in the game
+            x (int): The column of the head
+            y (int): The row of the head, the tail starts in the row above it
+            direction (int): The direction the snake starts moving in. Defaults to DOWN
+        """
+        self.index = index
+        self.direction = direction
+        self.body = SnakeBody()
+        self.body.push_head(x, y - 1, direction)
+        self.body.push_head(x, y, direction)
+        self.snake_length = 2 # max allowed length of the snake
+        self.score = 0
+        self.alive = True
+        self.death_cause = None # "wall", "self", "snake" or "head" once the snake is dead
+        self.death_tick = None
+
+    def change_direction(self, direction):
+        """
+        Function to change the direction the snake will move in on the next step.
+        Returns False if the change is not allowed because the snake would reverse into itself
+        Parameters:
+            direction (int): One of UP, LEFT, DOWN or RIGHT
+        """
+        if direction == OPPOSITE_DIRECTIONS[self.direction]:
+            return False
+        self.direction = direction
+        return True
+
+    def is_turn(self, direction):
+        """
+        Function to check if moving in a direction changes the course of the snake,
+        meaning it is neither the current direction nor the opposite one
+        Parameters:
+            direction (int): One of UP, LEFT, DOWN or RIGHT
+        """
+        return direction != self.direction and direction != OPPOSITE_DIRECTIONS[self.direction]
+
+
+class MultiGameState():
+    """
+    The complete state and rules of a multiplayer game of snake, without any rendering.
+    step() advances every living snake by a single tick. The snakes start spread out evenly over the board,
+    all moving down. The game is over once every snake is dead, or the board is too full for another apple.
+    After every step, died, eaten_apples and new_apples hold what happened during that step
+    Usage:
+    state = MultiGameState(40, 30, num_snakes=2)
+    state.step([RIGHT, None])
+    """
+    def __init__(self, columns, rows, num_snakes=2, num_apples=None, boundaries=True, rng=random):
+        """
+        Parameters:
+            columns (int): The width of the board in cells
+            rows (int): The height of the board in cells
+            num_snakes (int): The amount of snakes. Defaults to 2
+            num_apples (int): The amount of apples on the board at the same time. Defaults to one per snake
+            boundaries (bool): If True, running into the edges is game over. If False, snakes wrap around
+            rng (Random): The random number generator used to spawn apples. Defaults to the random module
+        """
+        if columns * rows > DENSE_GRID_MAX_CELLS:
+            raise ValueError(f"Multiplayer boards can have at most {DENSE_GRID_MAX_CELLS} cells")
+        self.columns = columns
+        self.rows = rows
+        self.num_snakes = num_snakes
+        self.num_apples = num_snakes if num_apples is None else num_apples
+        self.boundaries = boundaries
+        self.rng = rng
+        self.reset()
+
+    def reset(self):
+        """
+        Function to initialize the game state at the start of the game, or reset it on game over
+        """
+        self.game_over = False
+        self.ticks = 0
+        self.grid = OccupancyGrid(self.columns, self.rows)
+        # Index of the snake on every cell, NO_OWNER for free cells
+        self.owners = array('l', [NO_OWNER]) * (self.columns * self.rows)
+        self.snakes = [PlayerSnake(index, x, y) for index, (x, y) in enumerate(self.start_positions())]
+        self.alive = list(self.snakes)
+        for snake in self.snakes:
+            for segment in snake.body:
+                self.occupy(segment.y * self.columns + segment.x, snake.index)
+        # The cell of every apple, None for an apple that found no room on the board.
+        # apple_slots maps the cell of every apple to its index in apples
+        self.apples = [None] * self.num_apples
+        self.apple_slots = {}
+        for slot in range(self.num_apples):
+            self.spawn_apple(slot)
+        self.died = [] # snakes that died during the last step
+        self.eaten_apples = [] # (slot, cell) of every apple eaten during the last step
+        self.new_apples = [] # (slot, cell) of every apple spawned during the last step
+
+    def start_positions(self):
+        """
+        Function to return the (x, y) of the head of every snake at the start of the game.
+        The board is divided in a lattice of equal blocks, with a snake in the center of every block
+        """
+        per_row = ceil(sqrt(self.num_snakes))
+        per_column = ceil(self.num_snakes / per_row)
+        block_width = self.columns // per_row
+        block_height = self.rows // per_column
+        if block_width < 1 or block_height < 2:
+            raise ValueError(f"A board of {self.columns}x{self.rows} cells is too small for {self.num_snakes} snakes")
+        return [(block_width * (index % per_row) + block_width // 2, block_height * (index // per_row) + block_height // 2)
+                for index in range(self.num_snakes)]
+
+    def occupy(self, cell, owner):
+        """
+        Function to mark a cell as occupied by a snake
+        Parameters:
+            cell (int): The index of the cell
+            owner (int): The index of the snake
+        """
+        self.grid.occupy(cell)
+        self.owners[cell] = owner
+
+    def release(self, cell):
+        """
+        Function to mark a cell as no longer occupied
+        Parameters:
+            cell (int): The index of the cell
+        """
+        self.grid.release(cell)
+        self.owners[cell] = NO_OWNER
+
+    def spawn_apple(self, slot):
+        """
+        Function to place an apple on a random cell that is neither occupied by a snake nor by another apple.
+        Returns the cell, or None if no room was found, in which case the slot stays empty
+        Parameters:
+            slot (int): The index of the apple in apples
+        """
+        for _ in range(APPLE_SPAWN_ATTEMPTS):
+            cell = self.grid.random_free_cell(self.rng)
+            if cell is None:
+                break
+            if cell not in self.apple_slots:
+                self.apples[slot] = cell
+                self.apple_slots[cell] = slot
+                return cell
+        self.apples[slot] = None
+        return None
+
+    def apple_positions(self):
+        """
+        Generator yielding the (x, y) of every apple on the board
+        """
+        for cell in self.apples:
+            if cell is not None:
+                y, x = divmod(cell, self.columns)
+                yield x, y
+
+    def step(self, directions=None):
+        """
+        Function to advance the game by a single tick. Returns True if any snake is still alive
+        Parameters:
+            directions (list): Optional new direction for every snake, by index, see PlayerSnake.change_direction().
+                None for a snake that keeps moving in its current direction. Defaults to None, moving all snakes straight
+        """
+        if self.game_over:
+            return False
+        self.ticks += 1
+        self.died = []
+        self.eaten_apples = []
+        self.new_apples = []
+        columns = self.columns
+        rows = self.rows
+        counts = self.grid.counts
+        owners = self.owners
+
+        # Find the new head of every snake, then move the tails away before any head moves in
+        moves = []
+        for snake in self.alive:
+            if directions is not None and directions[snake.index] is not None:
+                snake.change_direction(directions[snake.index])
+            dx, dy = DIRECTION_STEPS[snake.direction]
+            head = snake.body.head()
+            x = head.x + dx
+            y = head.y + dy
+            if x < 0 or x >= columns or y < 0 or y >= rows:
+                if self.boundaries:
+                    self.kill(snake, "wall")
+                    continue
+                x %= columns
+                y %= rows
+            old_tail = None
+            if len(snake.body) >= snake.snake_length:
+                old_tail = snake.body.pop_tail()
+                self.release(old_tail.y * columns + old_tail.x)
+            moves.append( (snake, x, y, old_tail) )
+
+        # Resolve the collisions of all heads at once, against each other and against the bodies
+        heads = {}
+        for snake, x, y, _ in moves:
+            cell = y * columns + x
+            other = heads.get(cell)
+            if other is not None:
+                if other.alive:
+                    self.kill(other, "head")
+                self.kill(snake, "head")
+            else:
+                heads[cell] = snake
+            if counts[cell]:
+                self.kill(snake, "self" if owners[cell] == snake.index else "snake")
+
+        # Move the heads of the survivors, reusing the segments of their old tails, and eat the apples
+        eaten = []
+        for snake, x, y, old_tail in moves:
+            if not snake.alive:
+                continue
+            snake.body.push_head(x, y, snake.direction, old_tail)
+            cell = y * columns + x
+            self.occupy(cell, snake.index)
+            slot = self.apple_slots.pop(cell, None)
+            if slot is not None:
+                snake.snake_length += 1
+                snake.score += 1
+                eaten.append(slot)
+                self.eaten_apples.append( (slot, cell) )
+
+        # Clear the bodies of the snakes that died, before the eaten apples are placed again
+        for snake in self.died:
+            for segment in snake.body:
+                cell = segment.y * columns + segment.x
+                if owners[cell] == snake.index:
+                    self.release(cell)
+        if self.died:
+            self.alive = [snake for snake in self.alive if snake.alive]
+        for slot in eaten:
+            cell = self.spawn_apple(slot)
+            if cell is not None:
+                self.new_apples.append( (slot, cell) )
+
+        if not self.alive or not self.apple_slots:
+            self.game_over = True
+        return not self.game_over
+
+    def kill(self, snake, cause):
+        """
+        Function to mark a snake as dead during the current step. Its body is cleared at the end of the step
+        Parameters:
+            snake (PlayerSnake): The snake that died
+            cause (str): The death cause: "wall", "self", "snake" or "head"
+        """
+        if not snake.alive:
+            return
+        snake.alive = False
+        snake.death_cause = cause
+        snake.death_tick = self.ticks
+        self.died.append(snake)
+
+
+def greedy_bot(state, snake):
+    """
+    Bot that moves towards its own apple, avoiding the cells that are occupied right now.
+    Every snake is assigned an apple by its index, so choosing a move takes the same time for any amount
+    of snakes and apples. Returns None for a dead snake
+    Parameters:
+        state (MultiGameState): The current game state
+        snake (PlayerSnake): The snake to pick a direction for
+    """
+    if not snake.alive:
+        return None
+    head = snake.body.head()
+    target = state.apples[snake.index % len(state.apples)] if state.apples else None
+    if target is None:
+        target = next(iter(state.apple_slots), head.y * state.columns + head.x)
+    target_y, target_x = divmod(target, state.columns)
+    counts = state.grid.counts
+    best = None
+    best_distance = None
+    for direction in (UP, LEFT, DOWN, RIGHT):
+        if direction == OPPOSITE_DIRECTIONS[snake.direction]:
+            continue
+        dx, dy = DIRECTION_STEPS[direction]
+        x = head.x + dx
+        y = head.y + dy
+        if not (0 <= x < state.columns and 0 <= y < state.rows):
+            if state.boundaries:
+                continue
+            x %= state.columns
+            y %= state.rows
+        if counts[y * state.columns + x]:
+            continue
+        distance = abs(target_x - x) + abs(target_y - y)
+        if best is None or distance < best_distance:
+            best = direction
+            best_distance = distance
+    return best
@@ -0,0 +1,261 @@
+"""
+Opt-in profiler for the game loop of DangerNoodle, enabled with --profile.
+Every frame is split in phases, each timed with perf_counter_ns by taking a lap at the end of the phase,
+so profiling a phase costs a single clock read. The durations of the last frames are kept in rolling
+log-linear histograms, which give percentiles without sorting, for the in-game overlay and the summary.
+Every frame can also be kept in a trace, to export as JSON or CSV for offline analysis.
+When profiling is disabled the game holds no profiler at all, and the game loop skips every lap.
+Usage:
+profiler = FrameProfiler(trace=True)
+profiler.begin_frame()
+handle_events()
+profiler.lap("events")
+profiler.end_frame()
+print(profiler.summary())
+profiler.export("trace.csv")
+"""
+
+from collections import deque
+import csv
+import json
+from time import perf_counter_ns
+
+# The phases of a frame of the game loop, in order. Spawning apples is timed separately while
+# it happens during the simulation, so its time is also part of the simulation phase
+PHASES = ("events", "simulation", "spawn_apple", "draw", "display", "sleep")
+NESTED_PHASES = ("spawn_apple",)
+# Every power of two is split in 2**SUB_BUCKET_BITS buckets, so percentiles are accurate to within 12.5%
+SUB_BUCKET_BITS = 3
+# At most this many frames are kept in the trace, about half an hour at 60 fps
+MAX_TRACE_FRAMES = 100000
+
+
+def bucket_index(value):
+    """
+    Function to return the index of the histogram bucket holding a value
+    Parameters:
+        value (int): The value, at least 0
+    """
+    sub_buckets = 1 << SUB_BUCKET_BITS
+    if value < sub_buckets:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return ((shift + 1) << SUB_BUCKET_BITS) + (value >> shift) - sub_buckets
+
+
+def bucket_upper_bound(index):
+    """
+    Function to return the highest value that falls in a histogram bucket
+    Parameters:
+        index (int): The index of the bucket, see bucket_index()
+    """
+    sub_buckets = 1 << SUB_BUCKET_BITS
+    if index < sub_buckets:
+        return index
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    mantissa = (index & (sub_buckets - 1)) + sub_buckets
+    return ((mantissa + 1) << shift) - 1
+
+
+class RollingHistogram():
+    """
+    Histogram of the last window samples, with buckets that grow exponentially in width.
+    Adding a sample is O(1), the oldest sample is removed from its bucket once the window is full
+    """
+    def __init__(self, window=600):
+        self.window = window
+        self.counts = [0] * (64 << SUB_BUCKET_BITS)
+        self.samples = deque()
+        self.total = 0 # sum of the samples in the window
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, value):
+        """
+        Function to add a sample, dropping the oldest sample if the window is full
+        Parameters:
+            value (int): The sample, at least 0
+        """
+        self.counts[bucket_index(value)] += 1
+        self.samples.append(value)
+        self.total += value
+        if len(self.samples) > self.window:
+            old = self.samples.popleft()
+            self.counts[bucket_index(old)] -= 1
+            self.total -= old
+
+    def percentile(self, percentile):
+        """
+        Function to return the upper bound of the bucket holding the sample at a given percentile, 0 if empty
+        Parameters:
+            percentile (float): The percentile, between 0 and 100
+        """
+        if not self.samples:
+            return 0
+        rank = min(len(self.samples) - 1, int(len(self.samples) * percentile / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen > rank:
+                return bucket_upper_bound(index)
+        return 0
+
+    def mean(self):
+        """
+        Function to return the mean of the samples in the window, 0 if empty
+        """
+        return self.total / len(self.samples) if self.samples else 0
+
+    def max(self):
+        """
+        Function to return the highest sample in the window, 0 if empty
+        """
+        return max(self.samples, default=0)
+
+
+class FrameProfiler():
+    """
+    Times the phases of every frame and keeps rolling histograms of them, in ns.
+    Phases are timed as laps: lap(phase) adds the time since the previous lap to the phase,
+    and end_frame() starts the next frame, so the time in between frames is never lost
+    """
+    def __init__(self, window=600, trace=False):
+        """
+        Parameters:
+            window (int): The amount of recent frames the histograms are made of. Defaults to 600
+            trace (bool): If True, keep the phase times of every frame for export(). Defaults to False
+        """
+        self.histograms = {phase: RollingHistogram(window) for phase in PHASES}
+        self.frame_times = RollingHistogram(window)
+        # (start, total, ticks, phase times...) tuples of the last MAX_TRACE_FRAMES frames
+        self.trace = deque(maxlen=MAX_TRACE_FRAMES) if trace else None
+        self.frames = 0
+        self.frame = dict.fromkeys(PHASES, 0)
+        self.frame_start = self.last_lap = perf_counter_ns()
+
+    def begin_frame(self):
+        """
+        Function to start timing a new frame and forget the current one, used after a menu
+        """
+        self.frame = dict.fromkeys(PHASES, 0)
+        self.frame_start = self.last_lap = perf_counter_ns()
+
+    def lap(self, phase):
+        """
+        Function to add the time since the previous lap to a phase of the current frame
+        Parameters:
+            phase (str): The phase that just ended, one of PHASES
+        """
+        now = perf_counter_ns()
+        self.frame[phase] += now - self.last_lap
+        self.last_lap = now
+
+    def end_frame(self, ticks=0):
+        """
+        Function to add the current frame to the histograms and the trace, and start the next frame.
+        The frame ends at the last lap
+        Parameters:
+            ticks (int): The amount of game ticks done this frame. Defaults to 0
+        """
+        total = self.last_lap - self.frame_start
+        frame = self.frame
+        for phase, elapsed in frame.items():
+            self.histograms[phase].add(elapsed)
+        self.frame_times.add(total)
+        if self.trace is not None:
+            self.trace.append( (self.frame_start, total, ticks) + tuple(frame.values()) )
+        self.frames += 1
+        self.frame = dict.fromkeys(PHASES, 0)
+        self.frame_start = self.last_lap
+
+    def timed(self, phase, function):
+        """
+        Function to return a wrapper of a function that adds the time spent in it to a phase of the current frame.
+        Used for phases nested in another phase, the laps are not affected
+        Parameters:
+            phase (str): The phase to add the time to, one of NESTED_PHASES
+            function (callable): The function to time
+        """
+        def wrapper(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.frame[phase] += perf_counter_ns() - start
+        return wrapper
+
+    def instrument(self, state):
+        """
+        Function to time the nested phases of a game state, by wrapping its methods on the instance
+        Parameters:
+            state (GameState): The game state to instrument
+        """
+        state.spawn_apple = self.timed("spawn_apple", state.spawn_apple)
+
+    def fps(self):
+        """
+        Function to return the frames per second over the recent frames
+        """
+        total = self.frame_times.total
+        return len(self.frame_times) * 1000000000 / total if total else 0.0
+
+    def overlay_lines(self):
+        """
+        Function to return the lines of text shown in the in-game overlay: the frame rate,
+        the 99th percentile frame time and the mean time of every phase
+        """
+        lines = [f"FPS {self.fps():.1f}", f"frame p99 {self.frame_times.percentile(99) / 1000000:.2f} ms"]
+        for phase, histogram in self.histograms.items():
+            lines.append(f"{phase} {histogram.mean() / 1000000:.2f} ms")
+        return lines
+
+    def summary(self):
+        """
+        Function to return a multi-line summary of the recent frames, with percentiles of every phase in ms
+        """
+        lines = [f"{self.frames} frames, {self.fps():.1f} fps"]
+        rows = [("frame", self.frame_times)] + list(self.histograms.items())
+        for name, histogram in rows:
+            lines.append(f"{name:<12} mean {histogram.mean() / 1000000:>7.3f} ms, "
+                         f"p50 {histogram.percentile(50) / 1000000:>7.3f} ms, "
+                         f"p99 {histogram.percentile(99) / 1000000:>7.3f} ms, "
+                         f"max {histogram.max() / 1000000:>7.3f} ms")
+        return "\n".join(lines)
+
+    def trace_rows(self):
+        """
+        Generator yielding a dictionary per traced frame, with the start of the frame relative to the
+        first traced frame and all durations in ms
+        """
+        if not self.trace:
+            return
+        first = self.trace[0][0]
+        for start, total, ticks, *phases in self.trace:
+            row = {"start_ms": (start - first) / 1000000, "total_ms": total / 1000000, "ticks": ticks}
+            for phase, elapsed in zip(PHASES, phases):
+                row[f"{phase}_ms"] = elapsed / 1000000
+            yield row
+
+    def export(self, path):
+        """
+        Function to write the trace to a file, as CSV if the path ends with .csv and as JSON otherwise.
+        The JSON also holds the summary statistics of every phase
+        Parameters:
+            path (str): The path of the file
+        """
+        fields = ["start_ms", "total_ms", "ticks"] + [f"{phase}_ms" for phase in PHASES]
+        with open(path, "w", encoding="utf-8", newline="") as file:
+            if path.lower().endswith(".csv"):
+                writer = csv.DictWriter(file, fields)
+                writer.writeheader()
+                writer.writerows(self.trace_rows())
+                return
+            histograms = dict(self.histograms, frame=self.frame_times)
+            summary = {name: {"mean_ms": histogram.mean() / 1000000,
+                              "p50_ms": histogram.percentile(50) / 1000000,
+                              "p99_ms": histogram.percentile(99) / 1000000,
+                              "max_ms": histogram.max() / 1000000}
+                       for name, histogram in histograms.items()}
+            json.dump({"phases": list(PHASES), "nested_phases": list(NESTED_PHASES), "fps": self.fps(),
+                       "summary": summary, "frames": list(self.trace_rows())}, file, indent=1)
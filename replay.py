@@ -0,0 +1,213 @@
+"""
+Recording and playback of DangerNoodle games.
+Every game owns a random number generator seeded with a known seed, so a game is completely
+determined by its seed, its settings and the direction changes of the player. A replay stores
+only those, with every direction change encoded as a single varint of the ticks since the previous one
+and the direction, which comes down to a few kilobytes per hour of play.
+Replay file layout, after the magic bytes and a version byte, all fields are unsigned varints:
+seed, columns, rows, flags (1 = boundaries, 2 = finished), ticks, score, amount of inputs,
+followed by one varint per input: (ticks since the previous input << 2) | direction index
+Usage:
+recorder = ReplayRecorder(GameState(40, 30, rng=Random(seed)), seed)
+recorder.step(RIGHT)
+replay = recorder.replay()
+state = simulate(Replay.decode(replay.encode()))
+"""
+
+from random import Random
+
+from engine import GameState, UP, LEFT, DOWN, RIGHT
+
+MAGIC = b"DNR"
+VERSION = 1
+# Directions are stored as an index into REPLAY_DIRECTIONS, which fits in 2 bits
+REPLAY_DIRECTIONS = (UP, LEFT, DOWN, RIGHT)
+FLAG_BOUNDARIES = 1
+FLAG_FINISHED = 2
+
+
+class ReplayError(ValueError):
+    """
+    Raised when replay data is malformed or of an unsupported version
+    """
+
+
+def encode_varint(value, out):
+    """
+    Function to append an unsigned integer to a bytearray as a LEB128 varint,
+    7 bits per byte with the high bit set on every byte but the last
+    Parameters:
+        value (int): The non-negative integer to encode
+        out (bytearray): The buffer to append to
+    """
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data, pos):
+    """
+    Function to read a LEB128 varint from data at pos. Returns a tuple of (value, position after the varint)
+    Parameters:
+        data (bytes): The buffer to read from
+        pos (int): The position of the first byte of the varint
+    """
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ReplayError("Replay data ends in the middle of a varint")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class Replay():
+    """
+    A recorded game: the seed and settings it was started with, the direction changes of the player
+    as (tick, direction) tuples, and the amount of ticks and score the game reached
+    """
+    def __init__(self, seed, columns, rows, boundaries, inputs, ticks, score, finished=True):
+        self.seed = seed
+        self.columns = columns
+        self.rows = rows
+        self.boundaries = boundaries
+        self.inputs = inputs
+        self.ticks = ticks
+        self.score = score
+        self.finished = finished # False if the game was still in progress when the replay was made
+
+    def encode(self):
+        """
+        Function to encode the replay into its compact binary format and return the bytes
+        """
+        out = bytearray(MAGIC)
+        out.append(VERSION)
+        flags = (FLAG_BOUNDARIES if self.boundaries else 0) | (FLAG_FINISHED if self.finished else 0)
+        for value in (self.seed, self.columns, self.rows, flags, self.ticks, self.score, len(self.inputs)):
+            encode_varint(value, out)
+        last_tick = 0
+        for tick, direction in self.inputs:
+            encode_varint(((tick - last_tick) << 2) | REPLAY_DIRECTIONS.index(direction), out)
+            last_tick = tick
+        return bytes(out)
+
+    @classmethod
+    def decode(cls, data):
+        """
+        Function to create a replay from the bytes made by encode()
+        Parameters:
+            data (bytes): The encoded replay
+        """
+        if data[:len(MAGIC)] != MAGIC:
+            raise ReplayError("Not a DangerNoodle replay")
+        if len(data) <= len(MAGIC) or data[len(MAGIC)] != VERSION:
+            raise ReplayError("Unsupported replay version")
+        pos = len(MAGIC) + 1
+        fields = []
+        for _ in range(7):
+            value, pos = decode_varint(data, pos)
+            fields.append(value)
+        seed, columns, rows, flags, ticks, score, input_count = fields
+        inputs = []
+        tick = 0
+        for _ in range(input_count):
+            value, pos = decode_varint(data, pos)
+            tick += value >> 2
+            inputs.append( (tick, REPLAY_DIRECTIONS[value & 3]) )
+        return cls(seed, columns, rows, bool(flags & FLAG_BOUNDARIES), inputs, ticks, score, bool(flags & FLAG_FINISHED))
+
+    def save(self, path):
+        """
+        Function to write the encoded replay to a file
+        Parameters:
+            path (str): The path of the file
+        """
+        with open(path, "wb") as file:
+            file.write(self.encode())
+
+    @classmethod
+    def load(cls, path):
+        """
+        Function to read a replay from a file written by save()
+        Parameters:
+            path (str): The path of the file
+        """
+        with open(path, "rb") as file:
+            return cls.decode(file.read())
+
+    def new_state(self):
+        """
+        Function to create the game state at the start of the recorded game
+        """
+        return GameState(self.columns, self.rows, self.boundaries, Random(self.seed))
+
+    def directions(self):
+        """
+        Generator yielding the direction passed to GameState.step() for every tick of the game,
+        None for ticks without a direction change
+        """
+        tick = 0
+        for input_tick, direction in self.inputs:
+            while tick < input_tick:
+                yield None
+                tick += 1
+            yield direction
+            tick += 1
+        while tick < self.ticks:
+            yield None
+            tick += 1
+
+
+class ReplayRecorder():
+    """
+    Records the direction changes of a game while it is being played.
+    Every tick of the game should go through step() instead of GameState.step()
+    """
+    def __init__(self, state, seed):
+        """
+        Parameters:
+            state (GameState): The game state, freshly created with Random(seed) as its rng
+            seed (int): The seed of the random number generator of the state
+        """
+        self.state = state
+        self.seed = seed
+        self.inputs = []
+
+    def step(self, direction=None):
+        """
+        Function to record a direction change and advance the game by a single tick,
+        see GameState.step(). Only directions that actually turn the snake are recorded
+        Parameters:
+            direction (int): Optional new direction. Defaults to None
+        """
+        if direction is not None and self.state.is_turn(direction):
+            self.inputs.append( (self.state.ticks, direction) )
+        return self.state.step(direction)
+
+    def replay(self):
+        """
+        Function to return the Replay of the game recorded so far
+        """
+        state = self.state
+        return Replay(self.seed, state.columns, state.rows, state.boundaries, list(self.inputs),
+                      state.ticks, state.score, state.game_over)
+
+
+def simulate(replay):
+    """
+    Function to re-simulate a replay as fast as possible, without rendering.
+    Returns the final GameState
+    Parameters:
+        replay (Replay): The replay to simulate
+    """
+    state = replay.new_state()
+    step = state.step
+    for direction in replay.directions():
+        if not step(direction):
+            break
+    return state
@@ -0,0 +1,173 @@
+"""
+Save games of DangerNoodle, so a game in progress can be resumed after closing the game.
+A save game holds everything needed to continue the game exactly where it was left: the body, direction,
+apple, length, score and tick of the snake, the state of the random number generator, so the apples keep
+spawning where they would have, whether the game is played with boundaries and the inputs recorded so far,
+so the replay of a resumed game is complete. Other settings such as dark mode are not part of a save game.
+The occupancy grid is rebuilt from the body, the cell the grid picks for the next apple only depends on which
+cells are occupied (see engine.OccupancyGrid), so the size of a save game depends on the length of the snake
+and not on the size of the board. The file is loaded with mmap, the checksum and the body are read
+straight from the mapped file without copying it, so resuming a very long snake costs a pass over its segments.
+Files are written to a temporary file first, which then atomically replaces the old save game.
+Save game file layout, all integers are little-endian:
+HEADER_FORMAT: magic bytes, version, flags (1 = boundaries, 2 = pending gaussian),
+    direction index, columns, rows, max length, score, ticks, apple x, apple y, amount of segments,
+    size of the replay, crc32 of everything after the header, pending gaussian of the rng,
+followed by the RNG_WORDS 32 bit words of the state of the Mersenne Twister,
+a 32 bit word per segment from tail to head: cell << 2 | direction index, and the encoded Replay of the inputs.
+Usage:
+save_game("savegame.dns", state, recorder)
+state, recorder = load_game("savegame.dns")
+"""
+
+from array import array
+import mmap
+import os
+from random import Random
+import struct
+import sys
+import zlib
+
+from engine import GameState, Segment, SnakeBody, restore_grid
+from replay import Replay, ReplayError, ReplayRecorder, REPLAY_DIRECTIONS
+
+MAGIC = b"DNS"
+VERSION = 2
+HEADER_FORMAT = struct.Struct("<3sBBBxxIIIIQIIIIId")
+FLAG_BOUNDARIES = 1
+FLAG_GAUSS = 2
+# Version of the state returned by Random.getstate(), and the amount of words in it: 624 words and the index
+RNG_VERSION = 3
+RNG_WORDS = 625
+# Segments and rng words are stored as 4 byte words, read in place on little-endian machines
+WORD_SIZE = 4
+
+
+class SaveGameError(ValueError):
+    """
+    Raised when a save game is damaged or of an unsupported version
+    """
+
+
+def encode_save(state, recorder):
+    """
+    Function to encode a game in progress into the save game format and return the bytes
+    Parameters:
+        state (GameState): The game to save
+        recorder (ReplayRecorder): The recorder of the game
+    """
+    rng_version, words, gauss_next = state.rng.getstate()
+    if rng_version != RNG_VERSION or len(words) != RNG_WORDS:
+        raise SaveGameError(f"Unsupported random number generator state version {rng_version}")
+    columns = state.columns
+    direction_indices = {direction: index for index, direction in enumerate(REPLAY_DIRECTIONS)}
+    data = array('I', words)
+    data.extend((segment.y * columns + segment.x) << 2 | direction_indices[segment.rotation] for segment in state.body)
+    if sys.byteorder == "big":
+        data.byteswap()
+    replay = recorder.replay().encode()
+    payload = data.tobytes() + replay
+    flags = (FLAG_BOUNDARIES if state.boundaries else 0) | (FLAG_GAUSS if gauss_next is not None else 0)
+    header = HEADER_FORMAT.pack(MAGIC, VERSION, flags, direction_indices[state.direction], columns, state.rows,
+                                state.snake_length, state.score, state.ticks, state.apple_x, state.apple_y,
+                                len(state.body), len(replay), zlib.crc32(payload), gauss_next or 0.0)
+    return header + payload
+
+
+def decode_save(data):
+    """
+    Function to create the game from the bytes made by encode_save().
+    Returns a tuple of (GameState, ReplayRecorder)
+    Parameters:
+        data (bytes): The encoded save game, any object supporting the buffer protocol such as an mmap
+    """
+    if len(data) < HEADER_FORMAT.size or data[:len(MAGIC)] != MAGIC:
+        raise SaveGameError("Not a DangerNoodle save game")
+    (_, version, flags, direction, columns, rows, snake_length, score, ticks, apple_x, apple_y,
+     length, replay_size, checksum, gauss_next) = HEADER_FORMAT.unpack_from(data)
+    if version != VERSION:
+        raise SaveGameError(f"Unsupported save game version {version}")
+    body_end = RNG_WORDS + length # in words, after the header
+    words_end = HEADER_FORMAT.size + body_end * WORD_SIZE
+    if len(data) != words_end + replay_size:
+        raise SaveGameError("Save game is truncated")
+    if length < 2 or not (0 <= apple_x < columns and 0 <= apple_y < rows):
+        raise SaveGameError("Save game holds an invalid game")
+    with memoryview(data) as view:
+        with view[HEADER_FORMAT.size:] as payload:
+            if zlib.crc32(payload) != checksum:
+                raise SaveGameError("Save game is damaged, checksum mismatch")
+        if sys.byteorder == "little":
+            words = view[HEADER_FORMAT.size:words_end].cast('I')
+        else:
+            words = array('I')
+            words.frombytes(view[HEADER_FORMAT.size:words_end])
+            words.byteswap()
+        error = None
+        try:
+            # Every attribute of GameState is set here, instead of building a fresh game with __init__() first
+            state = GameState.__new__(GameState)
+            state.columns = columns
+            state.rows = rows
+            state.boundaries = bool(flags & FLAG_BOUNDARIES)
+            state.rng = Random()
+            state.rng.setstate( (RNG_VERSION, tuple(words[:RNG_WORDS]), gauss_next if flags & FLAG_GAUSS else None) )
+            state.body = SnakeBody()
+            state.body.segments.extend(Segment((value >> 2) % columns, (value >> 2) // columns, REPLAY_DIRECTIONS[value & 3])
+                                       for value in words[RNG_WORDS:body_end])
+            state.grid = restore_grid(columns, rows, (value >> 2 for value in words[RNG_WORDS:body_end]))
+            # A game in progress never overlaps itself, every segment is on a cell of its own
+            if state.grid.free_count() + length != columns * rows:
+                raise ValueError("The snake overlaps itself")
+        except (IndexError, ValueError) as e:
+            # Raised once the views are released, the traceback would keep them alive and the mmap open
+            error = f"{e}: Save game holds an invalid game"
+        finally:
+            if isinstance(words, memoryview):
+                words.release()
+    if error is not None:
+        raise SaveGameError(error)
+    state.game_over = False
+    state.death_cause = None
+    state.direction = REPLAY_DIRECTIONS[direction]
+    state.snake_length = snake_length
+    state.score = score
+    state.ticks = ticks
+    state.apple_x = apple_x
+    state.apple_y = apple_y
+    try:
+        replay = Replay.decode(data[words_end:])
+    except (ReplayError, IndexError) as e:
+        raise SaveGameError(f"{e}: Save game holds an invalid replay")
+    recorder = ReplayRecorder(state, replay.seed)
+    recorder.inputs = replay.inputs
+    return state, recorder
+
+
+def save_game(path, state, recorder):
+    """
+    Function to write a game in progress to a save game file, replacing the old one only once it is completely written
+    Parameters:
+        path (str): The path of the save game
+        state (GameState): The game to save
+        recorder (ReplayRecorder): The recorder of the game
+    """
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(encode_save(state, recorder))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def load_game(path):
+    """
+    Function to read a save game written by save_game(), see decode_save() for what is returned
+    Parameters:
+        path (str): The path of the save game
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            raise SaveGameError("Save game is empty")
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return decode_save(data)
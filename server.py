@@ -0,0 +1,387 @@
+"""
+Local network multiplayer server for DangerNoodle, running the multiplayer rules of multiplayer.py.
+The server is authoritative: it runs the only simulation, at a fixed tick rate, and clients connected
+over TCP only send direction changes. Snakes without a player are played by bots, so a game can be
+watched by spectators alone. The messages are encoded by codec.py.
+After every tick the server encodes a delta frame with only what changed: heads pushed, tails popped,
+snakes that died and apples that moved. A client gets a snapshot of the whole game when it joins, and after
+that the deltas keep its copy of the game in sync, see codec.MirrorState.
+Every delta is encoded once and shared by all clients, and every KEYFRAME_INTERVAL ticks a snapshot of the
+whole game is encoded, the keyframe. The deltas of the last HISTORY_TICKS ticks are kept, and every client
+only remembers the last tick it was sent. Whenever its connection is ready for more, it gets every delta
+since that tick in a single write, so the ticks a slow client missed are coalesced. A client that joins,
+or that fell behind further than the history, gets the last keyframe and the deltas after it, and a client
+that stays unable to take any data for MAX_CLIENT_LAG ticks is disconnected. Nothing is queued per client,
+so a slow client never delays the tick.
+Usage:
+python server.py --port 7777 --snakes 8
+python server.py --load-test 300 --duration 10
+"""
+
+import argparse
+import asyncio
+from collections import deque
+from random import Random
+import socket
+from time import perf_counter_ns
+
+from codec import (StateEncoder, MirrorState, ProtocolError, frame, read_frame, NET_DIRECTIONS, ROLE_PLAYER,
+                   ROLE_SPECTATOR, HELLO, DIRECTION, LENGTH_FORMAT)
+from multiplayer import MultiGameState, greedy_bot
+from profiler import RollingHistogram
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 7777
+TICK_RATE = 15 # ticks per second, the speed of the snakes
+# A server that falls further behind than this many ticks skips them, like MAX_TICKS_PER_FRAME in the game
+MAX_CATCH_UP_TICKS = 5
+# A snapshot of the whole game is encoded every KEYFRAME_INTERVAL ticks, and the deltas of the last
+# HISTORY_TICKS ticks are kept. The history has to reach back to the last keyframe
+KEYFRAME_INTERVAL = 30
+HISTORY_TICKS = 64
+# Clients that couldn't be sent anything for this many ticks are disconnected
+MAX_CLIENT_LAG = 64
+# Bytes the operating system buffers per client. Larger buffers would hide a slow client for many seconds
+CLIENT_SEND_BUFFER = 1 << 16
+# Frames larger than this are refused, so a client can't make the server allocate huge buffers
+MAX_CLIENT_FRAME = 16
+RESTART_DELAY = 2 # seconds between the end of a game and the start of the next one
+
+
+class ClientConnection():
+    """
+    A client connected to the server. Instead of a queue of frames it only remembers the last tick it was sent
+    """
+    def __init__(self, reader, writer, snake_index=-1):
+        self.reader = reader
+        self.writer = writer
+        self.snake_index = snake_index # the snake played by the client, -1 for a spectator
+        self.game = None # the game the client was last sent a tick of
+        self.sent_tick = None # the last tick the client was sent, None if it needs a keyframe
+        self.ready_tick = 0 # the tick on which the client last took everything it was sent
+        self.draining = False # True while waiting for the client to take the data sent to it
+        self.wakeup = asyncio.Event() # set when there is something to send
+        self.closed = False
+
+
+class GameServer():
+    """
+    Authoritative multiplayer server, see the module docstring.
+    The simulation runs in run_ticks() and every connection in its own tasks, all on a single event loop
+    Usage:
+    server = GameServer(MultiGameState(80, 60, num_snakes=8))
+    asyncio.run(server.serve())
+    """
+    def __init__(self, state, tick_rate=TICK_RATE, bot=greedy_bot):
+        """
+        Parameters:
+            state (MultiGameState): The game to run
+            tick_rate (int): The ticks per second. Defaults to TICK_RATE
+            bot (callable): Takes the state and a snake and returns the direction of a snake without a player.
+                Defaults to multiplayer.greedy_bot
+        """
+        self.state = state
+        self.tick_rate = tick_rate
+        self.bot = bot
+        self.clients = set()
+        self.players = {} # snake index -> ClientConnection playing it
+        self.inputs = [None] * state.num_snakes # latest direction of every player, used on the next tick
+        self.encoder = StateEncoder()
+        self.game = 0 # counts the games played, ticks start at 0 again in every game
+        self.history = deque(maxlen=HISTORY_TICKS) # delta frames of the last ticks, one per tick in order
+        self.keyframe = (state.ticks, bytes(self.encoder.snapshot(state))) # (tick, snapshot frame)
+        self.tick_times = RollingHistogram(window=1000) # time spent per tick in ns, simulating, encoding and waking up the clients
+        self.skipped_ticks = 0
+        self.dropped_clients = 0
+        self.resyncs = 0 # amount of times a client fell behind the history and was sent a keyframe
+        self.port = None
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT, duration=None):
+        """
+        Function to accept clients and run the game, forever or for a number of seconds
+        Parameters:
+            host (str): The address to listen on. Defaults to DEFAULT_HOST, only accepting local clients
+            port (int): The port to listen on, 0 picks a free port. Defaults to DEFAULT_PORT
+            duration (float): The amount of seconds to run. Defaults to None, running until cancelled
+        """
+        server = await asyncio.start_server(self.handle_client, host, port)
+        self.port = server.sockets[0].getsockname()[1]
+        async with server:
+            try:
+                await asyncio.wait_for(self.run_ticks(), duration)
+            except asyncio.TimeoutError:
+                pass
+            for client in list(self.clients):
+                self.close_client(client)
+
+    async def run_ticks(self):
+        """
+        Function to advance the game at the tick rate, forever
+        """
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.tick_rate
+        next_tick = loop.time()
+        while True:
+            now = loop.time()
+            if now < next_tick:
+                await asyncio.sleep(next_tick - now)
+            elif now - next_tick > MAX_CATCH_UP_TICKS * interval:
+                # Too far behind to catch up, skip the ticks instead of running them all at once
+                skipped = int((now - next_tick) / interval)
+                self.skipped_ticks += skipped
+                next_tick += skipped * interval
+            next_tick += interval
+            if self.state.game_over:
+                await asyncio.sleep(RESTART_DELAY)
+                next_tick = loop.time()
+                self.restart()
+                continue
+            self.tick()
+
+    def tick(self):
+        """
+        Function to advance the game by a single tick, encode its delta and wake up the senders of the clients
+        """
+        start = perf_counter_ns()
+        state = self.state
+        directions = [self.inputs[snake.index] if snake.index in self.players else self.bot(state, snake)
+                      for snake in state.snakes]
+        self.inputs = [None] * state.num_snakes
+        lengths = [len(snake.body) for snake in state.snakes]
+        state.step(directions)
+        self.history.append(bytes(self.encoder.delta(state, lengths)))
+        if state.ticks % KEYFRAME_INTERVAL == 0:
+            self.keyframe = (state.ticks, bytes(self.encoder.snapshot(state)))
+        for client in list(self.clients):
+            if client.draining and state.ticks - client.ready_tick > MAX_CLIENT_LAG:
+                self.dropped_clients += 1
+                self.close_client(client, abort=True)
+            else:
+                client.wakeup.set()
+        self.tick_times.add(perf_counter_ns() - start)
+
+    def restart(self):
+        """
+        Function to start a new game, every client is sent its keyframe
+        """
+        self.state.reset()
+        self.game += 1
+        self.history.clear()
+        self.keyframe = (self.state.ticks, bytes(self.encoder.snapshot(self.state)))
+        for client in self.clients:
+            client.wakeup.set()
+
+    def frames_for(self, client):
+        """
+        Function to return the frames a client needs to catch up with the current tick: the deltas since the last
+        tick it was sent, or the keyframe and the deltas after it if it is new or fell behind the history
+        Parameters:
+            client (ClientConnection): The client
+        """
+        history = self.history
+        ticks = self.state.ticks
+        first_tick = ticks - len(history) + 1 # the tick of the oldest delta in the history
+        frames = []
+        if client.sent_tick is None or client.game != self.game or client.sent_tick + 1 < first_tick:
+            if client.sent_tick is not None and client.game == self.game:
+                self.resyncs += 1
+            keyframe_tick, keyframe = self.keyframe
+            frames.append(keyframe)
+            sent_tick = keyframe_tick
+        else:
+            sent_tick = client.sent_tick
+        frames.extend(history[index] for index in range(sent_tick + 1 - first_tick, len(history)))
+        client.game = self.game
+        client.sent_tick = ticks
+        return frames
+
+    async def handle_client(self, reader, writer):
+        """
+        Function called for every new connection, which handles the messages of the client
+        until it disconnects
+        Parameters:
+            reader (StreamReader): The stream of the client
+            writer (StreamWriter): The stream to the client
+        """
+        try:
+            payload = await read_frame(reader, MAX_CLIENT_FRAME)
+            if payload[0] != HELLO or len(payload) < 2:
+                raise ProtocolError("Expected a HELLO message")
+            client = ClientConnection(reader, writer)
+            writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, CLIENT_SEND_BUFFER)
+            if payload[1] == ROLE_PLAYER:
+                free = [index for index in range(self.state.num_snakes) if index not in self.players]
+                if free:
+                    client.snake_index = free[0]
+                    self.players[client.snake_index] = client
+            writer.write(bytes(self.encoder.welcome(self.state, client.snake_index, self.tick_rate)))
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError) as e:
+            print(f"{e}: Refused a client")
+            writer.close()
+            return
+        self.clients.add(client)
+        client.ready_tick = self.state.ticks
+        client.wakeup.set()
+        sender = asyncio.create_task(self.send_frames(client))
+        try:
+            while not client.closed:
+                payload = await read_frame(reader, MAX_CLIENT_FRAME)
+                if payload[0] == DIRECTION and len(payload) == 2 and payload[1] < len(NET_DIRECTIONS):
+                    if client.snake_index >= 0:
+                        self.inputs[client.snake_index] = NET_DIRECTIONS[payload[1]]
+                else:
+                    raise ProtocolError(f"Unexpected message type {payload[0]}")
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError):
+            pass
+        finally:
+            self.close_client(client)
+            sender.cancel()
+
+    async def send_frames(self, client):
+        """
+        Function running in its own task for every client, writing everything since the last write to it
+        whenever it is ready for more. Waiting for a slow client only holds up this task, never the tick
+        Parameters:
+            client (ClientConnection): The client
+        """
+        try:
+            while not client.closed:
+                await client.wakeup.wait()
+                client.wakeup.clear()
+                frames = self.frames_for(client)
+                if not frames:
+                    continue
+                client.writer.write(b"".join(frames))
+                client.draining = True
+                await client.writer.drain()
+                client.draining = False
+                client.ready_tick = self.state.ticks
+        except ConnectionError:
+            self.close_client(client)
+
+    def close_client(self, client, abort=False):
+        """
+        Function to disconnect a client, its snake is played by a bot from then on
+        Parameters:
+            client (ClientConnection): The client
+            abort (bool): If True, drop the data that wasn't sent yet instead of waiting for the client
+                to read it. Defaults to False
+        """
+        if client.closed:
+            return
+        client.closed = True
+        client.wakeup.set()
+        self.clients.discard(client)
+        if self.players.get(client.snake_index) is client:
+            del self.players[client.snake_index]
+        if abort:
+            client.writer.transport.abort()
+        else:
+            client.writer.close()
+
+    def summary(self):
+        """
+        Function to return a summary of the tick times and the clients
+        """
+        return (f"{self.state.ticks} ticks, tick p50 {self.tick_times.percentile(50) / 1000:.0f} us, "
+                f"p99 {self.tick_times.percentile(99) / 1000:.0f} us, max {self.tick_times.max() / 1000:.0f} us, "
+                f"{self.skipped_ticks} skipped. {len(self.clients)} clients connected, {self.resyncs} keyframe resyncs, "
+                f"{self.dropped_clients} dropped")
+
+
+async def spectate(host, port, mirror=None, read_delay=0):
+    """
+    Function to connect as a spectator until the connection closes, and return the amount of bytes received.
+    With a MirrorState every message is applied to it, otherwise the messages are only counted
+    Parameters:
+        host (str): The address of the server
+        port (int): The port of the server
+        mirror (MirrorState): The copy of the game to keep in sync. Defaults to None
+        read_delay (float): Seconds to wait after every read, to act as a slow client. Defaults to 0
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    if read_delay:
+        # Without a small receive buffer the operating system would read ahead megabytes for a slow client
+        writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    writer.write(frame(bytes((HELLO, ROLE_SPECTATOR))))
+    received = 0
+    try:
+        while True:
+            if mirror is not None:
+                payload = await read_frame(reader)
+                received += LENGTH_FORMAT.size + len(payload)
+                mirror.apply(payload)
+            else:
+                data = await reader.read(4096 if read_delay else 65536)
+                if not data:
+                    break
+                received += len(data)
+            if read_delay:
+                await asyncio.sleep(read_delay)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+    return received
+
+
+async def load_test(state, spectators, duration, tick_rate, slow=0):
+    """
+    Function to run a server with a number of spectators connected from the same process, and print the tick
+    times and the traffic. One spectator keeps a copy of the game, which is compared to the server at the end
+    Parameters:
+        state (MultiGameState): The game to run
+        spectators (int): The amount of spectators
+        duration (float): The amount of seconds to run
+        tick_rate (int): The ticks per second
+        slow (int): The amount of extra spectators that read far slower than the tick rate. Defaults to 0
+    """
+    server = GameServer(state, tick_rate)
+    serving = asyncio.create_task(server.serve(port=0, duration=duration))
+    while server.port is None:
+        await asyncio.sleep(0.01)
+    mirror = MirrorState()
+    clients = [asyncio.create_task(spectate(DEFAULT_HOST, server.port, mirror if not index else None))
+               for index in range(spectators)]
+    slow_clients = [asyncio.create_task(spectate(DEFAULT_HOST, server.port, read_delay=5)) for _ in range(slow)]
+    await serving
+    received = await asyncio.gather(*clients)
+    # The server closes the connections after the last tick, by then the copy has received every tick
+    expected = [[(segment.x, segment.y, segment.rotation) for segment in snake.body] if snake.alive else []
+                for snake in state.snakes]
+    in_sync = mirror.tick == state.ticks and mirror.apples == state.apples and expected == [
+        [(segment.x, segment.y, segment.rotation) for segment in body] for body in mirror.bodies]
+    # The slow clients would take ages to read everything the server sent them before it was done with them
+    for client in slow_clients:
+        client.cancel()
+    print(server.summary())
+    print(f"Spectator copy of the game {'in sync' if in_sync else 'OUT OF SYNC'} at tick {mirror.tick}, "
+          f"{sum(received) / max(1, spectators) / state.ticks:.0f} bytes per tick per spectator")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a DangerNoodle multiplayer server")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="address to listen on, 0.0.0.0 to accept other machines")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on")
+    parser.add_argument("--columns", type=int, default=80, help="width of the board in cells")
+    parser.add_argument("--rows", type=int, default=60, help="height of the board in cells")
+    parser.add_argument("--snakes", type=int, default=8, help="amount of snakes, the ones without a player are bots")
+    parser.add_argument("--apples", type=int, default=None, help="amount of apples, defaults to one per snake")
+    parser.add_argument("--no-boundaries", action="store_true", help="wrap around the edges instead of dying")
+    parser.add_argument("--tick-rate", type=int, default=TICK_RATE, help="ticks per second")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to run, defaults to forever")
+    parser.add_argument("--load-test", type=int, metavar="N", default=None,
+                        help="connect N spectators from this process and print the tick times, needs --duration")
+    parser.add_argument("--slow-clients", type=int, default=0, help="with --load-test, extra spectators that read too slowly")
+    args = parser.parse_args()
+    game = MultiGameState(args.columns, args.rows, args.snakes, args.apples, not args.no_boundaries, Random())
+    try:
+        if args.load_test is not None:
+            asyncio.run(load_test(game, args.load_test, args.duration or 10, args.tick_rate, args.slow_clients))
+        else:
+            game_server = GameServer(game, args.tick_rate)
+            print(f"Serving on {args.host}:{args.port}")
+            asyncio.run(game_server.serve(args.host, args.port, args.duration))
+            print(game_server.summary())
+    except KeyboardInterrupt:
+        pass
@@ -11,12 +11,14 @@ files = ["apple.png", "body.png", "Gasalt-Black.ttf", "head.png", "icon.png", "t
 
 # exclude unneeded packages to trim down file size
 # There might be more unneeded packages that are not excluded right now, more research might be needed
+# pygame imports numpy and pkg_resources on startup when they are available,
+# which is most of the time spent importing pygame
 cx_Freeze.setup(
         name="DangerNoodle",
         options={
         "build_exe": {
                 "packages": ["pygame"],
-                "excludes": ["concurrent", "email", "html", "http", "logging", "multiprocessing", "unittest", "numpy", "test", "tkinter", "urllib"],
+                "excludes": ["concurrent", "email", "html", "http", "logging", "multiprocessing", "unittest", "numpy", "pkg_resources", "setuptools", "test", "tkinter", "urllib"],
                 "include_files": files
                     }
                 },
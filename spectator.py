@@ -0,0 +1,191 @@
+"""
+Spectator client for the multiplayer server of server.py, to show live games on lobby screens.
+The game arrives as a keyframe and deltas (see codec.py) and is kept in a MirrorState. Every new tick is
+drawn by the in-game screen of the game itself, dangernoodle.Snake.draw_in_game_screen(), following one
+snake with the camera, and the other snakes and apples in view are drawn on top of it. The game window
+is created without persistence, so a spectator never touches the highscores, settings or save game.
+The left and right arrow keys switch to another snake, escape quits.
+Usage:
+python spectator.py --host 127.0.0.1 --port 7777
+"""
+
+import argparse
+import asyncio
+
+import pygame as pg
+
+from codec import MirrorState, ProtocolError, frame, read_frame, HELLO, ROLE_SPECTATOR
+import dangernoodle
+from server import DEFAULT_HOST, DEFAULT_PORT
+
+SPECTATOR_FPS = 60 # how often events are handled and new ticks are looked for
+
+
+class SpectatorState():
+    """
+    The part of a MirrorState the in-game screen draws, as if it were the GameState of the followed snake:
+    its body and score, and the first apple on the board. apple_x and apple_y are None when there is no apple
+    """
+    def __init__(self, mirror, index):
+        """
+        Parameters:
+            mirror (MirrorState): The copy of the game
+            index (int): The index of the snake to follow
+        """
+        self.mirror = mirror
+        self.index = index
+        self.columns = mirror.columns
+        self.rows = mirror.rows
+
+    @property
+    def body(self):
+        return self.mirror.bodies[self.index]
+
+    @property
+    def score(self):
+        return self.mirror.scores[self.index]
+
+    @property
+    def apple_x(self):
+        cell = self.apple_cell()
+        return None if cell is None else cell % self.columns
+
+    @property
+    def apple_y(self):
+        cell = self.apple_cell()
+        return None if cell is None else cell // self.columns
+
+    def apple_cell(self):
+        """
+        Function to return the cell of the first apple, or None if there is none
+        """
+        return next((cell for cell in self.mirror.apples if cell is not None), None)
+
+
+class Spectator():
+    """
+    Connects to a server as a spectator and draws the game in a window
+    Usage:
+    asyncio.run(Spectator().run(DEFAULT_HOST, DEFAULT_PORT))
+    """
+    def __init__(self, block_size=20):
+        """
+        Parameters:
+            block_size (int): The size of a cell in pixels. Defaults to 20
+        """
+        self.block_size = block_size
+        self.mirror = MirrorState()
+        self.game = None # the dangernoodle.Snake window, created once the size of the board is known
+        self.following = 0 # index of the followed snake
+        self.drawn_tick = None # the tick on screen, None to redraw
+        self.chunks_body = None # the body the chunks of the game were filled from
+        self.chunks_tick = None # the tick the chunks were last updated on
+
+    async def run(self, host, port):
+        """
+        Function to connect to a server and draw the game until the window is closed or the server goes away
+        Parameters:
+            host (str): The address of the server
+            port (int): The port of the server
+        """
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(frame(bytes((HELLO, ROLE_SPECTATOR))))
+        self.mirror.apply(await read_frame(reader))
+        self.game = dangernoodle.Snake(self.mirror.columns, self.mirror.rows, self.block_size, persistent=False)
+        receiver = asyncio.create_task(self.receive(reader))
+        try:
+            while not receiver.done() and self.handle_events():
+                if self.mirror.synced and self.mirror.tick != self.drawn_tick:
+                    self.draw()
+                await asyncio.sleep(1 / SPECTATOR_FPS)
+        finally:
+            receiver.cancel()
+            writer.close()
+            self.game.close()
+            pg.quit()
+        if receiver.done() and not receiver.cancelled() and receiver.exception():
+            print(f"{receiver.exception()}: Lost the connection to the server")
+
+    async def receive(self, reader):
+        """
+        Function to apply every message of the server to the copy of the game, until the connection closes
+        Parameters:
+            reader (StreamReader): The stream of the server
+        """
+        try:
+            while True:
+                self.mirror.apply(await read_frame(reader))
+        except asyncio.IncompleteReadError:
+            print("The server closed the connection")
+
+    def handle_events(self):
+        """
+        Function to handle the events of the window. Returns False once the spectator wants to quit
+        """
+        for event in pg.event.get():
+            if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
+                return False
+            if event.type == pg.KEYDOWN and event.key in (pg.K_LEFT, pg.K_RIGHT):
+                self.follow_next(1 if event.key == pg.K_RIGHT else -1)
+        return True
+
+    def follow_next(self, step):
+        """
+        Function to follow the next living snake in a direction, staying on the current one if no other lives
+        Parameters:
+            step (int): 1 for the next snake, -1 for the previous one
+        """
+        count = self.mirror.num_snakes
+        for offset in range(1, count + 1):
+            index = (self.following + step * offset) % count
+            if self.mirror.alive[index]:
+                self.following = index
+                self.drawn_tick = None
+                return
+
+    def draw(self):
+        """
+        Function to draw the current tick: the followed snake through the in-game screen of the game,
+        then the other snakes and apples on top
+        """
+        mirror = self.mirror
+        if not mirror.alive[self.following]:
+            self.follow_next(1)
+            if not mirror.alive[self.following]:
+                return
+        game = self.game
+        game.state = SpectatorState(mirror, self.following)
+        tail = game.state.body.tail()
+        game.last_tail = (tail.x, tail.y)
+        game.render_alpha = 1
+        game.update_camera()
+        # The chunks are updated from the heads and tails of the last deltas, and only filled from scratch
+        # for another snake or after a keyframe, which replaces the bodies
+        body = game.state.body
+        ticks = mirror.tick - self.chunks_tick if body is self.chunks_body else None
+        if ticks is not None and 0 <= ticks < len(body):
+            if ticks:
+                game.update_chunks(ticks)
+        else:
+            game.rebuild_chunks()
+        self.chunks_body = body
+        self.chunks_tick = mirror.tick
+        game.draw_in_game_screen()
+        game.draw_other_snakes(mirror.bodies, mirror.alive, mirror.apples, self.following)
+        pg.display.set_caption(f"DangerNoodle - Spectating snake {self.following + 1} of {mirror.num_snakes}")
+        pg.display.update()
+        self.drawn_tick = mirror.tick
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch a game on a DangerNoodle multiplayer server")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="address of the server")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port of the server")
+    parser.add_argument("--block-size", type=int, default=20, help="size of a cell in pixels")
+    args = parser.parse_args()
+    try:
+        asyncio.run(Spectator(args.block_size).run(args.host, args.port))
+    except (ConnectionError, ProtocolError) as e:
+        print(f"{e}: Could not watch the game on {args.host}:{args.port}")
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,308 @@
+"""
+Crash-safe persistence of the settings of DangerNoodle. Scores are stored in the leaderboard.
+Every change is appended as a single record to a log file, so nothing is lost when the game crashes
+and a torn write can only ever damage the last record. Every record is a line holding the crc32 checksum
+of its JSON payload followed by the payload itself, records that fail the checksum are ignored.
+Once the log holds COMPACT_EVERY records, the complete state is written to a snapshot file, which replaces
+the old snapshot with an atomic rename, and the log is started over. Loading reads the snapshot and the
+records since the last compaction, so startup time doesn't grow with the amount of games played.
+Records carry a sequence number and the snapshot stores the last one it contains, so a crash in between
+writing the snapshot and clearing the log never applies a record twice.
+All file writes happen on a background thread, the game only updates the state in memory and queues the record.
+Older versions of the game pickled the highscores and settings, migrate_legacy_files() carries those over once.
+Usage:
+store = SaveStore("save.log", "save.json")
+store.set_settings(boundaries=False, dark_mode=True)
+store.close()
+"""
+
+import json
+import os
+import pickle
+import queue
+import threading
+import zlib
+
+# Amount of records in the log after which it is compacted into the snapshot
+COMPACT_EVERY = 256
+DEFAULT_SETTINGS = {"boundaries": True, "dark_mode": False}
+# Migrated pickle files of older versions are renamed to their path with this suffix
+MIGRATED_SUFFIX = ".migrated"
+
+
+def encode_record(payload):
+    """
+    Function to encode a dictionary as a checksummed line: the crc32 of the JSON in hex, a space and the JSON
+    Parameters:
+        payload (dict): The data to encode, must be serializable to JSON
+    """
+    data = json.dumps(payload, separators=(",", ":"))
+    return f"{zlib.crc32(data.encode()):08x} {data}\n"
+
+
+def decode_record(line):
+    """
+    Function to decode a line made by encode_record(). Returns None if the line is damaged
+    Parameters:
+        line (str): The line to decode, including the trailing newline
+    """
+    if not line.endswith("\n") or len(line) < 10 or line[8] != " ":
+        return None # torn write, the record was never completely written
+    data = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(data.encode()):
+            return None
+        payload = json.loads(data)
+    except ValueError:
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+def apply_record(state, record):
+    """
+    Function to apply a single record to a state, see SaveStore.state() for its layout
+    Parameters:
+        state (dict): The state to update
+        record (dict): The decoded record
+    """
+    if record["type"] == "settings":
+        for key in DEFAULT_SETTINGS:
+            if key in record:
+                state["settings"][key] = bool(record[key])
+    state["seq"] = int(record["seq"])
+
+
+class SaveStore():
+    """
+    Holds the settings in memory, and persists every change to an append-only log.
+    settings is a dictionary with the keys of DEFAULT_SETTINGS
+    """
+    def __init__(self, log_path, snapshot_path):
+        """
+        Parameters:
+            log_path (str): The path of the append-only log file
+            snapshot_path (str): The path of the snapshot file
+        """
+        self.log_path = log_path
+        self.snapshot_path = snapshot_path
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.seq = 0 # sequence number of the last applied record
+        snapshot_seq = self.load_snapshot()
+        log_records, damaged = self.load_log(snapshot_seq)
+        # The writer thread only touches the files and its own copy of the state, the state in memory is owned by the game
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_records, args=(self.state(), log_records), daemon=True)
+        self.writer.start()
+        if damaged or log_records >= COMPACT_EVERY:
+            # Start over with a clean log, so new records are not appended after a damaged one
+            self.queue.put( ("compact", self.state()) )
+
+    def state(self):
+        """
+        Function to return a copy of the complete state, as stored in the snapshot
+        """
+        return {"seq": self.seq, "settings": dict(self.settings)}
+
+    def load_snapshot(self):
+        """
+        Function to load the state from the snapshot file, if there is one.
+        Returns the sequence number of the last record contained in the snapshot
+        """
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as file:
+                snapshot = decode_record(file.read())
+        except FileNotFoundError:
+            return 0
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"{e}: Could not read {self.snapshot_path}, using the default settings")
+            return 0
+        try:
+            if snapshot is None:
+                raise ValueError("checksum mismatch")
+            settings = {key: bool(snapshot["settings"].get(key, value)) for key, value in DEFAULT_SETTINGS.items()}
+            seq = int(snapshot["seq"])
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"{e}: {self.snapshot_path} is damaged, using the default settings")
+            return 0
+        self.settings = settings
+        self.seq = seq
+        return seq
+
+    def load_log(self, snapshot_seq):
+        """
+        Function to apply the records in the log that are newer than the snapshot.
+        Stops at the first damaged record. Returns a tuple of (amount of records in the log, True if damaged)
+        Parameters:
+            snapshot_seq (int): The sequence number of the last record contained in the snapshot
+        """
+        records = 0
+        try:
+            with open(self.log_path, "r", encoding="utf-8", newline="\n") as file:
+                for line in file:
+                    record = decode_record(line)
+                    if record is None:
+                        print(f"Ignoring damaged records at the end of {self.log_path}")
+                        return records, True
+                    records += 1
+                    try:
+                        if int(record["seq"]) > snapshot_seq:
+                            self.apply(record)
+                    except (KeyError, TypeError, ValueError):
+                        print(f"Ignoring invalid record in {self.log_path}: {line.strip()}")
+        except FileNotFoundError:
+            pass
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"{e}: Could not read {self.log_path}")
+            return records, True
+        return records, False
+
+    def apply(self, record):
+        """
+        Function to apply a single record to the in memory state
+        Parameters:
+            record (dict): The decoded record
+        """
+        state = {"seq": self.seq, "settings": self.settings}
+        apply_record(state, record)
+        self.seq = state["seq"]
+
+    def append(self, record):
+        """
+        Function to apply a record to the in memory state and queue it to be written to the log
+        Parameters:
+            record (dict): The record without sequence number
+        """
+        record["seq"] = self.seq + 1
+        self.apply(record)
+        self.queue.put( ("record", record) )
+
+    def set_settings(self, **settings):
+        """
+        Function to change one or more settings, see DEFAULT_SETTINGS for the available keys
+        Parameters:
+            settings (bool): The new values of the settings
+        """
+        self.append(dict(settings, type="settings"))
+
+    def close(self):
+        """
+        Function to write all queued records and stop the writer thread. Blocks until everything is written
+        """
+        self.queue.put( ("close", None) )
+        self.writer.join()
+
+    def write_records(self, state, log_records):
+        """
+        Function executed by the writer thread. Appends queued records to the log, and compacts the log
+        into a snapshot once it holds COMPACT_EVERY records. The state for the snapshot is kept up to date
+        by applying the written records to a copy of the state, so the state of the game is never shared
+        Parameters:
+            state (dict): A copy of the state at the time the thread is started, see state()
+            log_records (int): The amount of records already in the log
+        """
+        log = None
+        while True:
+            kind, data = self.queue.get()
+            try:
+                if kind == "close":
+                    break
+                if kind == "compact":
+                    log = self.compact(log, data)
+                    log_records = 0
+                    continue
+                if log is None:
+                    log = open(self.log_path, "a", encoding="utf-8", newline="\n")
+                log.write(encode_record(data))
+                log.flush()
+                os.fsync(log.fileno())
+                apply_record(state, data)
+                log_records += 1
+                if log_records >= COMPACT_EVERY:
+                    log = self.compact(log, state)
+                    log_records = 0
+            except OSError as e:
+                print(f"{e}: Could not save the settings")
+        if log is not None:
+            log.close()
+
+    def compact(self, log, state):
+        """
+        Function executed by the writer thread to write the state to the snapshot file and clear the log.
+        The snapshot is written to a temporary file first, which then atomically replaces the old snapshot.
+        Returns the reopened, empty log
+        Parameters:
+            log (file): The open log file, or None
+            state (dict): The state to store in the snapshot, see state()
+        """
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8", newline="\n") as file:
+            file.write(encode_record(state))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        if log is not None:
+            log.close()
+        # Records up to state["seq"] are in the snapshot now, so if this doesn't happen they are skipped on load
+        log = open(self.log_path, "w", encoding="utf-8", newline="\n")
+        log.flush()
+        os.fsync(log.fileno())
+        return log
+
+
+class RestrictedUnpickler(pickle.Unpickler):
+    """
+    Unpickler for the pickle files of older versions, which only hold lists, tuples, strings, ints and bools.
+    Every global is refused, so loading a tampered file can't run any code
+    """
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"Global {module}.{name} is not allowed")
+
+
+def load_legacy_pickle(path):
+    """
+    Function to load a pickle file of an older version with the RestrictedUnpickler
+    Parameters:
+        path (str): The path of the pickle file
+    """
+    with open(path, "rb") as file:
+        return RestrictedUnpickler(file).load()
+
+
+def migrate_legacy_files(store, leaderboard, highscores_path, settings_path):
+    """
+    Function to carry the highscores and settings of the pickle files of older versions over to the store
+    and the leaderboard. The settings are only migrated when the store has no files yet, otherwise the pickle file
+    is left in place. Highscores are merged into the leaderboard, leaving out scores it already holds,
+    so migrating again after an interrupted migration doesn't add them twice.
+    Migrated files are renamed with MIGRATED_SUFFIX, so this happens once.
+    Should be called right after creating the store, before anything is saved in it
+    Parameters:
+        store (SaveStore): The store to migrate the settings to
+        leaderboard (Leaderboard): The leaderboard to migrate the highscores to
+        highscores_path (str): The path of the pickled list of (name, score) tuples
+        settings_path (str): The path of the pickled (boundaries, dark_mode) tuple
+    """
+    if os.path.isfile(highscores_path):
+        try:
+            highscores = load_legacy_pickle(highscores_path)
+            # Unused places of the old highscores were filled with ('', 0)
+            entries = {}
+            for name, score in highscores:
+                if isinstance(name, str) and isinstance(score, int) and name and score > 0:
+                    entries[(name, score)] = entries.get((name, score), 0) + 1
+            missing = []
+            for (name, score), count in entries.items():
+                missing.extend([(name, score)] * (count - leaderboard.occurrences(name, score)))
+            leaderboard.add_scores(missing)
+            os.replace(highscores_path, highscores_path + MIGRATED_SUFFIX)
+        except (pickle.UnpicklingError, EOFError, OSError, TypeError, ValueError) as e:
+            print(f"{e}: Could not migrate the highscores of {highscores_path}")
+    if os.path.exists(store.log_path) or os.path.exists(store.snapshot_path):
+        return
+    if os.path.isfile(settings_path):
+        try:
+            boundaries, dark_mode = load_legacy_pickle(settings_path)
+            store.set_settings(boundaries=bool(boundaries), dark_mode=bool(dark_mode))
+            os.replace(settings_path, settings_path + MIGRATED_SUFFIX)
+        except (pickle.UnpicklingError, EOFError, OSError, TypeError, ValueError) as e:
+            print(f"{e}: Could not migrate the settings of {settings_path}")
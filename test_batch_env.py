@@ -0,0 +1,37 @@
+"""
+Tests of the rewards of the vectorized batch environment.
+Usage:
+python -m unittest test_batch_env
+"""
+
+import unittest
+
+import numpy as np
+
+from batch_env import BatchSnakeEnv, ACTIONS, DEATH_FULL, DEATH_WALL
+from engine import UP, LEFT, DOWN, RIGHT
+
+
+class BatchSnakeEnvRewardTest(unittest.TestCase):
+    def test_filling_the_board_keeps_the_apple_reward(self):
+        # On a 2x2 board the snake starts in the right column, going around the board eats every apple
+        env = BatchSnakeEnv(1, columns=2, rows=2)
+        cycle = [ACTIONS.index(direction) for direction in (LEFT, UP, RIGHT, DOWN)]
+        for tick in range(8):
+            rewards, dones = env.step(np.array([cycle[tick % 4]]))
+            if dones[0]:
+                break
+        self.assertTrue(dones[0])
+        self.assertEqual(env.death_causes[0], DEATH_FULL)
+        self.assertEqual(rewards[0], 1)
+
+    def test_dying_is_penalized(self):
+        env = BatchSnakeEnv(1, columns=2, rows=2)
+        rewards, dones = env.step(np.array([-1])) # the snake starts in the bottom row, moving down
+        self.assertTrue(dones[0])
+        self.assertEqual(env.death_causes[0], DEATH_WALL)
+        self.assertEqual(rewards[0], -1)
+
+
+if __name__ == "__main__":
+    unittest.main()
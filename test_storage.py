@@ -0,0 +1,74 @@
+"""
+Tests of migrating the pickled highscores and settings of older versions of DangerNoodle.
+Usage:
+python -m unittest test_storage
+"""
+
+import os
+import pickle
+import tempfile
+import unittest
+
+from leaderboard import Leaderboard
+from storage import MIGRATED_SUFFIX, SaveStore, migrate_legacy_files
+
+
+class MigrateLegacyFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.highscores_path = self.path("highscores.pickle")
+        self.settings_path = self.path("settings.pickle")
+        self.leaderboard = Leaderboard(":memory:")
+        self.store = None
+
+    def tearDown(self):
+        if self.store is not None:
+            self.store.close()
+        self.leaderboard.close()
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def write_pickle(self, path, data):
+        with open(path, "wb") as file:
+            pickle.dump(data, file)
+
+    def migrate(self):
+        self.store = SaveStore(self.path("save.log"), self.path("save.json"))
+        migrate_legacy_files(self.store, self.leaderboard, self.highscores_path, self.settings_path)
+
+    def test_highscores_into_empty_leaderboard(self):
+        self.write_pickle(self.highscores_path, [("Jasper", 12), ("Anna", 7), ("", 0)])
+        self.migrate()
+        self.assertEqual(self.leaderboard.top(10), [("Jasper", 12), ("Anna", 7)])
+        self.assertFalse(os.path.exists(self.highscores_path))
+        self.assertTrue(os.path.exists(self.highscores_path + MIGRATED_SUFFIX))
+
+    def test_highscores_merged_into_leaderboard(self):
+        self.leaderboard.add_scores([("Jasper", 12), ("Bram", 9)])
+        self.write_pickle(self.highscores_path, [("Jasper", 12), ("Anna", 7), ("Anna", 7), ("", 0)])
+        self.migrate()
+        self.assertEqual(self.leaderboard.top(10), [("Jasper", 12), ("Bram", 9), ("Anna", 7), ("Anna", 7)])
+        self.assertTrue(os.path.exists(self.highscores_path + MIGRATED_SUFFIX))
+
+    def test_highscores_migrated_when_store_exists(self):
+        with open(self.path("save.log"), "w"):
+            pass
+        self.write_pickle(self.highscores_path, [("Jasper", 12)])
+        self.write_pickle(self.settings_path, (False, True))
+        self.migrate()
+        self.assertEqual(self.leaderboard.top(10), [("Jasper", 12)])
+        # The store already holds settings, so the old settings are not migrated and the file is kept
+        self.assertEqual(self.store.settings, {"boundaries": True, "dark_mode": False})
+        self.assertTrue(os.path.exists(self.settings_path))
+
+    def test_settings_into_new_store(self):
+        self.write_pickle(self.settings_path, (False, True))
+        self.migrate()
+        self.assertEqual(self.store.settings, {"boundaries": False, "dark_mode": True})
+        self.assertTrue(os.path.exists(self.settings_path + MIGRATED_SUFFIX))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,272 @@
+"""
+Tournament runner to evaluate snake controllers on large amounts of seeded headless games.
+Games are split into shards of consecutive seeds, which are played in a pool of worker processes.
+Only the controller, the seeds and the aggregated results of a shard cross the process boundary,
+never the game states themselves. Results are streamed back as shards finish, so long runs
+can be monitored and cancelled partway through.
+A controller is any picklable callable taking a GameState and returning a direction
+(UP, LEFT, DOWN or RIGHT) or None to keep going straight.
+Usage:
+python tournament.py --games 100000
+"""
+
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import os
+from random import Random
+from time import perf_counter
+
+from autopilot import PathfindingController
+from engine import GameState, UP, LEFT, DOWN, RIGHT, DIRECTION_STEPS, OPPOSITE_DIRECTIONS
+
+
+class TournamentResult():
+    """
+    Aggregated results of a number of games played by a single controller.
+    Results of different shards are combined with merge()
+    """
+    def __init__(self):
+        self.games = 0
+        self.scores = Counter() # score -> amount of games
+        self.lengths = Counter() # game length in ticks -> amount of games
+        self.death_causes = Counter() # "wall", "self", "full" or "timeout" -> amount of games
+        self.cpu_time = 0.0 # seconds spent playing, summed over all workers
+
+    def add_game(self, score, ticks, death_cause):
+        """
+        Function to add the outcome of a single game
+        Parameters:
+            score (int): The final score of the game
+            ticks (int): The amount of ticks the game lasted
+            death_cause (str): The reason the game ended
+        """
+        self.games += 1
+        self.scores[score] += 1
+        self.lengths[ticks] += 1
+        self.death_causes[death_cause] += 1
+
+    def merge(self, other):
+        """
+        Function to add all games of another result to this one
+        Parameters:
+            other (TournamentResult): The result to merge into this one
+        """
+        self.games += other.games
+        self.scores.update(other.scores)
+        self.lengths.update(other.lengths)
+        self.death_causes.update(other.death_causes)
+        self.cpu_time += other.cpu_time
+
+    def mean_score(self):
+        """
+        Function to return the mean score over all games
+        """
+        if not self.games:
+            return 0.0
+        return sum(score * count for score, count in self.scores.items()) / self.games
+
+    def mean_length(self):
+        """
+        Function to return the mean game length in ticks over all games
+        """
+        if not self.games:
+            return 0.0
+        return sum(ticks * count for ticks, count in self.lengths.items()) / self.games
+
+    def score_percentile(self, percentile):
+        """
+        Function to return the score at a given percentile of the score distribution
+        Parameters:
+            percentile (float): The percentile, between 0 and 100
+        """
+        target = self.games * percentile / 100
+        seen = 0
+        for score in sorted(self.scores):
+            seen += self.scores[score]
+            if seen >= target:
+                return score
+        return 0
+
+    def summary(self):
+        """
+        Function to return a single line summary of the result
+        """
+        causes = ", ".join(f"{cause}: {count}" for cause, count in self.death_causes.most_common())
+        return (f"{self.games} games, mean score {self.mean_score():.2f} (p50 {self.score_percentile(50)}, "
+                f"p99 {self.score_percentile(99)}, max {max(self.scores, default=0)}), "
+                f"mean length {self.mean_length():.1f} ticks, deaths: {causes}")
+
+
+def play_game(controller, seed, columns=40, rows=30, boundaries=True, max_ticks=100000):
+    """
+    Function to play a single headless game with a controller and return (score, ticks, death cause).
+    Games that take longer than max_ticks are stopped, with "timeout" as death cause
+    Parameters:
+        controller (callable): Takes the GameState and returns a direction or None
+        seed (int): The seed of the random number generator used for apples
+        columns (int): The width of the board in cells
+        rows (int): The height of the board in cells
+        boundaries (bool): If True, running into the edges is game over
+        max_ticks (int): The maximum amount of ticks before the game is stopped
+    """
+    state = GameState(columns, rows, boundaries, Random(seed))
+    step = state.step
+    while step(controller(state)):
+        if state.ticks >= max_ticks:
+            return state.score, state.ticks, "timeout"
+    return state.score, state.ticks, state.death_cause
+
+
+def play_shard(controller, first_seed, count, columns, rows, boundaries, max_ticks):
+    """
+    Function executed in a worker process to play the games of a single shard.
+    Returns the aggregated TournamentResult of the shard
+    Parameters:
+        controller (callable): Takes the GameState and returns a direction or None
+        first_seed (int): The seed of the first game of the shard, the others use consecutive seeds
+        count (int): The amount of games in the shard
+        columns (int): The width of the board in cells
+        rows (int): The height of the board in cells
+        boundaries (bool): If True, running into the edges is game over
+        max_ticks (int): The maximum amount of ticks per game
+    """
+    result = TournamentResult()
+    start = perf_counter()
+    for seed in range(first_seed, first_seed + count):
+        result.add_game(*play_game(controller, seed, columns, rows, boundaries, max_ticks))
+    result.cpu_time = perf_counter() - start
+    return result
+
+
+def run_tournament(controllers, games, seed=0, shard_size=1000, workers=None,
+                   columns=40, rows=30, boundaries=True, max_ticks=100000):
+    """
+    Generator that plays the given amount of games with every controller in a process pool.
+    Every controller plays the same seeds. Yields (name, shard result, total result) as shards finish,
+    the total result holds everything of that controller finished so far.
+    Closing the generator (or breaking out of the loop) cancels the remaining shards.
+    Only a bounded amount of shards is submitted ahead, so cancelling is fast even for huge runs
+    Parameters:
+        controllers (dict): Maps a name to a controller callable
+        games (int): The amount of games per controller
+        seed (int): The seed of the first game. Defaults to 0
+        shard_size (int): The amount of games per shard. Defaults to 1000
+        workers (int): The amount of worker processes. Defaults to the amount of cpu cores
+        columns (int): The width of the board in cells
+        rows (int): The height of the board in cells
+        boundaries (bool): If True, running into the edges is game over
+        max_ticks (int): The maximum amount of ticks per game
+    """
+    workers = workers or os.cpu_count() or 1
+    totals = {name: TournamentResult() for name in controllers}
+    shards = ((name, first_seed, min(shard_size, seed + games - first_seed))
+              for name in controllers
+              for first_seed in range(seed, seed + games, shard_size))
+    executor = ProcessPoolExecutor(workers)
+    pending = {}
+    try:
+        for shard in shards:
+            # Keep every worker busy, but don't queue up the whole tournament at once
+            while len(pending) >= workers * 2:
+                yield from collect_shards(pending, totals)
+            name, first_seed, count = shard
+            future = executor.submit(play_shard, controllers[name], first_seed, count,
+                                     columns, rows, boundaries, max_ticks)
+            pending[future] = name
+        while pending:
+            yield from collect_shards(pending, totals)
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def collect_shards(pending, totals):
+    """
+    Generator that waits for at least one pending shard to finish and yields its results,
+    see run_tournament()
+    Parameters:
+        pending (dict): Maps the futures of unfinished shards to their controller name
+        totals (dict): Maps controller names to their total TournamentResult
+    """
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        name = pending.pop(future)
+        result = future.result()
+        totals[name].merge(result)
+        yield name, result, totals[name]
+
+
+def straight_controller(state):
+    """
+    Controller that never turns. Useful as a baseline
+    Parameters:
+        state (GameState): The current game state
+    """
+    return None
+
+
+def greedy_controller(state):
+    """
+    Controller that moves towards the apple, avoiding cells that would kill it on the next tick
+    Parameters:
+        state (GameState): The current game state
+    """
+    head = state.body.head()
+    best = None
+    best_distance = None
+    for direction in (UP, LEFT, DOWN, RIGHT):
+        if direction == OPPOSITE_DIRECTIONS[state.direction]:
+            continue
+        dx, dy = DIRECTION_STEPS[direction]
+        x = head.x + dx
+        y = head.y + dy
+        if not state.grid.in_bounds(x, y):
+            if state.boundaries:
+                continue
+            x %= state.columns
+            y %= state.rows
+        # The tail moves away this tick when the snake is at max length, so then it is safe to move onto
+        tail = state.body.tail()
+        tail_moves = len(state.body) >= state.snake_length and (x, y) == (tail.x, tail.y)
+        if state.grid.is_occupied(state.grid.cell(x, y)) and not tail_moves:
+            continue
+        distance = abs(state.apple_x - x) + abs(state.apple_y - y)
+        if best is None or distance < best_distance:
+            best = direction
+            best_distance = distance
+    return best
+
+
+CONTROLLERS = {"straight": straight_controller, "greedy": greedy_controller,
+               "pathfinding": PathfindingController()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate snake controllers on seeded headless games")
+    parser.add_argument("--games", type=int, default=10000, help="amount of games per controller")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game")
+    parser.add_argument("--shard-size", type=int, default=1000, help="amount of games per worker task")
+    parser.add_argument("--workers", type=int, default=None, help="amount of worker processes")
+    parser.add_argument("--no-boundaries", action="store_true", help="wrap around the edges instead of dying")
+    parser.add_argument("--max-ticks", type=int, default=100000,
+                        help="amount of ticks after which a game is stopped, filling the board takes about 200000")
+    # The pathfinding controller plays until the board is full, which takes far longer than the others
+    parser.add_argument("--controllers", nargs="+", default=["straight", "greedy"], choices=list(CONTROLLERS))
+    args = parser.parse_args()
+
+    start = perf_counter()
+    totals = {}
+    try:
+        for name, _, total in run_tournament({name: CONTROLLERS[name] for name in args.controllers}, args.games,
+                                             args.seed, args.shard_size, args.workers,
+                                             boundaries=not args.no_boundaries, max_ticks=args.max_ticks):
+            totals[name] = total
+            print(f"[{perf_counter() - start:7.1f}s] {name}: {total.games}/{args.games} games")
+    except KeyboardInterrupt:
+        print("Cancelled, showing partial results")
+    elapsed = perf_counter() - start
+    for name, total in totals.items():
+        print(f"{name}: {total.summary()}")
+    print(f"Played {sum(total.games for total in totals.values())} games in {elapsed:.1f}s")
@@ -0,0 +1,298 @@
+"""
+Replay verifier to check that leaderboard scores were actually reached under the game rules.
+A submitted replay is re-simulated without rendering, and only accepted if the game ends on exactly
+the tick and with exactly the score it claims. The simulation in resimulate() is a stripped down copy
+of engine.GameState.step() working on plain cell indices, which is several times faster than stepping
+a GameState, while spawning every apple on the same cell. Boards too large for the counts of
+engine.OccupancyGrid use a SparseOccupancyGrid in the game, their replays are verified by stepping a GameState.
+Bulk backlogs are verified in a pool of worker processes, only the encoded replays and the
+results cross the process boundary.
+Usage:
+python verifier.py replays/*.dnr --workers 4
+"""
+
+import argparse
+from collections import deque
+import os
+from random import Random
+from time import perf_counter, perf_counter_ns
+
+from engine import DOWN, DIRECTION_STEPS, OPPOSITE_DIRECTIONS, DENSE_GRID_MAX_CELLS, FREE_BLOCK_BITS, OccupancyGrid, nth_free_cell
+from replay import Replay, ReplayError
+
+# Replays claiming larger boards or longer games than this are rejected without simulating them,
+# so a malicious replay can't make the verifier allocate huge boards or run forever.
+# The largest board of the game is 10000x10000 cells, see MAX_BOARD_SIZE in dangernoodle.py
+MAX_CELLS = 10000 * 10000
+MAX_TICKS = 10000000
+
+
+class VerificationResult():
+    """
+    The outcome of verifying a single replay. valid is True if the replay reproduces its claimed score,
+    otherwise reason describes why it was rejected
+    """
+    def __init__(self, name, valid, reason, claimed_score, score, ticks, elapsed_us):
+        self.name = name
+        self.valid = valid
+        self.reason = reason # None for valid replays
+        self.claimed_score = claimed_score
+        self.score = score # score reached in the re-simulation
+        self.ticks = ticks # ticks simulated
+        self.elapsed_us = elapsed_us # time spent decoding and simulating in microseconds
+
+    def __repr__(self):
+        status = "valid" if self.valid else f"rejected ({self.reason})"
+        return (f"{self.name}: {status}, claimed score {self.claimed_score}, simulated score {self.score} "
+                f"in {self.ticks} ticks, {self.elapsed_us:.0f} us")
+
+
+def resimulate(replay):
+    """
+    Function to re-simulate a replay as fast as possible and return (score, ticks, death cause).
+    Follows the rules of engine.GameState exactly, and picks free cells like engine.OccupancyGrid,
+    so the same seed spawns the same apples. The death cause is None if the game is still alive
+    after the ticks of the replay
+    Parameters:
+        replay (Replay): The replay to simulate
+    """
+    columns = replay.columns
+    rows = replay.rows
+    if columns * rows > DENSE_GRID_MAX_CELLS:
+        return resimulate_state(replay)
+    boundaries = replay.boundaries
+    randrange = Random(replay.seed).randrange
+    size = columns * rows
+    # The counts of an engine.OccupancyGrid, updated inline to avoid method calls in the loop
+    grid = OccupancyGrid(columns, rows)
+    counts = grid.counts
+    block_free = grid.block_free
+    free = size
+    body = deque()
+    append = body.append
+    popleft = body.popleft
+
+    direction = DOWN
+    x = columns // 2
+    y = rows // 2
+    for cell in ((y - 1) * columns + x, y * columns + x):
+        append(cell)
+        counts[cell] = 1
+        block_free[cell >> FREE_BLOCK_BITS] -= 1
+        free -= 1
+    snake_length = 2
+    score = 0
+    apple = nth_free_cell(counts, block_free, randrange(free))
+
+    dx, dy = DIRECTION_STEPS[direction]
+    inputs = iter(replay.inputs)
+    next_tick, next_direction = next(inputs, (-1, None))
+    end = replay.ticks
+    tick = 0
+    while tick < end:
+        if tick == next_tick:
+            if next_direction != OPPOSITE_DIRECTIONS[direction]:
+                direction = next_direction
+                dx, dy = DIRECTION_STEPS[direction]
+            next_tick, next_direction = next(inputs, (-1, None))
+        tick += 1
+        x += dx
+        y += dy
+        if x < 0 or x >= columns or y < 0 or y >= rows:
+            if boundaries:
+                return score, tick, "wall"
+            x %= columns
+            y %= rows
+
+        head = y * columns + x
+        if len(body) >= snake_length:
+            # Moving without growing: the old tail is released and the head occupied, the amount of free cells stays the same
+            old_tail = popleft()
+            counts[old_tail] = 0
+            append(head)
+            if counts[head]:
+                return score, tick, "self"
+            counts[head] = 1
+            block_free[old_tail >> FREE_BLOCK_BITS] += 1
+            block_free[head >> FREE_BLOCK_BITS] -= 1
+        else:
+            append(head)
+            if counts[head]:
+                return score, tick, "self"
+            counts[head] = 1
+            block_free[head >> FREE_BLOCK_BITS] -= 1
+            free -= 1
+
+        if head == apple:
+            snake_length += 1
+            score += 1
+            if not free:
+                return score, tick, "full"
+            apple = nth_free_cell(counts, block_free, randrange(free))
+    return score, tick, None
+
+
+def resimulate_state(replay):
+    """
+    Function to re-simulate a replay by stepping a GameState and return (score, ticks, death cause),
+    like resimulate(). Used for boards larger than DENSE_GRID_MAX_CELLS, whose SparseOccupancyGrid spawns
+    apples by trying random cells instead of picking them by rank
+    Parameters:
+        replay (Replay): The replay to simulate
+    """
+    state = replay.new_state()
+    step = state.step
+    for direction in replay.directions():
+        if not step(direction):
+            break
+    return state.score, state.ticks, state.death_cause
+
+
+def check_replay(replay):
+    """
+    Function to check if a replay is well-formed and consistent with its claimed result.
+    Returns a tuple of (reason, score, ticks), where reason is None if the replay is valid
+    Parameters:
+        replay (Replay): The replay to check
+    """
+    if not replay.finished:
+        return "game was not finished", 0, 0
+    if replay.columns < 2 or replay.rows < 2 or replay.columns * replay.rows > MAX_CELLS:
+        return "unsupported board size", 0, 0
+    if replay.ticks > MAX_TICKS:
+        return "too many ticks", 0, 0
+    last_tick = -1
+    for tick, _ in replay.inputs:
+        # The recorder stores at most one input per tick, and none after the game has ended
+        if tick <= last_tick or tick >= replay.ticks:
+            return "invalid input ticks", 0, 0
+        last_tick = tick
+    score, ticks, death_cause = resimulate(replay)
+    if death_cause is None:
+        return "game does not end", score, ticks
+    if ticks != replay.ticks:
+        return "game ends on a different tick", score, ticks
+    if score != replay.score:
+        return "score mismatch", score, ticks
+    return None, score, ticks
+
+
+def verify_replay(replay, name=None):
+    """
+    Function to verify a single replay and return its VerificationResult
+    Parameters:
+        replay (Replay or bytes): The replay, or its encoded bytes
+        name (str): Name to identify the replay by in the result. Defaults to None
+    """
+    start = perf_counter_ns()
+    claimed_score = None
+    try:
+        if not isinstance(replay, Replay):
+            replay = Replay.decode(replay)
+        claimed_score = replay.score
+        reason, score, ticks = check_replay(replay)
+    except ReplayError as e:
+        reason, score, ticks = str(e), 0, 0
+    elapsed_us = (perf_counter_ns() - start) / 1000
+    return VerificationResult(name, reason is None, reason, claimed_score, score, ticks, elapsed_us)
+
+
+def verify_chunk(items):
+    """
+    Function executed in a worker process to verify a chunk of replays.
+    Returns a list of VerificationResults in the same order
+    Parameters:
+        items (list): (name, encoded replay) tuples
+    """
+    return [verify_replay(data, name) for name, data in items]
+
+
+def verify_replays(items, workers=None, chunk_size=256):
+    """
+    Generator that verifies (name, encoded replay) tuples in a process pool and yields
+    a VerificationResult for every replay, in the order the chunks finish.
+    Only a bounded amount of chunks is submitted ahead, so items can be a lazy iterator over a huge backlog.
+    Closing the generator cancels the remaining chunks
+    Parameters:
+        items (iterable): (name, encoded replay) tuples
+        workers (int): The amount of worker processes. Defaults to the amount of cpu cores
+        chunk_size (int): The amount of replays per worker task. Defaults to 256
+    """
+    # Imported here, so the game itself can verify its own replays without the multiprocessing machinery
+    from concurrent.futures import ProcessPoolExecutor
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(workers)
+    pending = set()
+    chunk = []
+    try:
+        for item in items:
+            chunk.append(item)
+            if len(chunk) < chunk_size:
+                continue
+            # Keep every worker busy, but don't read the whole backlog into memory at once
+            while len(pending) >= workers * 2:
+                yield from collect_chunks(pending)
+            pending.add(executor.submit(verify_chunk, chunk))
+            chunk = []
+        if chunk:
+            pending.add(executor.submit(verify_chunk, chunk))
+        while pending:
+            yield from collect_chunks(pending)
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def collect_chunks(pending):
+    """
+    Generator that waits for at least one pending chunk to finish and yields its results,
+    see verify_replays()
+    Parameters:
+        pending (set): The futures of unfinished chunks
+    """
+    from concurrent.futures import FIRST_COMPLETED, wait
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        pending.remove(future)
+        yield from future.result()
+
+
+def read_replay_files(paths):
+    """
+    Generator yielding (path, file contents) for every replay file
+    Parameters:
+        paths (list): The paths of the replay files
+    """
+    for path in paths:
+        with open(path, "rb") as file:
+            yield path, file.read()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verify the claimed scores of DangerNoodle replays")
+    parser.add_argument("replays", nargs="+", help="replay files to verify")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="amount of worker processes, 0 verifies in this process")
+    parser.add_argument("--chunk-size", type=int, default=256, help="amount of replays per worker task")
+    parser.add_argument("--quiet", action="store_true", help="only print rejected replays and the summary")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    if args.workers == 0:
+        results = (verify_replay(data, name) for name, data in read_replay_files(args.replays))
+    else:
+        results = verify_replays(read_replay_files(args.replays), args.workers, args.chunk_size)
+    timings = []
+    rejected = 0
+    for result in results:
+        timings.append(result.elapsed_us)
+        rejected += not result.valid
+        if not args.quiet or not result.valid:
+            print(result)
+    elapsed = perf_counter() - start
+    timings.sort()
+    if timings:
+        print(f"Verified {len(timings)} replays in {elapsed:.2f}s ({len(timings) / elapsed:.0f} replays/sec), "
+              f"{rejected} rejected. Per replay: p50 {timings[len(timings) // 2]:.0f} us, "
+              f"p99 {timings[min(len(timings) - 1, len(timings) * 99 // 100)]:.0f} us, max {timings[-1]:.0f} us")